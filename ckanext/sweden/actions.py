@@ -1,10 +1,18 @@
 import json
 
 from pylons import config
+from sqlalchemy import func, and_, orm
 
+import ckan.model as model
 import ckan.logic.converters as converters
 import ckan.plugins.toolkit as toolkit
 
+from ckanext.sweden.dcat.model import UnchangedHarvestJob
+from ckanext.sweden.model.validation import (ValidationSummary,
+                                             ValidationResource,
+                                             count_errors_and_warnings,
+                                             summarize_gather_errors)
+
 
 @toolkit.side_effect_free
 def dcat_organization_list(context, data_dict):
@@ -22,32 +30,41 @@ def dcat_organization_list(context, data_dict):
     organizations = toolkit.get_action('organization_list')(context=context,
                                                             data_dict=data_dict)
 
+    # Fetch everything needed for all organizations upfront, so the number
+    # of queries doesn't depend on the number of organizations
+    harvest_sources = _harvest_sources_by_org(context)
+    last_jobs = _last_harvest_jobs(
+        [source['id'] for source in harvest_sources.values()])
+    validation_results = _validation_results(last_jobs.values())
+
+    site_url = config.get('ckan.site_url').rstrip('/')
+
     dcat_org_list = []
     for org in organizations:
+
+        harvest_source = harvest_sources.get(org['id'])
+        if not harvest_source:
+            continue
+
         dcat_org_data = {
             'id': org['id'],
             'dcat_validation_result': "{host}{path}".format(
-                host=config.get('ckan.site_url').rstrip('/'),
+                host=site_url,
                 path=toolkit.url_for('dcat_validation',
                                      _id=org['name'])),
             'dcat_validation': None,
             'dcat_validation_date': None,
         }
 
-        dcat_validation = toolkit.get_action('dcat_validation')(context,
-                                                                {'id': org['id']})
-        if dcat_validation and dcat_validation.get('result'):
-            dcat_org_data['dcat_validation'] = dcat_validation['result']['errors'] == 0
-            dcat_org_data['dcat_validation_date'] = dcat_validation['last_validation']
-        else:
-            dcat_org_data['dcat_validation'] = None
-            dcat_org_data['dcat_validation_date'] = None
+        last_job = last_jobs.get(harvest_source['id'])
+        if last_job:
+            dcat_org_data['dcat_validation'] = \
+                validation_results[last_job.id]['errors'] == 0
+            dcat_org_data['dcat_validation_date'] = \
+                _isoformat(last_job.gather_finished)
 
         # set original_dcat_metadata_url
-        harvest_list = _harvest_list_for_org(context, org['id'])
-        if not harvest_list:
-            continue
-        harvest_url = harvest_list[0].get('url', '')
+        harvest_url = harvest_source.get('url', '')
         dcat_org_data.update({'original_dcat_metadata_url': harvest_url})
 
         # set uri
@@ -56,7 +73,7 @@ def dcat_organization_list(context, data_dict):
         dcat_org_data.update({'url': url})
 
         # set dcat_metadata_url
-        dcat_metadata_url = (config.get('ckan.site_url').rstrip('/') +
+        dcat_metadata_url = (site_url +
                              toolkit.url_for('dcat_organization',
                                              _id=org['name'],
                                              _format='rdf'))
@@ -67,11 +84,38 @@ def dcat_organization_list(context, data_dict):
     return dcat_org_list
 
 
+# Values of the `severity` parameter of `dcat_validation`
+SEVERITY_LEVELS = ('errors', 'warnings')
+
+
 @toolkit.side_effect_free
 def dcat_validation(context, data_dict):
     '''
     Return the validation errors for the last harvest job of the organization
     harvest source.
+
+    :param id: the id or name of the organization
+    :type id: string
+    :param offset: the number of validation messages to skip (optional,
+        default: 0)
+    :type offset: int
+    :param limit: the maximum number of validation messages to return
+        (optional, default: all of them)
+    :type limit: int
+    :param severity: only return the validation messages with ``errors`` or
+        with ``warnings`` (optional)
+    :type severity: string
+
+    `result.errors` and `result.warnings` are the totals for the whole job,
+    and `result.resources_count` the number of messages matching
+    `severity`, regardless of `offset` and `limit`.
+
+    If the remote file hadn't changed since a previous job, the job didn't
+    validate it again: `result.unchanged` is True and the messages are the
+    ones of that previous job, `result.reference_job_id`.
+
+    If `stream` is True in the context, `result.resources` is an iterator
+    that fetches the messages from the database as it is consumed.
     '''
 
     toolkit.check_access('dcat_validation', context, data_dict)
@@ -82,73 +126,269 @@ def dcat_validation(context, data_dict):
     except toolkit.Invalid:
         raise toolkit.ObjectNotFound
 
-    harvest_list = _harvest_list_for_org(context, id)
-    if harvest_list:
-        harvest_package = harvest_list[0]
-        harvest_source_id = harvest_package.get('id', '')
-        source_status = toolkit.get_action('harvest_source_show_status')(
-            context=context, data_dict={'id': harvest_source_id})
+    offset = _get_int(data_dict, 'offset', 0)
+    limit = _get_int(data_dict, 'limit')
+    severity = data_dict.get('severity') or None
+    if severity and severity not in SEVERITY_LEVELS:
+        raise toolkit.ValidationError(
+            {'severity': ['Must be one of: {0}'.format(
+                ', '.join(SEVERITY_LEVELS))]})
+
+    harvest_source = _harvest_source_for_org(id)
+    if harvest_source:
 
         return_obj = {
-            'url': harvest_package['url'],
+            'url': harvest_source.url,
             'last_validation': None,
             'result': None,
         }
-        last_job = source_status.get('last_job', None)
+        last_job = _last_harvest_jobs([harvest_source.id]).get(
+            harvest_source.id)
         if last_job:
 
-            return_obj['last_validation'] = last_job['gather_finished']
-
-            last_job_report = toolkit.get_action('harvest_job_report')(context={'ignore_auth': True},
-                                                                       data_dict={'id': last_job['id']})
-
-            gather_errors = last_job_report.get('gather_errors', [])
-            gather_errors_list = []
-            error_count = 0
-            warning_count = 0
-            for error in gather_errors:
-                try:
-                    message = json.loads(error.get('message'))
-                except ValueError:
-                    # If the error can't be parsed it is normal text (not a
-                    # json object) which means its a more fundamental error
-                    # We therefore increment the error count
-                    error_count += 1
-                    message = error.get('message', '')
-                else:
-                    if message.get('errors') and type(message.get('errors')) is list:
-                        error_count += len(message.get('errors'))
-                    if message.get('warnings') and type(message.get('warnings')) is list:
-                        warning_count += len(message.get('warnings'))
-
-                gather_errors_list.append(message)
-
-            result_obj = {
-                'errors': error_count,
-                'warnings': warning_count,
-                'resources': gather_errors_list
-            }
-
-            return_obj['result'] = result_obj
+            return_obj['last_validation'] = _isoformat(
+                last_job.gather_finished)
+            result = _validation_results([last_job])[last_job.id]
+            validated_job = _reference_jobs([last_job]).get(last_job.id)
+            result['unchanged'] = validated_job is not None
+            if validated_job:
+                result['reference_job_id'] = validated_job.id
+            else:
+                validated_job = last_job
+            result['resources_count'], result['resources'] = \
+                _validation_resources(validated_job, offset, limit, severity,
+                                      stream=context.get('stream', False))
+            return_obj['result'] = result
 
         return return_obj
     else:
         return None
 
 
-def _harvest_list_for_org(context, org_id):
+def _get_int(data_dict, key, default=None):
+    value = data_dict.get(key)
+    if value in (None, ''):
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise toolkit.ValidationError({key: ['Invalid integer']})
+    if value < 0:
+        raise toolkit.ValidationError({key: ['Must be a positive integer']})
+    return value
+
+
+def _harvest_source_for_org(org_id):
     '''
-    Return a list of harvest datasets with `owner_org` that corresponds with
+    Return the harvest dataset with `owner_org` that corresponds with
     `org_id`.
 
-    (This list should really only have one member.)
+    (There should really only be one.)
     '''
-    harvest_dict = {
-        'fq': 'owner_org:"{org_id}" type:"harvest"'.format(org_id=org_id)
-    }
-    harvest_search = toolkit.get_action('package_search')(context=context,
-                                                          data_dict=harvest_dict)
-    return harvest_search.get('results', [])
+    return model.Session.query(model.Package) \
+        .filter(model.Package.type == 'harvest') \
+        .filter(model.Package.owner_org == org_id) \
+        .filter(model.Package.state == 'active') \
+        .filter(model.Package.private == False) \
+        .order_by(model.Package.metadata_modified.desc()) \
+        .first()
+
+
+def _harvest_sources_by_org(context, rows=1000):
+    '''
+    Return a dict with the first harvest dataset of each organization, keyed
+    by the organization id.
+
+    All the harvest datasets are fetched at once (paging through the results
+    only if there are more than `rows` of them).
+    '''
+    harvest_sources = {}
+    start = 0
+    while True:
+        harvest_dict = {
+            'fq': 'type:"harvest"',
+            'rows': rows,
+            'start': start,
+        }
+        harvest_search = toolkit.get_action('package_search')(
+            context=context, data_dict=harvest_dict)
+        results = harvest_search.get('results', [])
+        for harvest_source in results:
+            owner_org = harvest_source.get('owner_org')
+            if owner_org and owner_org not in harvest_sources:
+                harvest_sources[owner_org] = harvest_source
+        start += rows
+        if not results or start >= harvest_search.get('count', 0):
+            break
+    return harvest_sources
+
+
+def _last_harvest_jobs(source_ids):
+    '''
+    Return a dict with the most recent harvest job of each of the given
+    harvest sources, keyed by the source id, using a single query.
+    '''
+    if not source_ids:
+        return {}
+
+    from ckanext.harvest.model import HarvestJob
+
+    last_created = model.Session.query(
+        HarvestJob.source_id,
+        func.max(HarvestJob.created).label('created')) \
+        .filter(HarvestJob.source_id.in_(source_ids)) \
+        .group_by(HarvestJob.source_id) \
+        .subquery()
+
+    jobs = model.Session.query(HarvestJob) \
+        .join(last_created,
+              and_(HarvestJob.source_id == last_created.c.source_id,
+                   HarvestJob.created == last_created.c.created)) \
+        .all()
+
+    return dict((job.source_id, job) for job in jobs)
+
+
+def _validation_results(jobs):
+    '''
+    Return a dict with the number of errors and warnings of the validation
+    of each of the given harvest jobs, keyed by the job id.
+
+    Results are read from the validation summaries stored by the harvester.
+    Jobs that don't have one yet (they are still gathering, or validating in
+    the background) get it worked out from their gather errors, with a
+    single query for all of them.
+
+    Jobs that found their remote file unchanged get the results of the job
+    that validated it.
+    '''
+    if not jobs:
+        return {}
+
+    references = _reference_jobs(jobs)
+    validated_jobs = dict((job.id, references.get(job.id, job))
+                          for job in jobs)
+    jobs = dict((job.id, job) for job in validated_jobs.values()).values()
+
+    job_ids = [job.id for job in jobs]
+    results = {}
+
+    summaries = model.Session.query(ValidationSummary) \
+        .filter(ValidationSummary.harvest_job_id.in_(job_ids))
+    for summary in summaries:
+        results[summary.harvest_job_id] = {
+            'errors': summary.errors,
+            'warnings': summary.warnings,
+        }
+
+    missing_jobs = [job for job in jobs if job.id not in results]
+    if missing_jobs:
+        messages = _gather_error_messages([job.id for job in missing_jobs])
+        for job in missing_jobs:
+            summary = summarize_gather_errors(messages[job.id])
+            results[job.id] = {
+                'errors': summary['errors'],
+                'warnings': summary['warnings'],
+            }
+
+    return dict((job_id, dict(results[validated_job.id]))
+                for job_id, validated_job in validated_jobs.iteritems())
+
+
+def _reference_jobs(jobs):
+    '''
+    Return a dict with the job that validated the remote file of each of the
+    given harvest jobs that found it unchanged, keyed by the job id.
+    '''
+    from ckanext.harvest.model import HarvestJob
+
+    if not jobs:
+        return {}
+
+    q = model.Session.query(UnchangedHarvestJob.harvest_job_id, HarvestJob) \
+        .join(HarvestJob,
+              HarvestJob.id == UnchangedHarvestJob.reference_job_id) \
+        .filter(UnchangedHarvestJob.harvest_job_id.in_(
+            [job.id for job in jobs]))
+    return dict(q.all())
+
+
+def _gather_error_messages(job_ids):
+    '''
+    Return a dict with the list of gather error messages of each of the
+    given harvest jobs, keyed by the job id.
+    '''
+    from ckanext.harvest.model import HarvestGatherError
+
+    messages = dict((job_id, []) for job_id in job_ids)
+    q = model.Session.query(HarvestGatherError.harvest_job_id,
+                            HarvestGatherError.message) \
+        .filter(HarvestGatherError.harvest_job_id.in_(job_ids)) \
+        .order_by(HarvestGatherError.created)
+    for job_id, message in q:
+        messages[job_id].append(message)
+    return messages
+
+
+def _validation_resources(job, offset=0, limit=None, severity=None,
+                          stream=False):
+    '''
+    Return the number of validation messages of a harvest job matching
+    `severity` and the page of them defined by `offset` and `limit`.
+
+    The messages of jobs with a stored summary are filtered and paged in the
+    database. If `stream` is True they are returned as an iterator that runs
+    the query when consumed, fetching the messages in batches.
+    '''
+    if not ValidationSummary.get(job.id):
+        # Still gathering or validating, so there's no stored summary to
+        # query
+        messages = _gather_error_messages([job.id])[job.id]
+        resources = summarize_gather_errors(messages)['resources']
+        if severity:
+            index = SEVERITY_LEVELS.index(severity)
+            resources = [resource for resource in resources
+                         if count_errors_and_warnings(resource)[index]]
+        end = offset + limit if limit is not None else None
+        return len(resources), resources[offset:end]
+
+    def query(session):
+        q = session.query(ValidationResource.message) \
+            .filter(ValidationResource.harvest_job_id == job.id)
+        if severity == 'errors':
+            q = q.filter(ValidationResource.errors > 0)
+        elif severity == 'warnings':
+            q = q.filter(ValidationResource.warnings > 0)
+        return q
+
+    count = query(model.Session).count()
+
+    def page(q):
+        q = q.order_by(ValidationResource.position).offset(offset)
+        if limit is not None:
+            q = q.limit(limit)
+        return q
+
+    if not stream:
+        resources = [json.loads(message)
+                     for message, in page(query(model.Session))]
+        return count, resources
+
+    def iter_resources():
+        # The response is sent after the request session has been removed,
+        # so use a session of our own
+        session = orm.sessionmaker(bind=model.meta.engine)()
+        try:
+            for message, in page(query(session)).yield_per(100):
+                yield json.loads(message)
+        finally:
+            session.close()
+
+    return count, iter_resources()
+
+
+def _isoformat(date_time):
+    return date_time.isoformat() if date_time else None
 
 
 # TODO: This overrides the core `user_invite` action to be able to customize
@@ -0,0 +1,196 @@
+'''
+Caching for the results of expensive template helpers and actions.
+
+Results are stored in a configurable backend:
+
+* `memory` (default): an in-process LRU cache, private to each worker.
+* `redis`: a Redis server shared by all the workers (and servers), so that
+  a value is only computed once for all of them.
+
+Each cached function has its own TTL, which can be set with the
+`ckanext.sweden.cache.ttl.<function name>` config option, falling back to
+`ckanext.sweden.cache.ttl`. A TTL of 0 disables caching.
+'''
+import time
+import hashlib
+import logging
+import threading
+import functools
+import cPickle as pickle
+from collections import OrderedDict
+
+from pylons import config
+
+import ckan.plugins.toolkit as toolkit
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_REDIS_URL = 'redis://localhost:6379/0'
+
+# Returned by the backends when a key is not cached (None is a valid value)
+MISSING = object()
+
+
+class MemoryCache(object):
+    '''An in-process, thread safe LRU cache with per entry expiry.'''
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return MISSING
+            expires, value = entry
+            if expires < time.time():
+                return MISSING
+            # Re-insert to mark it as the most recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache(object):
+    '''A cache shared between processes, stored in a Redis server.'''
+
+    prefix = 'ckanext-sweden:cache:'
+
+    def __init__(self, url=DEFAULT_REDIS_URL):
+        import redis
+        self.redis = redis.StrictRedis.from_url(url)
+
+    def get(self, key):
+        try:
+            value = self.redis.get(self.prefix + key)
+        except Exception, e:
+            log.warning('Error reading from the Redis cache: {0}'.format(e))
+            return MISSING
+        if value is None:
+            return MISSING
+        return pickle.loads(value)
+
+    def set(self, key, value, ttl):
+        try:
+            self.redis.set(self.prefix + key,
+                           pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                           ex=int(ttl))
+        except Exception, e:
+            log.warning('Error writing to the Redis cache: {0}'.format(e))
+
+    def delete(self, key):
+        self.redis.delete(self.prefix + key)
+
+    def clear(self):
+        keys = self.redis.keys(self.prefix + '*')
+        if keys:
+            self.redis.delete(*keys)
+
+
+_backend = None
+
+
+def get_backend():
+    '''Return the cache backend set up in the config, creating it once.'''
+    global _backend
+    if _backend is None:
+        name = config.get('ckanext.sweden.cache.backend', 'memory')
+        if name == 'redis':
+            _backend = RedisCache(
+                config.get('ckanext.sweden.cache.redis_url',
+                           DEFAULT_REDIS_URL))
+        elif name == 'memory':
+            _backend = MemoryCache(int(
+                config.get('ckanext.sweden.cache.max_entries',
+                           DEFAULT_MAX_ENTRIES)))
+        else:
+            raise ValueError('Unknown cache backend: {0}'.format(name))
+    return _backend
+
+
+def get_ttl(name):
+    '''Return the TTL in seconds for the cached function `name`.'''
+    ttl = config.get('ckanext.sweden.cache.ttl.{0}'.format(name),
+                     config.get('ckanext.sweden.cache.ttl', DEFAULT_TTL))
+    return int(ttl)
+
+
+def permission_context():
+    '''
+    Return a string identifying what the current user is allowed to see.
+
+    Anonymous users share their cache entries, while logged in users get their
+    own ones, as they might see private datasets. Sysadmins can see
+    everything, so they share theirs.
+    '''
+    try:
+        user = toolkit.c.user
+        userobj = toolkit.c.userobj
+    except (TypeError, AttributeError):
+        # Not in a web request (e.g. a paster command)
+        return 'anonymous'
+    if not user:
+        return 'anonymous'
+    if userobj and userobj.sysadmin:
+        return 'sysadmin'
+    return u'user:{0}'.format(user)
+
+
+def make_key(name, args=(), kwargs=None, per_user=True):
+    arguments = repr((args, sorted((kwargs or {}).items())))
+    key = [name, hashlib.sha1(arguments).hexdigest()]
+    if per_user:
+        key.insert(1, permission_context())
+    return u':'.join(key).encode('utf-8')
+
+
+def cached(per_user=True):
+    '''
+    Decorator that caches the results of the function for its TTL.
+
+    The cache key includes the function arguments and, if `per_user` is
+    True, the permission context of the current user, so results with private
+    datasets are never served to users that can't see them. Functions whose
+    results don't depend on the user can set `per_user` to False.
+
+    The original function is available as the `uncached` attribute of the
+    decorated one.
+    '''
+    def decorator(func):
+        name = func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            ttl = get_ttl(name)
+            if ttl <= 0:
+                return func(*args, **kwargs)
+
+            backend = get_backend()
+            key = make_key(name, args, kwargs, per_user=per_user)
+            value = backend.get(key)
+            if value is MISSING:
+                value = func(*args, **kwargs)
+                backend.set(key, value, ttl)
+            return value
+
+        wrapper.uncached = func
+        return wrapper
+    return decorator
@@ -0,0 +1,45 @@
+import logging
+
+from ckan.lib.cli import CkanCommand
+# No other CKAN imports allowed until _load_config is run,
+# or logging is disabled
+
+
+class OrganizationURLsCommand(CkanCommand):
+    """Manage the table used to check that organization URLs are unique
+
+    Usage:
+
+        sweden_organization_urls migrate
+            Fill in the table with the URLs of the existing organizations
+            again (it is filled in when created). Organizations that share a
+            URL are listed, only the oldest of them keeps it in the table,
+            and the rest need a different URL before they can be updated.
+    """
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 1
+    min_args = 1
+
+    def command(self):
+        """
+        """
+        self._load_config()
+        log = logging.getLogger(__name__)
+
+        import ckan.model as model
+        from ckanext.sweden.model import organization_url
+
+        organization_url.init_tables(model.meta.engine)
+
+        cmd = self.args[0]
+        if cmd == 'migrate':
+            duplicates = organization_url.migrate_organization_urls()
+            for url, names in sorted(duplicates.items()):
+                print 'Organizations with the same URL ({0}): {1}'.format(
+                    url, ', '.join(names))
+            if not duplicates:
+                log.info('No duplicated organization URLs found')
+        else:
+            print 'Command {0} not recognized'.format(cmd)
+            print self.usage
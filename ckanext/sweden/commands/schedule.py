@@ -0,0 +1,71 @@
+import logging
+
+from ckan.lib.cli import CkanCommand
+# No other CKAN imports allowed until _load_config is run,
+# or logging is disabled
+
+DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+
+
+class ScheduleCommand(CkanCommand):
+    """Spread the weekly harvest sources across the week
+
+    Usage:
+
+        sweden_harvest_schedule init
+            Create the harvest schedule table
+
+        sweden_harvest_schedule rebalance [--dry-run]
+            Assign each active weekly harvest source an hour of the week,
+            balancing the gather time of each hour based on how long the
+            last jobs of each source took, and set the next run of the
+            sources accordingly (run it periodically, e.g. weekly from
+            cron, so the schedule follows changes in the sources). With
+            --dry-run, the schedule is printed but not saved.
+
+        sweden_harvest_schedule show
+            Print the current schedule
+    """
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 1
+    min_args = 1
+
+    def __init__(self, name):
+        super(ScheduleCommand, self).__init__(name)
+        self.parser.add_option('--dry-run', dest='dry_run',
+                               action='store_true', default=False,
+                               help='Print the schedule without saving it')
+
+    def command(self):
+        """
+        """
+        self._load_config()
+        log = logging.getLogger(__name__)
+
+        import ckan.model as model
+        from ckanext.sweden.dcat import model as dcat_model
+        from ckanext.sweden.dcat import scheduler
+
+        dcat_model.init_tables(model.meta.engine)
+
+        cmd = self.args[0]
+        if cmd == 'init':
+            log.info("Harvest schedule DB tables are setup")
+        elif cmd == 'rebalance':
+            schedules = scheduler.rebalance(dry_run=self.options.dry_run)
+            if self.options.dry_run:
+                self._print_schedule(schedules)
+        elif cmd == 'show':
+            self._print_schedule(
+                model.Session.query(dcat_model.HarvestSchedule).all())
+        else:
+            print 'Command {0} not recognized'.format(cmd)
+            print self.usage
+
+    def _print_schedule(self, schedules):
+        for schedule in sorted(schedules, key=lambda s: s.slot):
+            print '{0} {1:02d}:00  {2}  {3:.0f}s ({4} jobs)'.format(
+                DAYS[schedule.slot // 24], schedule.slot % 24,
+                schedule.harvest_source_id, schedule.gather_seconds or 0,
+                schedule.jobs)
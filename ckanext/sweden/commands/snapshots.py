@@ -0,0 +1,114 @@
+import logging
+import multiprocessing
+
+from ckan.lib.cli import CkanCommand
+# No other CKAN imports allowed until _load_config is run,
+# or logging is disabled
+
+
+class SnapshotsCommand(CkanCommand):
+    """Manage the pre-rendered DCAT catalogs of the organizations
+
+    Usage:
+
+        sweden_dcat_snapshots rebuild [<organization>] [--force] [-j N]
+            Render the DCAT catalog snapshots of all organizations (or just
+            the given one) that are missing or stale (run it periodically,
+            e.g. from cron, to pick up dataset changes and harvests). With
+            --force, all snapshots are rendered again. -j sets the number of
+            organizations rendered in parallel.
+
+        sweden_dcat_snapshots clear [<organization>]
+            Delete the snapshots of all organizations (or just the given one)
+    """
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 2
+    min_args = 1
+
+    def __init__(self, name):
+        super(SnapshotsCommand, self).__init__(name)
+        self.parser.add_option('--force', dest='force', action='store_true',
+                               default=False,
+                               help='Render up to date snapshots as well')
+        self.parser.add_option('-j', '--jobs', dest='jobs', type='int',
+                               default=multiprocessing.cpu_count(),
+                               help='Number of parallel processes')
+
+    def command(self):
+        """
+        """
+        self._load_config()
+        log = logging.getLogger(__name__)
+
+        import ckan.model as model
+        from ckanext.sweden import snapshots
+
+        if not snapshots.get_snapshots_dir():
+            print 'ckanext.sweden.dcat.snapshots_dir is not set'
+            return
+
+        if len(self.args) > 1:
+            org = model.Group.get(self.args[1])
+            if not org or not org.is_organization:
+                print 'Organization {0} not found'.format(self.args[1])
+                return
+            org_ids = [org.id]
+        else:
+            org_ids = [org_id for org_id, in model.Session.query(
+                model.Group.id)
+                .filter(model.Group.is_organization == True)
+                .filter(model.Group.state == 'active')]
+
+        cmd = self.args[0]
+        if cmd == 'rebuild':
+            jobs = max(self.options.jobs, 1)
+            args = [(org_id, self.options.force) for org_id in org_ids]
+            if jobs == 1 or len(org_ids) < 2:
+                results = map(_render, args)
+            else:
+                # Each worker needs its own database connections
+                model.Session.remove()
+                model.meta.engine.dispose()
+                pool = multiprocessing.Pool(jobs, _init_worker)
+                try:
+                    results = pool.map(_render, args, chunksize=1)
+                finally:
+                    pool.close()
+                    pool.join()
+            log.info('Rendered the snapshots of {0} organizations, '
+                     '{1} were up to date, {2} failed'.format(
+                         results.count(True), results.count(False),
+                         results.count(None)))
+        elif cmd == 'clear':
+            for org_id in org_ids:
+                snapshots.delete_snapshots(org_id)
+        else:
+            print 'Command {0} not recognized'.format(cmd)
+            print self.usage
+
+
+def _init_worker():
+    import ckan.model as model
+    model.Session.remove()
+    model.meta.engine.dispose()
+
+
+def _render(args):
+    '''
+    Render the snapshots of an organization. Returns True if they were
+    rendered, False if they were up to date and None on errors.
+    '''
+    from ckanext.sweden import snapshots
+    import ckan.model as model
+
+    org_id, force = args
+    try:
+        return snapshots.render_snapshots(org_id, force=force)
+    except Exception:
+        logging.getLogger(__name__).exception(
+            'Error rendering the snapshots of organization {0}'.format(
+                org_id))
+        return None
+    finally:
+        model.Session.remove()
@@ -1,39 +1,242 @@
 import json
+import types
+import hashlib
+import calendar
+from email.utils import formatdate, parsedate_tz, mktime_tz
 
+import paste.fileapp
+from pylons import config
+
+import ckan.model as model
 import ckan.plugins.toolkit as toolkit
 
 from ckanext.dcat.utils import CONTENT_TYPES
+from ckanext.sweden import snapshots
+from ckanext.sweden import streaming
+from ckanext.sweden.dcat.model import UnchangedHarvestJob
+from ckanext.sweden.model.validation import ValidationSummary
+
+DEFAULT_CACHE_CONTROL = 'public, max-age=300'
 
 
 class DCATController(toolkit.BaseController):
 
     def read_organization(self, _id, _format='rdf'):
 
-        try:
-            org_dict = toolkit.get_action('organization_show')({}, {'id': _id})
-        except toolkit.ObjectNotFound:
-            toolkit.abort(404, toolkit._('Organization not found'))
+        org = _get_organization(_id)
+
+        # Streamed catalogs include all datasets, so they are not paginated
+        stream = (_format == 'nt' or
+                  toolkit.asbool(toolkit.request.params.get('stream')))
+        if stream and _format not in streaming.FORMATS:
+            toolkit.abort(409, toolkit._(
+                'Only the {0} formats can be streamed').format(
+                    ', '.join(sorted(streaming.FORMATS))))
+        page = None if stream else toolkit.request.params.get('page')
+
+        state = snapshots.catalog_state(org)
+
+        # Without a page, serve the snapshot of the full catalog if there is
+        # an up to date one, gzipped if the client supports it
+        snapshot = None
+        gzipped = False
+        if not page:
+            toolkit.response.headers['Vary'] = 'Accept-Encoding'
+            gzipped = 'gzip' in toolkit.request.accept_encoding
+            snapshot = snapshots.snapshot_path(org.id, _format, state,
+                                               gzipped=gzipped)
+            if not snapshot and gzipped:
+                gzipped = False
+                snapshot = snapshots.snapshot_path(org.id, _format, state)
+
+        # The catalog state doesn't tell when it changed (e.g. datasets may
+        # have been removed), so no Last-Modified is sent
+        etag = _etag(state, _format, page, stream, bool(snapshot), gzipped)
+        if _not_modified(etag):
+            return ''
+
+        content_type = (CONTENT_TYPES.get(_format) or
+                        streaming.CONTENT_TYPES[_format])
+        if snapshot:
+            return _serve_file(snapshot, content_type, gzipped)
+
+        if stream:
+            toolkit.response.headers['Content-type'] = content_type
+            context = {'user': toolkit.c.user}
+            return _buffered(streaming.iter_catalog(org.id, _format, context))
 
         data_dict = {
-            'fq': 'owner_org:{0}'.format(org_dict['id']),
+            'fq': 'owner_org:{0}'.format(org.id),
             'format': _format,
-            'page': toolkit.request.params.get('page'),
+            'page': page,
         }
 
-        toolkit.response.headers.update(
-            {'Content-type': CONTENT_TYPES[_format]})
+        toolkit.response.headers.update({'Content-type': content_type})
         try:
             return toolkit.get_action('dcat_catalog_search')({}, data_dict)
         except toolkit.ValidationError, e:
             toolkit.abort(409, str(e))
 
     def organization_dcat_validation(self, _id):
+        data_dict = {'id': _id}
+        for param in ('offset', 'limit', 'severity'):
+            if param in toolkit.request.params:
+                data_dict[param] = toolkit.request.params[param]
+
+        # The report of a job only changes when its validation summary is
+        # stored, at the end of the gather stage or once the document has
+        # been validated in the background, so it isn't cached until then
+        org = _get_organization(_id)
+        last_job = snapshots.last_harvest_job(org.id)
+        summary = _validation_summary(last_job) if last_job else None
+        if not last_job or (last_job.gather_finished and summary):
+            etag = _etag(org.id,
+                         last_job.id if last_job else None,
+                         last_job.gather_finished if last_job else None,
+                         summary.harvest_job_id if summary else None,
+                         summary.created if summary else None,
+                         summary.errors if summary else None,
+                         summary.warnings if summary else None,
+                         *[data_dict.get(param) for param in
+                           ('offset', 'limit', 'severity')])
+            if _not_modified(etag, summary.created if summary else None):
+                return ''
+
+        # Get the validation messages as an iterator, and write them to the
+        # response as they are fetched rather than encoding the whole report
+        # in memory
+        context = {'stream': True}
         try:
             dcat_validation_dict = \
-                toolkit.get_action('dcat_validation')({}, {'id': _id})
+                toolkit.get_action('dcat_validation')(context, data_dict)
         except toolkit.ObjectNotFound:
             toolkit.abort(404, toolkit._('Organization not found'))
+        except toolkit.ValidationError, e:
+            toolkit.abort(409, str(e))
 
         toolkit.response.headers.update({'Content-type': 'application/json'})
 
-        return json.dumps(dcat_validation_dict)
+        return _buffered(_iterencode(dcat_validation_dict))
+
+
+def _get_organization(id):
+    org = model.Group.get(id)
+    if not org or not org.is_organization or org.state != 'active':
+        toolkit.abort(404, toolkit._('Organization not found'))
+    return org
+
+
+def _validation_summary(job):
+    '''
+    Return the stored validation summary of a harvest job, or of the job
+    that validated its remote file if it was unchanged, or None if it
+    hasn't been stored yet.
+    '''
+    unchanged = model.Session.query(UnchangedHarvestJob).get(job.id)
+    return ValidationSummary.get(
+        unchanged.reference_job_id if unchanged else job.id)
+
+
+def _etag(*values):
+    return hashlib.md5(
+        u'|'.join(unicode(value) for value in values).encode('utf8')
+    ).hexdigest()
+
+
+def _not_modified(etag, last_modified=None):
+    '''
+    Set the caching headers of the response, and return True (after setting
+    the response status to 304) if the copy of the client is up to date.
+
+    `last_modified` is a naive UTC datetime.
+    '''
+    headers = toolkit.response.headers
+    headers['ETag'] = '"{0}"'.format(etag)
+    if last_modified:
+        last_modified = calendar.timegm(last_modified.utctimetuple())
+        headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+    cache_control = config.get('ckanext.sweden.dcat.cache_control',
+                               DEFAULT_CACHE_CONTROL)
+    if cache_control:
+        headers['Cache-Control'] = cache_control
+        headers.pop('Pragma', None)
+
+    request_headers = toolkit.request.headers
+    if_none_match = request_headers.get('If-None-Match')
+    if_modified_since = request_headers.get('If-Modified-Since')
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        not_modified = ('*' in tags or
+                        any(tag.lstrip('W/').strip('"') == etag
+                            for tag in tags))
+    elif if_modified_since and last_modified:
+        since = parsedate_tz(if_modified_since)
+        not_modified = bool(since) and last_modified <= mktime_tz(since)
+    else:
+        not_modified = False
+
+    if not_modified:
+        toolkit.response.status_int = 304
+        headers.pop('Content-type', None)
+    return not_modified
+
+
+def _serve_file(path, content_type, gzipped=False):
+    '''
+    Return the contents of a file as the response, keeping the caching
+    headers already set.
+    '''
+    fileapp = paste.fileapp.FileApp(path)
+    status, headers, app_iter = toolkit.request.call_application(fileapp)
+    headers = dict(headers)
+    for header in ('ETag', 'Last-Modified', 'Cache-Control', 'Expires'):
+        headers.pop(header, None)
+    toolkit.response.headers.update(headers)
+    toolkit.response.headers['Content-type'] = content_type
+    if gzipped:
+        toolkit.response.headers['Content-Encoding'] = 'gzip'
+    toolkit.response.status = status
+    return app_iter
+
+
+def _iterencode(obj):
+    '''
+    Encode `obj` as JSON, yielding the output in chunks.
+
+    Lists and generators are encoded one item at a time, so generators are
+    only consumed as the output is written.
+    '''
+    if isinstance(obj, dict):
+        yield '{'
+        for i, (key, value) in enumerate(obj.iteritems()):
+            if i:
+                yield ', '
+            yield json.dumps(key) + ': '
+            for chunk in _iterencode(value):
+                yield chunk
+        yield '}'
+    elif isinstance(obj, (list, tuple, types.GeneratorType)):
+        yield '['
+        for i, item in enumerate(obj):
+            if i:
+                yield ', '
+            for chunk in _iterencode(item):
+                yield chunk
+        yield ']'
+    else:
+        yield json.dumps(obj)
+
+
+def _buffered(chunks, size=64 * 1024):
+    '''Join the given chunks into blocks of at least `size` bytes.'''
+    buf = []
+    length = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(buf)
+            buf = []
+            length = 0
+    if buf:
+        yield ''.join(buf)
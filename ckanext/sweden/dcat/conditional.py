@@ -0,0 +1,188 @@
+'''
+Skipping harvest jobs whose remote file hasn't changed.
+
+For each harvest source, the `ETag` and `Last-Modified` headers sent with
+the file and the hash of its content are stored once it has been validated
+and its datasets gathered. Before the next download a conditional request is
+sent with them, and if the server replies with a 304, or the downloaded file
+has the same hash, the file is neither validated nor imported again. The job
+is recorded as unchanged, and its validation report is the one of the job
+that validated the file.
+
+Files that couldn't be validated, and jobs whose gather stage failed or
+whose datasets failed to import, are not skipped next time. Neither are
+paginated catalogs, as the other pages may have changed even if the first
+one hasn't.
+'''
+import hashlib
+import logging
+import threading
+
+import requests
+
+import ckan.model as model
+
+from ckanext.sweden.dcat.model import HarvestSourceState, UnchangedHarvestJob
+from ckanext.sweden.model.validation import delete_validation_summary
+
+log = logging.getLogger(__name__)
+
+TIMEOUT = (10, 60)
+
+# The caching headers of the last response for each thread, and what was
+# downloaded in the current job, until it is stored
+_local = threading.local()
+
+
+def reset():
+    '''Forget what was downloaded by the previous job of this thread.'''
+    _local.headers = {}
+    _local.main_file = False
+    _local.downloaded = None
+    _local.pages = 0
+
+
+def not_modified(url, harvest_job):
+    '''
+    Send a conditional HEAD request for the main file of the harvest source,
+    and return True if the server says it hasn't changed.
+
+    Errors are logged and left for the actual download to report.
+    '''
+    _local.headers = {}
+    _local.pages = getattr(_local, 'pages', 0) + 1
+    # Other pages of paginated catalogs are always downloaded and validated
+    _local.main_file = (url == harvest_job.source.url)
+    if not _local.main_file:
+        return False
+
+    headers = {}
+    state = _validated_state(harvest_job.source_id)
+    if state:
+        if state.etag:
+            headers['If-None-Match'] = state.etag
+        if state.last_modified:
+            headers['If-Modified-Since'] = state.last_modified
+
+    # Even without anything to send, the response headers are stored for
+    # the next time
+    try:
+        r = requests.head(url, headers=headers, timeout=TIMEOUT,
+                          allow_redirects=True)
+    except requests.exceptions.RequestException, e:
+        log.debug('Conditional request to {0} failed: {1}'.format(url, e))
+        return False
+
+    if r.status_code == 304 and headers:
+        return True
+    if r.status_code == 200:
+        _local.headers = {
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+        }
+    return False
+
+
+def content_unchanged(content, harvest_job):
+    '''
+    Return True if the content downloaded is the same that was validated
+    last time.
+    '''
+    if not getattr(_local, 'main_file', False):
+        return False
+    state = _validated_state(harvest_job.source_id)
+    return bool(state and state.content_hash == _hash(content))
+
+
+def downloaded(content, harvest_job):
+    '''
+    Keep the hash of the main file downloaded in a harvest job and its
+    caching headers, to be stored with `record_validated` once it has been
+    validated and its datasets gathered.
+    '''
+    if not getattr(_local, 'main_file', False):
+        return
+    headers = getattr(_local, 'headers', None) or {}
+    _local.downloaded = {
+        'harvest_source_id': harvest_job.source_id,
+        'etag': headers.get('etag'),
+        'last_modified': headers.get('last_modified'),
+        'content_hash': _hash(content),
+    }
+
+
+def pop_downloaded():
+    '''
+    Return what was kept by `downloaded` in the current job, if anything,
+    and forget it. Call it once all the pages have been downloaded.
+    '''
+    downloaded = getattr(_local, 'downloaded', None)
+    if downloaded:
+        downloaded['paginated'] = getattr(_local, 'pages', 0) > 1
+    _local.downloaded = None
+    return downloaded
+
+
+def record_validated(harvest_job_id, downloaded):
+    '''
+    Store the hash of the file validated in a harvest job and the caching
+    headers it was sent with, as returned by `pop_downloaded`, and whether
+    other pages were downloaded after it.
+    '''
+    source_id = downloaded['harvest_source_id']
+    state = HarvestSourceState.get(source_id) or \
+        HarvestSourceState(harvest_source_id=source_id)
+    state.etag = downloaded['etag']
+    state.last_modified = downloaded['last_modified']
+    state.content_hash = downloaded['content_hash']
+    state.paginated = downloaded['paginated']
+    state.validated_job_id = harvest_job_id
+    model.Session.add(state)
+    model.Session.commit()
+
+
+def mark_unchanged(harvest_job):
+    '''
+    Record that the remote file of a harvest job was the same as in the
+    last job that validated it.
+    '''
+    state = HarvestSourceState.get(harvest_job.source_id)
+    model.Session.merge(UnchangedHarvestJob(
+        harvest_job_id=harvest_job.id,
+        reference_job_id=state.validated_job_id))
+    delete_validation_summary(harvest_job.id)
+    model.Session.commit()
+    log.info('The remote file of harvest job {0} is unchanged since job '
+             '{1}, skipping it'.format(harvest_job.id,
+                                       state.validated_job_id))
+
+
+def _validated_state(harvest_source_id):
+    '''
+    Return the stored state of a harvest source, if the job that validated
+    its file didn't fail to import any dataset and it wasn't paginated.
+    '''
+    from ckanext.harvest.model import HarvestObject
+
+    state = HarvestSourceState.get(harvest_source_id)
+    if not state or not state.validated_job_id:
+        return None
+    if state.paginated:
+        log.debug('Harvest source {0} is paginated, not skipping its '
+                  'file'.format(harvest_source_id))
+        return None
+    failed = model.Session.query(HarvestObject.id) \
+        .filter(HarvestObject.harvest_job_id == state.validated_job_id) \
+        .filter(HarvestObject.state == u'ERROR') \
+        .first()
+    if failed:
+        log.info('Some datasets of harvest job {0} failed to import, not '
+                 'skipping its file'.format(state.validated_job_id))
+        return None
+    return state
+
+
+def _hash(content):
+    if isinstance(content, unicode):
+        content = content.encode('utf8')
+    return hashlib.sha256(content).hexdigest()
@@ -0,0 +1,127 @@
+'''
+Gazetteer of Swedish places, used to fill in the name and geometry of the
+`dct:spatial` locations of harvested datasets, and to emit canonical URIs for
+them when serializing.
+
+The places are read from a tab separated file (the bundled `gazetteer.tsv`,
+or the one set in `ckanext.sweden.dcat.gazetteer`), which is memory-mapped
+the first time a place is looked up. Only the offset of each line is kept in
+memory, indexed by URI, code and name (and other names), and lines are
+parsed when looked up.
+'''
+import os
+import re
+import mmap
+import threading
+import collections
+
+from pylons import config
+
+DEFAULT_PATH = os.path.join(os.path.dirname(__file__), 'gazetteer.tsv')
+
+# The different URIs GeoNames places are referred to with
+GEONAMES_URI = re.compile(
+    r'^https?://(?:sws\.|www\.)?geonames\.org/(\d+)(?:/.*)?$')
+
+
+class Place(collections.namedtuple('Place',
+                                   ['uri', 'code', 'name', 'bbox'])):
+    '''
+    A place of the gazetteer, with its bounding box (W, S, E, N). Places
+    without URI have an empty `uri`.
+    '''
+
+    @property
+    def geometry(self):
+        '''The bounding box as a GeoJSON polygon.'''
+        west, south, east, north = self.bbox
+        return {
+            'type': 'Polygon',
+            'coordinates': [[[west, south], [east, south], [east, north],
+                             [west, north], [west, south]]],
+        }
+
+
+def normalize_uri(uri):
+    uri = uri.strip()
+    match = GEONAMES_URI.match(uri)
+    if match:
+        return 'http://sws.geonames.org/{0}'.format(match.group(1))
+    return uri.rstrip('/')
+
+
+class Gazetteer(object):
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._by_uri = {}
+        self._by_code = {}
+        self._by_name = {}
+        self._places = 0
+        offset = 0
+        line = self._map.readline()
+        while line:
+            if line.strip() and not line.startswith('#'):
+                fields = line.rstrip('\r\n').split('\t')
+                uri, code, name = fields[:3]
+                if uri:
+                    self._by_uri[normalize_uri(uri)] = offset
+                if code:
+                    self._by_code[code] = offset
+                names = [name] + (fields[7].split('|') if len(fields) > 7
+                                  else [])
+                for name in names:
+                    self._by_name.setdefault(name.decode('utf8').lower(),
+                                             offset)
+                self._places += 1
+            offset = self._map.tell()
+            line = self._map.readline()
+
+    def __len__(self):
+        return self._places
+
+    def get(self, uri):
+        '''Return the place with the given URI, or None.'''
+        offset = self._by_uri.get(normalize_uri(uri))
+        return self._place(offset) if offset is not None else None
+
+    def get_by_code(self, code):
+        '''
+        Return the place with the given SCB county or municipality code, or
+        None.
+        '''
+        offset = self._by_code.get(code.strip())
+        return self._place(offset) if offset is not None else None
+
+    def find(self, name):
+        '''Return the place with the given name (ignoring case), or None.'''
+        if isinstance(name, str):
+            name = name.decode('utf8')
+        offset = self._by_name.get(name.strip().lower())
+        return self._place(offset) if offset is not None else None
+
+    def _place(self, offset):
+        end = self._map.find('\n', offset)
+        if end == -1:
+            end = len(self._map)
+        fields = self._map[offset:end].rstrip('\r').split('\t')
+        return Place(fields[0].decode('utf8'), fields[1].decode('utf8'),
+                     fields[2].decode('utf8'),
+                     tuple(float(value) for value in fields[3:7]))
+
+
+_gazetteer = None
+_lock = threading.Lock()
+
+
+def get_gazetteer():
+    '''Return the gazetteer of this process, loading it the first time.'''
+    global _gazetteer
+    if _gazetteer is None:
+        with _lock:
+            if _gazetteer is None:
+                _gazetteer = Gazetteer(config.get(
+                    'ckanext.sweden.dcat.gazetteer') or DEFAULT_PATH)
+    return _gazetteer
@@ -0,0 +1,216 @@
+'''
+A local validation engine for DCAT-AP-SE documents.
+
+It checks the mandatory classes of the profile and the cardinality of the
+properties of catalogs, datasets, distributions, agents and contact points,
+and returns a report with the same structure as the remote validation
+service:
+
+    {
+        'rdfError': None,
+        'mandatoryError': ['dcat:Catalog'],
+        'errors': 1,
+        'warnings': 2,
+        'resources': [{
+            'type': 'dcat:Dataset',
+            'template': 'dcat-ap-se:Dataset',
+            'uri': 'http://example.com/dataset/1',
+            'errors': [{'path': 'dcterms:title', 'code': 'few'}],
+            'warnings': [{'path': 'dcat:keyword', 'code': 'few'}],
+        }],
+    }
+
+The document is parsed once, and each resource is checked with a single
+lookup of its properties, so there are no network requests involved and
+large catalogs are validated quickly.
+'''
+import logging
+from collections import defaultdict
+
+import rdflib
+from rdflib.namespace import Namespace, RDF
+
+log = logging.getLogger(__name__)
+
+DCAT = Namespace('http://www.w3.org/ns/dcat#')
+DCT = Namespace('http://purl.org/dc/terms/')
+FOAF = Namespace('http://xmlns.com/foaf/0.1/')
+VCARD = Namespace('http://www.w3.org/2006/vcard/ns#')
+
+PREFIXES = (
+    ('dcat', DCAT),
+    ('dcterms', DCT),
+    ('foaf', FOAF),
+    ('vcard', VCARD),
+)
+
+ERROR = 'errors'
+WARNING = 'warnings'
+
+# How RDF/XML documents start
+XML_START = ('<?xml', '<!--', '<rdf:RDF')
+
+# The classes that must be present in every document
+MANDATORY_CLASSES = (DCAT.Catalog, DCAT.Dataset)
+
+# For each kind of resource, its type, how to find the resources of that
+# kind (their rdf:type, and the properties that point to them) and the rules
+# for its properties: (property, min, max, severity). Documents often leave
+# out the type of agents, distributions and contact points, so they are
+# also found through the properties that point to them.
+TEMPLATES = (
+    {
+        'name': 'dcat-ap-se:Catalog',
+        'type': DCAT.Catalog,
+        'linked_by': (),
+        'rules': (
+            (DCT.title, 1, None, ERROR),
+            (DCT.description, 1, None, ERROR),
+            (DCT.publisher, 1, 1, ERROR),
+            (DCAT.dataset, 1, None, ERROR),
+            (DCT.issued, 0, 1, ERROR),
+            (DCT.modified, 0, 1, ERROR),
+            (DCT.license, 0, 1, ERROR),
+            (FOAF.homepage, 0, 1, ERROR),
+            (DCT.language, 1, None, WARNING),
+            (DCT.license, 1, None, WARNING),
+            (FOAF.homepage, 1, None, WARNING),
+            (DCAT.themeTaxonomy, 1, None, WARNING),
+        ),
+    },
+    {
+        'name': 'dcat-ap-se:Dataset',
+        'type': DCAT.Dataset,
+        'linked_by': (DCAT.dataset,),
+        'rules': (
+            (DCT.title, 1, None, ERROR),
+            (DCT.description, 1, None, ERROR),
+            (DCT.publisher, 1, 1, ERROR),
+            (DCAT.contactPoint, 1, None, ERROR),
+            (DCT.issued, 0, 1, ERROR),
+            (DCT.modified, 0, 1, ERROR),
+            (DCT.accrualPeriodicity, 0, 1, ERROR),
+            (DCAT.distribution, 1, None, WARNING),
+            (DCAT.keyword, 1, None, WARNING),
+            (DCAT.theme, 1, None, WARNING),
+        ),
+    },
+    {
+        'name': 'dcat-ap-se:Distribution',
+        'type': DCAT.Distribution,
+        'linked_by': (DCAT.distribution,),
+        'rules': (
+            (DCAT.accessURL, 1, None, ERROR),
+            (DCT.license, 0, 1, ERROR),
+            (DCT.format, 0, 1, ERROR),
+            (DCT.description, 1, None, WARNING),
+            (DCT.format, 1, None, WARNING),
+            (DCT.license, 1, None, WARNING),
+        ),
+    },
+    {
+        'name': 'dcat-ap-se:Agent',
+        'type': FOAF.Agent,
+        'linked_by': (DCT.publisher,),
+        'rules': (
+            (FOAF.name, 1, None, ERROR),
+            (DCT.type, 1, None, WARNING),
+        ),
+    },
+    {
+        'name': 'dcat-ap-se:ContactPoint',
+        'type': VCARD.Kind,
+        'linked_by': (DCAT.contactPoint,),
+        'rules': (
+            (VCARD.fn, 1, None, ERROR),
+            (VCARD.hasEmail, 1, None, ERROR),
+        ),
+    },
+)
+
+
+def validate(content):
+    '''
+    Validate a DCAT document (RDF/XML, Turtle or N-Triples) and return the
+    report.
+    '''
+    report = {
+        'rdfError': None,
+        'mandatoryError': [],
+        'errors': 0,
+        'warnings': 0,
+        'resources': [],
+    }
+
+    try:
+        g = parse(content)
+    except Exception, e:
+        report['rdfError'] = 'Error parsing the RDF document: {0}'.format(e)
+        return report
+
+    for _class in MANDATORY_CLASSES:
+        if (None, RDF.type, _class) not in g:
+            report['mandatoryError'].append(_qname(_class))
+            report['errors'] += 1
+
+    for template in TEMPLATES:
+        for ref in _resources(g, template):
+            resource = _validate_resource(g, ref, template)
+            if resource['errors'] or resource['warnings']:
+                report['errors'] += len(resource['errors'])
+                report['warnings'] += len(resource['warnings'])
+                report['resources'].append(resource)
+
+    return report
+
+
+def parse(content):
+    '''
+    Parse a document, guessing its format: documents starting with an XML
+    declaration, a comment or an `rdf:RDF` element are parsed as RDF/XML,
+    and the rest as Turtle (N-Triples is a subset of it, and both can start
+    with a `<` too).
+    '''
+    g = rdflib.Graph()
+    _format = 'xml' if content.lstrip().startswith(XML_START) else 'turtle'
+    g.parse(data=content, format=_format)
+    return g
+
+
+def _resources(g, template):
+    refs = set(g.subjects(RDF.type, template['type']))
+    for _property in template['linked_by']:
+        refs.update(ref for ref in g.objects(None, _property)
+                    if not isinstance(ref, rdflib.Literal))
+    return sorted(refs)
+
+
+def _validate_resource(g, ref, template):
+    counts = defaultdict(int)
+    for _property in g.predicates(ref, None):
+        counts[_property] += 1
+
+    resource = {
+        'type': _qname(template['type']),
+        'template': template['name'],
+        'uri': unicode(ref),
+        ERROR: [],
+        WARNING: [],
+    }
+    for _property, _min, _max, severity in template['rules']:
+        count = counts[_property]
+        if count < _min:
+            code = 'few'
+        elif _max is not None and count > _max:
+            code = 'many'
+        else:
+            continue
+        resource[severity].append({'path': _qname(_property), 'code': code})
+    return resource
+
+
+def _qname(uri):
+    for prefix, namespace in PREFIXES:
+        if uri.startswith(namespace):
+            return '{0}:{1}'.format(prefix, uri[len(namespace):])
+    return unicode(uri)
@@ -0,0 +1,80 @@
+from datetime import datetime
+from sqlalchemy import Column
+from sqlalchemy import types
+from sqlalchemy.ext.declarative import declarative_base
+
+import ckan.model as model
+
+log = __import__('logging').getLogger(__name__)
+
+Base = declarative_base()
+
+
+class HarvestSchedule(Base):
+    """
+    The slot of the week a weekly harvest source is run in, and the average
+    duration of its gather stage it was assigned from.
+    """
+    __tablename__ = 'sweden_harvest_schedule'
+
+    harvest_source_id = Column(types.UnicodeText, primary_key=True)
+    # Hour of the week, starting on Monday at 00:00 UTC
+    slot = Column(types.Integer, nullable=False)
+    gather_seconds = Column(types.Float)
+    # Number of jobs the average duration was worked out from
+    jobs = Column(types.Integer, nullable=False, default=0)
+    updated = Column(types.DateTime, default=datetime.utcnow,
+                     onupdate=datetime.utcnow)
+
+    @classmethod
+    def get(cls, harvest_source_id):
+        return model.Session.query(cls).get(harvest_source_id)
+
+    def __repr__(self):
+        return u"<HarvestSchedule: %s, slot:%s>" % (self.harvest_source_id,
+                                                     self.slot)
+
+
+class HarvestSourceState(Base):
+    """
+    What was last downloaded from a harvest source: the caching headers sent
+    by the server, the hash of the content, whether it had more pages and
+    the job it was validated in.
+    """
+    __tablename__ = 'sweden_harvest_source_state'
+
+    harvest_source_id = Column(types.UnicodeText, primary_key=True)
+    etag = Column(types.UnicodeText)
+    last_modified = Column(types.UnicodeText)
+    content_hash = Column(types.UnicodeText)
+    paginated = Column(types.Boolean, nullable=False, default=False)
+    validated_job_id = Column(types.UnicodeText)
+    updated = Column(types.DateTime, default=datetime.utcnow,
+                     onupdate=datetime.utcnow)
+
+    @classmethod
+    def get(cls, harvest_source_id):
+        return model.Session.query(cls).get(harvest_source_id)
+
+    def __repr__(self):
+        return u"<HarvestSourceState: %s>" % self.harvest_source_id
+
+
+class UnchangedHarvestJob(Base):
+    """
+    A harvest job that found the remote file unchanged, so it wasn't
+    validated nor imported again. Its validation is the one of
+    `reference_job_id`.
+    """
+    __tablename__ = 'sweden_harvest_unchanged_job'
+
+    harvest_job_id = Column(types.UnicodeText, primary_key=True)
+    reference_job_id = Column(types.UnicodeText, nullable=False)
+
+    def __repr__(self):
+        return u"<UnchangedHarvestJob: %s, reference:%s>" % (
+            self.harvest_job_id, self.reference_job_id)
+
+
+def init_tables(e):
+    Base.metadata.create_all(e)
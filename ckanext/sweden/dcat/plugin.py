@@ -1,14 +1,24 @@
-import json
-import requests
+import logging
+import threading
+
 import rdflib
 
 from pylons import config
 
+import ckan.model as model
 import ckan.plugins as p
 
+from ckanext.dcat.harvesters import DCATRDFHarvester
 from ckanext.dcat.interfaces import IDCATRDFHarvester
+from ckanext.sweden.dcat import conditional
+from ckanext.sweden.dcat import model as dcat_model
 from ckanext.sweden.dcat import template_helpers
+from ckanext.sweden.dcat import scheduler
+from ckanext.sweden.dcat import validation
+from ckanext.sweden.model.validation import update_validation_summary
+
 
+log = logging.getLogger(__name__)
 
 VALIDATION_SERVICE = 'https://validator.dcat-editor.com/service'
 
@@ -21,69 +31,122 @@ rdflib.plugin.register(
     'rdflib.plugins.parsers.rdfxml', 'RDFXMLParser')
 
 
-class SwedenDCATRDFHarvester(p.SingletonPlugin):
+# The documents of the current harvest job of each thread to validate in the
+# background once its gather stage has finished
+_local = threading.local()
+
+
+def skip_unchanged():
+    return p.toolkit.asbool(
+        config.get('ckanext.sweden.harvest.skip_unchanged', True))
+
+
+class SwedenDCATRDFHarvester(DCATRDFHarvester):
+    '''
+    The `dcat_rdf` harvester of ckanext-dcat, with the downloads limited per
+    host, the remote files validated and unchanged files skipped. It
+    replaces the `dcat_rdf_harvester` plugin.
+    '''
 
     p.implements(IDCATRDFHarvester, inherit=True)
+    p.implements(p.IConfigurable, inherit=True)
     p.implements(p.IConfigurer)
     p.implements(p.ITemplateHelpers)
 
-    def after_download(self, content, harvest_job):
+    # IConfigurable
 
-        if not p.toolkit.asbool(config.get('ckanext.sweden.harvest.use_validation', True)):
-            return content, []
+    def configure(self, config):
+        dcat_model.init_tables(model.meta.engine)
 
-        validation_service = config.get('ckanext.sweden.harvest.validation_service', VALIDATION_SERVICE)
-
-        stop_on_errors = p.toolkit.asbool(config.get('ckanext.sweden.harvest.stop_on_validation_errors', False))
+    # IHarvester
 
-        errors = []
+    def gather_stage(self, harvest_job):
+        conditional.reset()
+        validation.metrics.start_job()
+        _local.async_validations = []
         try:
-            r = requests.post(validation_service, data=content)
-        except requests.exceptions.RequestException, e:
-            errors.append(p.toolkit._(
-                'Error contacting the validation service: {0}'.format(str(e)))
-            )
+            object_ids = super(SwedenDCATRDFHarvester, self).gather_stage(
+                harvest_job)
+        finally:
+            # The gather stage stops without calling `after_download` if the
+            # download fails, so the host slot may still be held
+            scheduler.release_host_slot()
+
+        # The file is only skipped next time if it was validated and its
+        # datasets gathered
+        downloaded = conditional.pop_downloaded() if object_ids else None
+        if _local.async_validations:
+            for content, validation_service in _local.async_validations:
+                validation.validate_async(content, validation_service,
+                                          harvest_job.id, downloaded)
+                # It belongs to the first document, the main file
+                downloaded = None
+            _local.async_validations = []
+        else:
+            # All the validation errors have been added to the job
+            update_validation_summary(harvest_job.id)
+            validation.save_metrics(harvest_job.id)
+            model.Session.commit()
+            if downloaded:
+                conditional.record_validated(harvest_job.id, downloaded)
 
-            if stop_on_errors:
-                return None, errors
-            else:
-                return content, errors
+        return object_ids
 
-        if r.status_code != 200:
+    # IDCATRDFHarvester
 
-            errors.append(p.toolkit._(
-                'The validation service returned an error: {0}'.format(
-                    r.status_code)))
+    def before_download(self, url, harvest_job):
 
-            if stop_on_errors:
-                return None, errors
-            else:
-                return content, errors
+        # Limit the concurrent downloads from the same host
+        scheduler.acquire_host_slot(url)
 
-        else:
-            response = r.json()
+        if skip_unchanged() and conditional.not_modified(url, harvest_job):
+            scheduler.release_host_slot()
+            conditional.mark_unchanged(harvest_job)
+            return None, []
 
-            if not any([response.get('rdfError'),
-                        response.get('errors'),
-                        response.get('warnings')]):
-                # All clear
-                return content, []
+        return url, []
 
-            if response.get('rdfError'):
-                errors.append(response.get('rdfError'))
-            else:
-                if response.get('mandatoryError'):
-                    for _class in response['mandatoryError']:
-                        errors.append(p.toolkit._(
-                            'Mandatory class {0} missing'.format(_class)))
+    def after_download(self, content, harvest_job):
 
-                for resource in response.get('resources', []):
-                    errors.append(json.dumps(resource))
+        scheduler.release_host_slot()
 
+        if not content:
+            return content, []
+
+        if skip_unchanged():
+            if conditional.content_unchanged(content, harvest_job):
+                conditional.mark_unchanged(harvest_job)
+                return None, []
+
+        # Files that aren't validated are always downloaded again
+        if not p.toolkit.asbool(config.get('ckanext.sweden.harvest.use_validation', True)):
+            return content, []
+
+        validation_service = config.get('ckanext.sweden.harvest.validation_service', VALIDATION_SERVICE)
+
+        stop_on_errors = p.toolkit.asbool(config.get('ckanext.sweden.harvest.stop_on_validation_errors', False))
+
+        if p.toolkit.asbool(config.get('ckanext.sweden.harvest.async_validation', False)):
             if stop_on_errors:
-                return None, errors
+                log.warning('Asynchronous validation is not used when '
+                            'stop_on_validation_errors is set')
             else:
-                return content, errors
+                # Carry on gathering, the document is queued at the end of
+                # the gather stage and the validation errors will be added
+                # to the job when the validation finishes
+                conditional.downloaded(content, harvest_job)
+                _local.async_validations.append(
+                    (content, validation_service))
+                return content, []
+
+        errors, validated = validation.validate_document(content,
+                                                         validation_service)
+
+        if errors and stop_on_errors:
+            return None, errors
+        if validated:
+            conditional.downloaded(content, harvest_job)
+        return content, errors
 
     # IConfigurer
     def update_config(self, config):
@@ -1,12 +1,63 @@
+import json
+import weakref
+
 from rdflib.namespace import Namespace, RDF, RDFS
 from rdflib import URIRef, BNode, Literal
 
 from ckanext.dcat.profiles import RDFProfile
+from ckanext.sweden.dcat.gazetteer import get_gazetteer
 
 
 DCT = Namespace("http://purl.org/dc/terms/")
 
 
+class SpatialIndex(object):
+    '''
+    The `dct:spatial` object of each dataset of a graph, indexed with a
+    single pass over the graph, and the labels of the ones looked up so
+    far.
+
+    Catalogs usually have thousands of datasets sharing a handful of
+    locations (municipalities, counties), so each label is only looked up
+    once. Datasets added to the graph after the index was built are looked
+    up in the graph.
+    '''
+
+    def __init__(self, g):
+        self.spatial_by_dataset = {}
+        for dataset_ref, spatial in g.subject_objects(DCT.spatial):
+            self.spatial_by_dataset.setdefault(dataset_ref, spatial)
+        self.labels = {}
+
+    def spatial(self, g, dataset_ref):
+        spatial = self.spatial_by_dataset.get(dataset_ref)
+        if spatial is None:
+            spatial = g.value(dataset_ref, DCT.spatial)
+        return spatial
+
+    def label(self, g, spatial):
+        if spatial not in self.labels:
+            self.labels[spatial] = g.label(spatial)
+        return self.labels[spatial]
+
+
+# The parser creates a new profile for every dataset, so the indexes are
+# kept per graph, for as long as the graph is around
+_spatial_indexes = weakref.WeakKeyDictionary()
+
+
+def get_spatial_index(g):
+    index = _spatial_indexes.get(g)
+    if index is None:
+        index = _spatial_indexes[g] = SpatialIndex(g)
+    return index
+
+
+# The locations with a URI already described in each graph being serialized,
+# as datasets of a catalog usually share a few of them
+_emitted_locations = weakref.WeakKeyDictionary()
+
+
 class SwedishDCATAPProfile(RDFProfile):
     '''
     An RDF profile for the Swedish DCAT-AP recommendation for data portals
@@ -17,15 +68,35 @@ class SwedishDCATAPProfile(RDFProfile):
     def parse_dataset(self, dataset_dict, dataset_ref):
 
         # Spatial label
-        spatial = self._object(dataset_ref, DCT.spatial)
+        index = get_spatial_index(self.g)
+        spatial = index.spatial(self.g, dataset_ref)
         if spatial:
-            spatial_label = self.g.label(spatial)
+            # Known places get their name, if the graph has none, and their
+            # bounding box. Places referred to without URI are looked up by
+            # their label
+            place = None
+            if isinstance(spatial, URIRef):
+                place = get_gazetteer().get(spatial)
+            label = index.label(self.g, spatial)
+            if not place and label:
+                place = get_gazetteer().find(unicode(label))
+
+            spatial_label = label or (place and place.name)
             if spatial_label:
-                dataset_dict['extras'].append({'key': 'spatial_text',
-                                               'value': str(spatial_label)})
+                self._add_extra(dataset_dict, 'spatial_text',
+                                unicode(spatial_label))
+            if place:
+                self._add_extra(dataset_dict, 'spatial',
+                                json.dumps(place.geometry))
 
         return dataset_dict
 
+    def _add_extra(self, dataset_dict, key, value):
+        '''Add an extra to the dataset, unless another profile did.'''
+        extras = dataset_dict.setdefault('extras', [])
+        if not any(extra['key'] == key for extra in extras):
+            extras.append({'key': key, 'value': value})
+
     def graph_from_dataset(self, dataset_dict, dataset_ref):
 
         g = self.g
@@ -35,13 +106,33 @@ class SwedishDCATAPProfile(RDFProfile):
 
         spatial_geom = self._get_dataset_value(dataset_dict, 'spatial')
 
+        # Use the canonical URI of known places
+        if spatial_uri:
+            place = get_gazetteer().get(spatial_uri)
+        elif spatial_text:
+            place = get_gazetteer().find(spatial_text)
+        else:
+            place = None
+        if place:
+            spatial_uri = place.uri or spatial_uri
+            spatial_text = spatial_text or place.name
+
+        if not spatial_uri and not spatial_text:
+            return
+
         if spatial_uri:
             spatial_ref = URIRef(spatial_uri)
+            g.add((dataset_ref, DCT.spatial, spatial_ref))
+
+            emitted = _emitted_locations.setdefault(g, set())
+            if spatial_ref in emitted:
+                return
+            emitted.add(spatial_ref)
         else:
             spatial_ref = BNode()
+            g.add((dataset_ref, DCT.spatial, spatial_ref))
 
         g.add((spatial_ref, RDF.type, DCT.Location))
-        g.add((dataset_ref, DCT.spatial, spatial_ref))
 
         if spatial_text:
             g.add((spatial_ref, RDFS.label, Literal(spatial_text)))
@@ -0,0 +1,223 @@
+'''
+Scheduling of the weekly DCAT harvest sources.
+
+Weekly sources are spread across the hours of the week so that the gather
+stages don't all run at once. Each source is given an hour of the week (a
+slot), balancing the total gather time of each slot, based on how long the
+last gather stages of each source took. The slot is applied by setting the
+`next_run` of the source, which ckanext-harvest moves a week forward every
+time it runs the source, so it keeps running in its slot.
+
+Downloads of the remote files are also limited per host across all gather
+processes (see `acquire_host_slot`), so running several gather consumers
+doesn't overload the servers that publish many catalogs.
+'''
+import time
+import zlib
+import heapq
+import logging
+import datetime
+import threading
+import urlparse
+
+from pylons import config
+from sqlalchemy import func, select
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.sweden.dcat.model import HarvestSchedule
+
+log = logging.getLogger(__name__)
+
+DEFAULT_GATHER_SECONDS = 60
+DEFAULT_JOBS_PER_SOURCE = 5
+DEFAULT_DOWNLOADS_PER_HOST = 2
+DEFAULT_HOST_WAIT = 300
+
+
+def allowed_slots():
+    '''
+    Return the slots (hours of the week, starting on Monday at 00:00 UTC)
+    sources can be scheduled in, from the
+    `ckanext.sweden.harvest.schedule_days` (0 is Monday) and
+    `ckanext.sweden.harvest.schedule_hours` options.
+    '''
+    days = [int(day) for day in toolkit.aslist(
+        config.get('ckanext.sweden.harvest.schedule_days', range(7)))]
+    hours = [int(hour) for hour in toolkit.aslist(
+        config.get('ckanext.sweden.harvest.schedule_hours', range(24)))]
+    return sorted(day * 24 + hour for day in days for hour in hours)
+
+
+def gather_durations(source_ids, jobs_per_source=DEFAULT_JOBS_PER_SOURCE,
+                     weeks=10):
+    '''
+    Return a dict with the average duration in seconds of the gather stage
+    of the last `jobs_per_source` finished jobs (of the last `weeks` weeks)
+    of each of the given sources, and the number of jobs it was worked out
+    from, keyed by the source id.
+    '''
+    from ckanext.harvest.model import HarvestJob
+
+    if not source_ids:
+        return {}
+
+    since = datetime.datetime.utcnow() - datetime.timedelta(weeks=weeks)
+    q = model.Session.query(HarvestJob.source_id,
+                            HarvestJob.gather_started,
+                            HarvestJob.gather_finished) \
+        .filter(HarvestJob.source_id.in_(source_ids)) \
+        .filter(HarvestJob.created >= since) \
+        .filter(HarvestJob.gather_started != None) \
+        .filter(HarvestJob.gather_finished != None) \
+        .order_by(HarvestJob.created.desc())
+
+    durations = {}
+    for source_id, started, finished in q:
+        source_durations = durations.setdefault(source_id, [])
+        if len(source_durations) < jobs_per_source:
+            source_durations.append(
+                max((finished - started).total_seconds(), 0))
+
+    return dict((source_id, (sum(values) / len(values), len(values)))
+                for source_id, values in durations.iteritems())
+
+
+def assign_slots(durations, slots):
+    '''
+    Assign each source to a slot, balancing the total duration of the
+    sources of each slot.
+
+    `durations` is a dict with the expected duration of each source. The
+    longest sources are placed first, each of them in the slot with the
+    lowest total so far. Slots with the same total are filled in order of
+    hour of the day and then day, so a handful of sources end up spread
+    across different days rather than on consecutive hours.
+    '''
+    if not slots:
+        raise ValueError('No slots to schedule the harvest sources in')
+    heap = [(0, (slot % 24, slot // 24), slot) for slot in slots]
+    heapq.heapify(heap)
+
+    assignment = {}
+    for source_id, duration in sorted(durations.iteritems(),
+                                      key=lambda item: (-item[1], item[0])):
+        load, order, slot = heapq.heappop(heap)
+        assignment[source_id] = slot
+        heapq.heappush(heap, (load + duration, order, slot))
+    return assignment
+
+
+def next_slot_time(slot, now=None):
+    '''Return the next time (in UTC) the given slot of the week starts.'''
+    now = now or datetime.datetime.utcnow()
+    week_start = datetime.datetime(now.year, now.month, now.day) - \
+        datetime.timedelta(days=now.weekday())
+    slot_time = week_start + datetime.timedelta(hours=slot)
+    if slot_time <= now:
+        slot_time += datetime.timedelta(weeks=1)
+    return slot_time
+
+
+def rebalance(dry_run=False):
+    '''
+    Work out the slot of each active weekly harvest source from the
+    duration of its last gather stages, and update their `next_run`.
+
+    Sources without finished jobs are assumed to take as long as the median
+    of the rest. Returns the list of `HarvestSchedule` objects.
+    '''
+    from ckanext.harvest.model import HarvestSource
+
+    sources = model.Session.query(HarvestSource) \
+        .filter(HarvestSource.active == True) \
+        .filter(HarvestSource.frequency == 'WEEKLY') \
+        .all()
+    if not sources:
+        return []
+
+    measured = gather_durations([source.id for source in sources])
+    known = sorted(duration for duration, jobs in measured.values())
+    default = known[len(known) // 2] if known else DEFAULT_GATHER_SECONDS
+
+    durations = dict((source.id, measured.get(source.id, (default, 0))[0])
+                     for source in sources)
+    assignment = assign_slots(durations, allowed_slots())
+
+    schedules = []
+    now = datetime.datetime.utcnow()
+    for source in sources:
+        schedule = HarvestSchedule(
+            harvest_source_id=source.id,
+            slot=assignment[source.id],
+            gather_seconds=durations[source.id],
+            jobs=measured.get(source.id, (None, 0))[1])
+        schedules.append(schedule)
+        if not dry_run:
+            model.Session.merge(schedule)
+            source.next_run = next_slot_time(schedule.slot, now)
+
+    if not dry_run:
+        model.Session.commit()
+        log.info('Scheduled {0} weekly harvest sources'.format(len(sources)))
+    return schedules
+
+
+_local = threading.local()
+
+
+def acquire_host_slot(url):
+    '''
+    Wait until fewer than `ckanext.sweden.harvest.max_downloads_per_host`
+    files are being downloaded from the host of `url` (by any process), and
+    take one of its slots until `release_host_slot` is called.
+
+    The slots are PostgreSQL advisory locks, held on a connection of their
+    own. If no slot is free after `ckanext.sweden.harvest.host_wait`
+    seconds, the download goes ahead anyway. Returns True if a slot was
+    taken.
+    '''
+    release_host_slot()
+
+    limit = toolkit.asint(config.get(
+        'ckanext.sweden.harvest.max_downloads_per_host',
+        DEFAULT_DOWNLOADS_PER_HOST))
+    if not limit or model.meta.engine.dialect.name != 'postgresql':
+        return False
+    wait = toolkit.asint(config.get('ckanext.sweden.harvest.host_wait',
+                                    DEFAULT_HOST_WAIT))
+
+    host = urlparse.urlparse(url).netloc.lower()
+    key = zlib.crc32(host.encode('utf8'))
+    connection = model.meta.engine.connect()
+    deadline = time.time() + wait
+    while True:
+        for i in range(limit):
+            locked = connection.execute(
+                select([func.pg_try_advisory_lock(key, i)])).scalar()
+            if locked:
+                _local.held = (connection, key, i)
+                return True
+        if time.time() >= deadline:
+            connection.close()
+            log.warning('Waited {0} seconds for a free download slot for '
+                        '{1}, downloading anyway'.format(wait, host))
+            return False
+        time.sleep(1)
+
+
+def release_host_slot():
+    '''Free the host slot taken by this thread, if any.'''
+    held = getattr(_local, 'held', None)
+    if not held:
+        return
+    _local.held = None
+    connection, key, i = held
+    try:
+        connection.execute(select([func.pg_advisory_unlock(key, i)]))
+        connection.close()
+    except Exception:
+        # Don't return a connection that may still hold the lock to the pool
+        connection.invalidate()
+        log.exception('Error releasing the download slot')
@@ -0,0 +1,72 @@
+'''
+Benchmark of the parsing of a large DCAT catalog with the Swedish profile.
+
+Generates a catalog of datasets sharing a few `dct:spatial` locations, like
+the ones published by municipalities and counties, and reports how many
+datasets per second are parsed. It isn't run by the tests, run it with:
+
+    python -m ckanext.sweden.dcat.tests.benchmark_parse -n 50000
+
+'''
+import time
+import argparse
+
+from ckanext.dcat.parsers import RDFParser
+
+LOCATIONS = [
+    ('http://sws.geonames.org/2673730', 'Stockholm'),
+    ('http://sws.geonames.org/2711537', 'Goteborg'),
+    ('http://sws.geonames.org/2692969', 'Malmo'),
+    ('http://sws.geonames.org/2666199', 'Uppsala'),
+    ('http://sws.geonames.org/2664454', 'Vasteras'),
+]
+
+PREFIXES = '''
+@prefix dcat: <http://www.w3.org/ns/dcat#> .
+@prefix dcterms: <http://purl.org/dc/terms/> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+'''
+
+
+def catalog(datasets):
+    '''Return a Turtle catalog with the given number of datasets.'''
+    lines = [PREFIXES, '<http://example.com/catalog> a dcat:Catalog ;',
+             '    dcterms:title "Benchmark catalog" .']
+    for uri, label in LOCATIONS:
+        lines.append('<{0}> a dcterms:Location ; rdfs:label "{1}" .'.format(
+            uri, label))
+    for i in xrange(datasets):
+        uri = 'http://example.com/dataset/{0}'.format(i)
+        lines.append('<http://example.com/catalog> dcat:dataset <{0}> .'
+                     .format(uri))
+        lines.append('<{0}> a dcat:Dataset ; dcterms:title "Dataset {1}" ; '
+                     'dcterms:description "Dataset number {1}" ; '
+                     'dcterms:spatial <{2}> .'.format(
+                         uri, i, LOCATIONS[i % len(LOCATIONS)][0]))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-n', '--datasets', type=int, default=50000,
+                        help='Number of datasets in the catalog')
+    parser.add_argument('--profiles', default='euro_dcat_ap sweden_dcat_ap',
+                        help='Profiles to parse the catalog with')
+    args = parser.parse_args()
+
+    content = catalog(args.datasets)
+
+    p = RDFParser(profiles=args.profiles.split())
+    start = time.time()
+    p.parse(content, _format='turtle')
+    parsed = time.time()
+    count = sum(1 for dataset in p.datasets())
+    finished = time.time()
+
+    print 'Parsed the RDF in {0:.1f}s'.format(parsed - start)
+    print 'Read {0} datasets in {1:.1f}s ({2:.0f} datasets/s)'.format(
+        count, finished - parsed, count / max(finished - parsed, 1e-6))
+
+
+if __name__ == '__main__':
+    main()
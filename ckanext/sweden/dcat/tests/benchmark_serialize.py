@@ -0,0 +1,99 @@
+'''
+Benchmark of the serialization of a large organization catalog.
+
+Serializes the datasets of a synthetic organization, most of them without
+spatial data and the rest sharing a few locations, with the current
+`SwedishDCATAPProfile.graph_from_dataset` and with the previous one, which
+added a location node to every dataset. Reports the size of the graphs and
+the serialization times. It isn't run by the tests, run it with:
+
+    python -m ckanext.sweden.dcat.tests.benchmark_serialize -n 20000
+
+'''
+import time
+import argparse
+
+from rdflib import URIRef, BNode, Literal
+from rdflib.namespace import RDF, RDFS
+
+from ckanext.dcat.processors import RDFSerializer
+from ckanext.sweden.dcat.profiles import DCT, SwedishDCATAPProfile
+
+LOCATIONS = [
+    ('http://sws.geonames.org/2673730', 'Stockholm'),
+    ('http://sws.geonames.org/2711537', 'Goteborg'),
+    ('http://sws.geonames.org/2692969', 'Malmo'),
+]
+
+
+def dataset_dicts(datasets):
+    for i in xrange(datasets):
+        extras = []
+        # A quarter of the datasets have a location
+        if i % 4 == 0:
+            uri, label = LOCATIONS[i % len(LOCATIONS)]
+            extras = [{'key': 'spatial_uri', 'value': uri},
+                      {'key': 'spatial_text', 'value': label}]
+        yield {
+            'id': 'dataset-{0}'.format(i),
+            'name': 'dataset-{0}'.format(i),
+            'title': 'Dataset {0}'.format(i),
+            'notes': 'Dataset number {0}'.format(i),
+            'extras': extras,
+            'tags': [],
+            'resources': [],
+        }
+
+
+def previous_graph_from_dataset(self, dataset_dict, dataset_ref):
+
+    g = self.g
+
+    spatial_uri = self._get_dataset_value(dataset_dict, 'spatial_uri')
+    spatial_text = self._get_dataset_value(dataset_dict, 'spatial_text')
+
+    if spatial_uri:
+        spatial_ref = URIRef(spatial_uri)
+    else:
+        spatial_ref = BNode()
+
+    g.add((spatial_ref, RDF.type, DCT.Location))
+    g.add((dataset_ref, DCT.spatial, spatial_ref))
+
+    if spatial_text:
+        g.add((spatial_ref, RDFS.label, Literal(spatial_text)))
+
+
+def run(datasets, profiles, fmt):
+    serializer = RDFSerializer(profiles=profiles)
+    start = time.time()
+    serializer.serialize_catalog({}, dataset_dicts=dataset_dicts(datasets),
+                                 _format=fmt)
+    return len(serializer.g), time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-n', '--datasets', type=int, default=20000,
+                        help='Number of datasets of the organization')
+    parser.add_argument('--profiles', default='euro_dcat_ap sweden_dcat_ap',
+                        help='Profiles to serialize the catalog with')
+    parser.add_argument('--format', default='turtle',
+                        help='RDF format to serialize the catalog to')
+    args = parser.parse_args()
+    profiles = args.profiles.split()
+
+    current = SwedishDCATAPProfile.graph_from_dataset
+    for label, method in (('previous', previous_graph_from_dataset),
+                          ('current', current)):
+        SwedishDCATAPProfile.graph_from_dataset = method
+        try:
+            triples, seconds = run(args.datasets, profiles, args.format)
+        finally:
+            SwedishDCATAPProfile.graph_from_dataset = current
+        print '{0:>8}: {1} triples, serialized in {2:.1f}s'.format(
+            label, triples, seconds)
+
+
+if __name__ == '__main__':
+    main()
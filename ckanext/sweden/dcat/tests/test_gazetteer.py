@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import nose
+
+from ckanext.sweden.dcat.gazetteer import get_gazetteer, normalize_uri
+
+eq_ = nose.tools.eq_
+
+
+class TestGazetteer(object):
+
+    def test_get_by_uri(self):
+        place = get_gazetteer().get('http://data.europa.eu/nuts/code/SE110')
+
+        eq_(place.name, u'Stockholms län')
+        eq_(place.code, u'01')
+        eq_(place.bbox, (17.22, 58.70, 19.30, 60.20))
+
+    def test_geonames_uris_are_normalized(self):
+        for uri in ('http://sws.geonames.org/2661886/',
+                    'https://www.geonames.org/2661886/sweden.html'):
+            eq_(normalize_uri(uri), 'http://sws.geonames.org/2661886')
+            eq_(get_gazetteer().get(uri).uri,
+                u'http://sws.geonames.org/2661886')
+
+    def test_find_by_name(self):
+        place = get_gazetteer().find(u'skåne län')
+
+        eq_(place.uri, u'http://data.europa.eu/nuts/code/SE224')
+        eq_(place.name, u'Skåne län')
+
+    def test_all_municipalities(self):
+        gazetteer = get_gazetteer()
+
+        eq_(len(gazetteer), 1 + 21 + 290)
+        eq_(len([code for code in gazetteer._by_code if len(code) == 4]),
+            290)
+
+    def test_municipality(self):
+        place = get_gazetteer().get_by_code('2480')
+
+        eq_(place.uri, u'http://www.scb.se/kommun/2480')
+        eq_(place.name, u'Umeå kommun')
+        eq_(place.geometry['type'], 'Polygon')
+        west, south, east, north = place.bbox
+        assert west < east and south < north
+        eq_(get_gazetteer().get(u'http://www.scb.se/kommun/2480'), place)
+        eq_(get_gazetteer().find(u'Umeå'), place)
+        eq_(get_gazetteer().find(u'umeå kommun'), place)
+
+    def test_unknown_places(self):
+        eq_(get_gazetteer().get('http://example.com/place'), None)
+        eq_(get_gazetteer().get_by_code('9999'), None)
+        eq_(get_gazetteer().find('Atlantis'), None)
+
+    def test_geometry(self):
+        geometry = get_gazetteer().find('Sverige').geometry
+
+        eq_(geometry['type'], 'Polygon')
+        eq_(geometry['coordinates'][0][0], geometry['coordinates'][0][-1])
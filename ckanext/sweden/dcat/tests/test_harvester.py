@@ -0,0 +1,279 @@
+import json
+import datetime
+import threading
+import BaseHTTPServer
+
+import nose
+from pylons import config
+
+import ckan.model as model
+
+try:
+    import ckan.tests.factories as factories
+    import ckan.tests.helpers as helpers
+except ImportError:
+    # CKAN 2.3
+    import ckan.new_tests.factories as factories
+    import ckan.new_tests.helpers as helpers
+
+from ckanext.sweden.cache import get_backend
+from ckanext.sweden.dcat import scheduler
+from ckanext.sweden.dcat.model import HarvestSourceState, UnchangedHarvestJob
+from ckanext.sweden.dcat.plugin import SwedenDCATRDFHarvester
+from ckanext.sweden.model.validation import ValidationSummary
+
+eq_ = nose.tools.eq_
+
+
+CATALOG = '''
+@prefix dcat: <http://www.w3.org/ns/dcat#> .
+@prefix dcterms: <http://purl.org/dc/terms/> .
+
+<http://example.com/catalog> a dcat:Catalog ;
+    dcterms:title "Catalog" ;
+    dcat:dataset <http://example.com/dataset/1> .
+
+<http://example.com/dataset/1> a dcat:Dataset ;
+    dcterms:title "Dataset 1" ;
+    dcterms:description "The first dataset" .
+'''
+
+PAGED_CATALOG = CATALOG + '''
+@prefix hydra: <http://www.w3.org/ns/hydra/core#> .
+
+<http://example.com/catalog?page=1> a hydra:PagedCollection ;
+    hydra:nextPage "{url}/page2.ttl" .
+'''
+
+SECOND_PAGE = '''
+@prefix dcat: <http://www.w3.org/ns/dcat#> .
+@prefix dcterms: <http://purl.org/dc/terms/> .
+
+<http://example.com/catalog> a dcat:Catalog ;
+    dcterms:title "Catalog" ;
+    dcat:dataset <http://example.com/dataset/2> .
+
+<http://example.com/dataset/2> a dcat:Dataset ;
+    dcterms:title "{title}" ;
+    dcterms:description "The second dataset" .
+'''
+
+
+class CatalogHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Serves the server `catalog` at /catalog.ttl, with the server `etag` (if
+    any), and replies with a 304 to requests with a matching If-None-Match.
+    The paths in the server `pages` are served with their content, and other
+    paths are not found. The method and If-None-Match header of each request
+    are kept in the server `requests`.
+    '''
+
+    def do_HEAD(self):
+        self._reply(body=False)
+
+    def do_GET(self):
+        self._reply(body=True)
+
+    def _reply(self, body):
+        if_none_match = self.headers.getheader('If-None-Match')
+        self.server.requests.append((self.command, if_none_match))
+        if self.path == '/catalog.ttl':
+            content = self.server.catalog
+            etag = self.server.etag
+        elif self.path in self.server.pages:
+            content = self.server.pages[self.path]
+            etag = None
+        else:
+            self.send_error(404)
+            return
+        if etag and if_none_match == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/turtle')
+        self.send_header('Content-Length', str(len(content)))
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHarvester(helpers.FunctionalTestBase):
+
+    options = {
+        'ckanext.sweden.harvest.use_validation': 'true',
+        'ckanext.sweden.harvest.validation_service': 'local',
+        'ckanext.sweden.harvest.async_validation': 'false',
+        'ckanext.sweden.harvest.validation_cache_ttl': '0',
+        'ckanext.sweden.harvest.skip_unchanged': 'true',
+    }
+
+    def setup(self):
+        super(TestHarvester, self).setup()
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                CatalogHandler)
+        self.server.catalog = CATALOG
+        self.server.etag = '"v1"'
+        self.server.requests = []
+        self.server.pages = {}
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{0}'.format(
+            self.server.server_address[1])
+
+        self.original_config = dict((key, config.get(key))
+                                    for key in self.options)
+        config.update(self.options)
+
+    def teardown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for key, value in self.original_config.iteritems():
+            if value is None:
+                config.pop(key, None)
+            else:
+                config[key] = value
+
+    def _create_source(self, path='/catalog.ttl'):
+        org = factories.Organization()
+        return factories.Dataset(owner_org=org['id'],
+                                 type='harvest',
+                                 source_type='dcat_rdf',
+                                 url=self.url + path)
+
+    def _gather(self, source):
+        from ckanext.harvest.model import HarvestJob
+
+        job = HarvestJob(source_id=source['id'], status=u'Running')
+        job.save()
+        object_ids = SwedenDCATRDFHarvester().gather_stage(job)
+        job.gather_finished = datetime.datetime.utcnow()
+        job.save()
+        return job, object_ids
+
+    def _advisory_locks(self):
+        if model.meta.engine.dialect.name != 'postgresql':
+            return 0
+        return model.Session.execute(
+            "SELECT count(*) FROM pg_locks WHERE locktype = 'advisory'"
+        ).scalar()
+
+    def test_host_slot_is_released_when_the_download_fails(self):
+        source = self._create_source('/missing.ttl')
+
+        job, object_ids = self._gather(source)
+
+        eq_(object_ids, [])
+        eq_(getattr(scheduler._local, 'held', None), None)
+        eq_(self._advisory_locks(), 0)
+
+    def test_validation_summary_is_stored(self):
+        from ckanext.harvest.model import HarvestGatherError
+
+        self.server.catalog = 'Not RDF'
+        source = self._create_source()
+
+        job, object_ids = self._gather(source)
+
+        errors = model.Session.query(HarvestGatherError) \
+            .filter(HarvestGatherError.harvest_job_id == job.id).count()
+        assert errors
+        eq_(ValidationSummary.get(job.id).errors, errors)
+
+    def test_validation_metrics_are_stored_per_job(self):
+        get_backend().clear()
+        config['ckanext.sweden.harvest.skip_unchanged'] = 'false'
+        config['ckanext.sweden.harvest.validation_cache_ttl'] = '60'
+        source = self._create_source()
+
+        first_job, object_ids = self._gather(source)
+        job, object_ids = self._gather(source)
+
+        metrics = json.loads(ValidationSummary.get(first_job.id).metrics)
+        eq_((metrics['cache_hits'], metrics['cache_misses']), (0, 1))
+        metrics = json.loads(ValidationSummary.get(job.id).metrics)
+        eq_((metrics['cache_hits'], metrics['cache_misses']), (1, 0))
+
+    def test_not_modified_file_is_skipped(self):
+        source = self._create_source()
+        job, object_ids = self._gather(source)
+        eq_(len(object_ids), 1)
+        eq_(HarvestSourceState.get(source['id']).validated_job_id, job.id)
+        del self.server.requests[:]
+
+        unchanged_job, object_ids = self._gather(source)
+
+        eq_(object_ids, [])
+        eq_(self.server.requests, [('HEAD', '"v1"')])
+        eq_(model.Session.query(UnchangedHarvestJob).get(
+            unchanged_job.id).reference_job_id, job.id)
+
+    def test_file_with_the_same_content_is_skipped(self):
+        self.server.etag = None
+        source = self._create_source()
+        job, object_ids = self._gather(source)
+        del self.server.requests[:]
+
+        unchanged_job, object_ids = self._gather(source)
+
+        eq_(object_ids, [])
+        assert ('GET', None) in self.server.requests
+        eq_(model.Session.query(UnchangedHarvestJob).get(
+            unchanged_job.id).reference_job_id, job.id)
+
+    def test_file_that_failed_validation_is_not_skipped(self):
+        # Nothing listens on this port
+        config['ckanext.sweden.harvest.validation_service'] = \
+            'http://127.0.0.1:1/service'
+        config['ckanext.sweden.harvest.validation_retries'] = '0'
+        try:
+            source = self._create_source()
+            job, object_ids = self._gather(source)
+            eq_(len(object_ids), 1)
+            eq_(HarvestSourceState.get(source['id']), None)
+
+            job, object_ids = self._gather(source)
+        finally:
+            config.pop('ckanext.sweden.harvest.validation_retries')
+
+        eq_(len(object_ids), 1)
+        eq_(model.Session.query(UnchangedHarvestJob).get(job.id), None)
+
+    def test_file_that_failed_to_import_is_not_skipped(self):
+        from ckanext.harvest.model import HarvestObject
+
+        source = self._create_source()
+        job, object_ids = self._gather(source)
+        for obj in model.Session.query(HarvestObject) \
+                .filter(HarvestObject.harvest_job_id == job.id):
+            obj.state = u'ERROR'
+        model.Session.commit()
+
+        job, object_ids = self._gather(source)
+
+        eq_(len(object_ids), 1)
+        eq_(model.Session.query(UnchangedHarvestJob).get(job.id), None)
+
+    def test_paginated_file_is_not_skipped(self):
+        self.server.catalog = PAGED_CATALOG.replace('{url}', self.url)
+        self.server.pages['/page2.ttl'] = SECOND_PAGE.replace('{title}',
+                                                              'Dataset 2')
+        source = self._create_source()
+        job, object_ids = self._gather(source)
+        eq_(len(object_ids), 2)
+        eq_(HarvestSourceState.get(source['id']).paginated, True)
+
+        # Only the second page changes
+        self.server.pages['/page2.ttl'] = SECOND_PAGE.replace(
+            '{title}', 'Dataset 2 updated')
+        job, object_ids = self._gather(source)
+
+        eq_(len(object_ids), 2)
+        eq_(model.Session.query(UnchangedHarvestJob).get(job.id), None)
@@ -0,0 +1,112 @@
+import os
+
+import nose
+
+from ckanext.sweden.dcat import local_validator
+
+eq_ = nose.tools.eq_
+assert_in = nose.tools.assert_in
+
+
+CATALOG = '''
+@prefix dcat: <http://www.w3.org/ns/dcat#> .
+@prefix dcterms: <http://purl.org/dc/terms/> .
+@prefix foaf: <http://xmlns.com/foaf/0.1/> .
+
+<http://example.com/catalog> a dcat:Catalog ;
+    dcterms:title "Catalog" ;
+    dcterms:description "A catalog" ;
+    dcterms:publisher <http://example.com/publisher> ;
+    dcat:dataset <http://example.com/dataset/1> .
+
+<http://example.com/publisher> a foaf:Agent ;
+    foaf:name "Publisher" .
+
+<http://example.com/dataset/1> a dcat:Dataset ;
+    {dataset}
+'''
+
+
+class TestLocalValidator(object):
+
+    def _get_file_contents(self, file_name):
+        path = os.path.join(os.path.dirname(__file__),
+                            '..', 'examples',
+                            file_name)
+        with open(path, 'r') as f:
+            return f.read()
+
+    def _get_resource(self, report, uri):
+        return next(resource for resource in report['resources']
+                    if resource['uri'] == uri)
+
+    def test_example(self):
+        report = local_validator.validate(
+            self._get_file_contents('dataset_sweden.rdf'))
+
+        eq_(report['rdfError'], None)
+        eq_(report['mandatoryError'], [])
+        for resource in report['resources']:
+            for key in ('type', 'template', 'uri', 'errors', 'warnings'):
+                assert_in(key, resource)
+
+    def test_missing_properties(self):
+        report = local_validator.validate(CATALOG.replace(
+            '{dataset}', 'dcterms:description "A dataset" .'))
+
+        resource = self._get_resource(report, 'http://example.com/dataset/1')
+        eq_(resource['type'], 'dcat:Dataset')
+        assert_in({'path': 'dcterms:title', 'code': 'few'},
+                  resource['errors'])
+        assert_in({'path': 'dcat:keyword', 'code': 'few'},
+                  resource['warnings'])
+        eq_(report['errors'], sum(len(r['errors'])
+                                  for r in report['resources']))
+
+    def test_too_many_values(self):
+        report = local_validator.validate(CATALOG.replace(
+            '{dataset}', '''dcterms:title "A dataset" ;
+            dcterms:description "A dataset" ;
+            dcterms:issued "2015-01-01", "2015-01-02" .'''))
+
+        resource = self._get_resource(report, 'http://example.com/dataset/1')
+        assert_in({'path': 'dcterms:issued', 'code': 'many'},
+                  resource['errors'])
+
+    def test_untyped_linked_resources_are_checked(self):
+        report = local_validator.validate(CATALOG.replace(
+            '{dataset}', '''dcterms:title "A dataset" ;
+            dcat:distribution <http://example.com/distribution/1> .'''))
+
+        resource = self._get_resource(report,
+                                      'http://example.com/distribution/1')
+        eq_(resource['type'], 'dcat:Distribution')
+        assert_in({'path': 'dcat:accessURL', 'code': 'few'},
+                  resource['errors'])
+
+    def test_mandatory_classes(self):
+        report = local_validator.validate('''
+            @prefix dcterms: <http://purl.org/dc/terms/> .
+            <http://example.com/thing> dcterms:title "Not a catalog" .
+        ''')
+
+        eq_(report['mandatoryError'], ['dcat:Catalog', 'dcat:Dataset'])
+        eq_(report['errors'], 2)
+
+    def test_rdf_error(self):
+        report = local_validator.validate('<rdf:RDF not really')
+
+        assert report['rdfError']
+        eq_(report['resources'], [])
+
+    def test_n_triples(self):
+        report = local_validator.validate(
+            '<http://example.com/catalog> '
+            '<http://www.w3.org/1999/02/22-rdf-syntax-ns#type> '
+            '<http://www.w3.org/ns/dcat#Catalog> .\n'
+            '<http://example.com/dataset/1> '
+            '<http://www.w3.org/1999/02/22-rdf-syntax-ns#type> '
+            '<http://www.w3.org/ns/dcat#Dataset> .\n')
+
+        eq_(report['rdfError'], None)
+        eq_(report['mandatoryError'], [])
@@ -0,0 +1,80 @@
+import datetime
+
+import nose
+from pylons import config
+
+from ckanext.sweden.dcat import scheduler
+
+eq_ = nose.tools.eq_
+
+
+class TestAssignSlots(object):
+
+    def test_longest_sources_get_their_own_slot(self):
+        durations = {'a': 3600, 'b': 600, 'c': 600, 'd': 300}
+
+        assignment = scheduler.assign_slots(durations, [0, 1])
+
+        eq_(assignment['a'], 0)
+        eq_(set([assignment['b'], assignment['c'], assignment['d']]),
+            set([1]))
+
+    def test_loads_are_balanced(self):
+        durations = dict(('source-{0}'.format(i), (i % 7 + 1) * 60)
+                         for i in range(100))
+        slots = range(10)
+
+        assignment = scheduler.assign_slots(durations, slots)
+
+        loads = dict((slot, 0) for slot in slots)
+        for source_id, slot in assignment.iteritems():
+            loads[slot] += durations[source_id]
+        assert max(loads.values()) - min(loads.values()) <= 7 * 60
+
+    def test_few_sources_are_spread_across_days(self):
+        durations = {'a': 60, 'b': 60, 'c': 60}
+
+        assignment = scheduler.assign_slots(durations, range(7 * 24))
+
+        eq_(sorted(assignment.values()), [0, 24, 48])
+
+
+class TestNextSlotTime(object):
+
+    def test_later_this_week(self):
+        # A Wednesday
+        now = datetime.datetime(2015, 6, 10, 12, 30)
+
+        # Thursday at 03:00
+        eq_(scheduler.next_slot_time(3 * 24 + 3, now),
+            datetime.datetime(2015, 6, 11, 3, 0))
+
+    def test_next_week(self):
+        now = datetime.datetime(2015, 6, 10, 12, 30)
+
+        # Monday at 01:00
+        eq_(scheduler.next_slot_time(1, now),
+            datetime.datetime(2015, 6, 15, 1, 0))
+
+
+class TestAllowedSlots(object):
+
+    def setup(self):
+        self.original_config = config.copy()
+
+    def teardown(self):
+        config.clear()
+        config.update(self.original_config)
+
+    def test_default(self):
+        config.pop('ckanext.sweden.harvest.schedule_days', None)
+        config.pop('ckanext.sweden.harvest.schedule_hours', None)
+
+        eq_(scheduler.allowed_slots(), range(7 * 24))
+
+    def test_nights_on_weekdays(self):
+        config['ckanext.sweden.harvest.schedule_days'] = '0 1 2 3 4'
+        config['ckanext.sweden.harvest.schedule_hours'] = '1 2'
+
+        eq_(scheduler.allowed_slots(),
+            [1, 2, 25, 26, 49, 50, 73, 74, 97, 98])
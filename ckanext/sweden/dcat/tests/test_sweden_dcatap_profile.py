@@ -2,7 +2,14 @@ import os
 
 import nose
 
+import json
+
+from rdflib import Graph, URIRef
+from rdflib.namespace import RDF, RDFS
+
 from ckanext.dcat.parsers import RDFParser
+from ckanext.sweden.dcat.profiles import (DCT, SwedishDCATAPProfile,
+                                          get_spatial_index)
 
 eq_ = nose.tools.eq_
 
@@ -35,3 +42,139 @@ class TestSwedenDCATAPProfile(object):
             return v[0] if v else None
 
         eq_(_get_extra_value('spatial_text'), u'Stockholm')
+
+    def test_shared_spatial_labels(self):
+
+        contents = '''
+        @prefix dcat: <http://www.w3.org/ns/dcat#> .
+        @prefix dcterms: <http://purl.org/dc/terms/> .
+        @prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+
+        <http://example.com/catalog> a dcat:Catalog ;
+            dcat:dataset <http://example.com/ds1>, <http://example.com/ds2>,
+                <http://example.com/ds3> .
+        <http://example.com/ds1> a dcat:Dataset ;
+            dcterms:spatial <http://sws.geonames.org/2673730> .
+        <http://example.com/ds2> a dcat:Dataset ;
+            dcterms:spatial <http://sws.geonames.org/2673730> .
+        <http://example.com/ds3> a dcat:Dataset .
+        <http://sws.geonames.org/2673730> rdfs:label "Stockholm" .
+        '''
+
+        p = RDFParser(profiles=['euro_dcat_ap', 'sweden_dcat_ap'])
+
+        p.parse(contents, _format='turtle')
+
+        labels = {}
+        for dataset in p.datasets():
+            extras = dict((extra['key'], extra['value'])
+                          for extra in dataset['extras'])
+            labels[extras['uri']] = extras.get('spatial_text')
+
+        eq_(labels, {'http://example.com/ds1': 'Stockholm',
+                     'http://example.com/ds2': 'Stockholm',
+                     'http://example.com/ds3': None})
+
+        index = get_spatial_index(p.g)
+        eq_(index.labels.keys(),
+            [URIRef('http://sws.geonames.org/2673730')])
+
+    def test_spatial_from_gazetteer(self):
+
+        contents = '''
+        @prefix dcat: <http://www.w3.org/ns/dcat#> .
+        @prefix dcterms: <http://purl.org/dc/terms/> .
+
+        <http://example.com/catalog> a dcat:Catalog ;
+            dcat:dataset <http://example.com/ds1> .
+        <http://example.com/ds1> a dcat:Dataset ;
+            dcterms:spatial <http://data.europa.eu/nuts/code/SE110> .
+        '''
+
+        p = RDFParser(profiles=['euro_dcat_ap', 'sweden_dcat_ap'])
+
+        p.parse(contents, _format='turtle')
+
+        dataset = next(p.datasets())
+        extras = dict((extra['key'], extra['value'])
+                      for extra in dataset['extras'])
+
+        eq_(extras['spatial_text'], u'Stockholms l\xe4n')
+        eq_(json.loads(extras['spatial'])['type'], 'Polygon')
+
+    def test_spatial_municipality_from_gazetteer(self):
+
+        contents = '''
+        @prefix dcat: <http://www.w3.org/ns/dcat#> .
+        @prefix dcterms: <http://purl.org/dc/terms/> .
+        @prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+
+        <http://example.com/catalog> a dcat:Catalog ;
+            dcat:dataset <http://example.com/ds1> .
+        <http://example.com/ds1> a dcat:Dataset ;
+            dcterms:spatial [ a dcterms:Location ;
+                              rdfs:label "Ume\\u00e5 kommun" ] .
+        '''
+
+        p = RDFParser(profiles=['euro_dcat_ap', 'sweden_dcat_ap'])
+
+        p.parse(contents, _format='turtle')
+
+        dataset = next(p.datasets())
+        extras = dict((extra['key'], extra['value'])
+                      for extra in dataset['extras'])
+
+        eq_(extras['spatial_text'], u'Ume\xe5 kommun')
+        eq_(json.loads(extras['spatial'])['type'], 'Polygon')
+
+    def test_graph_from_dataset_canonical_municipality_uri(self):
+
+        g = Graph()
+        dataset_ref = URIRef('http://example.com/ds1')
+        profile = SwedishDCATAPProfile(g)
+
+        profile.graph_from_dataset({
+            'extras': [{'key': 'spatial_text', 'value': u'Ume\xe5'}],
+        }, dataset_ref)
+
+        eq_(g.value(dataset_ref, DCT.spatial),
+            URIRef('http://www.scb.se/kommun/2480'))
+
+    def test_graph_from_dataset_canonical_spatial_uri(self):
+
+        g = Graph()
+        dataset_ref = URIRef('http://example.com/ds1')
+        profile = SwedishDCATAPProfile(g)
+
+        profile.graph_from_dataset({
+            'extras': [{'key': 'spatial_text',
+                        'value': u'Stockholms l\xe4n'}],
+        }, dataset_ref)
+
+        spatial = g.value(dataset_ref, DCT.spatial)
+        eq_(spatial, URIRef('http://data.europa.eu/nuts/code/SE110'))
+        eq_(unicode(g.value(spatial, RDFS.label)), u'Stockholms l\xe4n')
+
+    def test_graph_from_dataset_without_spatial(self):
+
+        g = Graph()
+        dataset_ref = URIRef('http://example.com/ds1')
+
+        SwedishDCATAPProfile(g).graph_from_dataset({'extras': []},
+                                                   dataset_ref)
+
+        eq_(len(g), 0)
+
+    def test_graph_from_dataset_shared_locations(self):
+
+        g = Graph()
+        spatial_uri = 'http://example.com/place'
+        for i in range(3):
+            SwedishDCATAPProfile(g).graph_from_dataset({
+                'extras': [{'key': 'spatial_uri', 'value': spatial_uri},
+                           {'key': 'spatial_text', 'value': 'Place'}],
+            }, URIRef('http://example.com/ds{0}'.format(i)))
+
+        eq_(len(list(g.subjects(DCT.spatial, URIRef(spatial_uri)))), 3)
+        eq_(list(g.subjects(RDF.type, DCT.Location)), [URIRef(spatial_uri)])
+        eq_(len(list(g.objects(URIRef(spatial_uri), RDFS.label))), 1)
@@ -0,0 +1,243 @@
+import gzip
+import json
+import time
+import StringIO
+import threading
+import BaseHTTPServer
+
+import nose
+import requests
+from pylons import config
+
+from ckanext.sweden.cache import get_backend
+from ckanext.sweden.dcat import validation
+
+eq_ = nose.tools.eq_
+assert_raises = nose.tools.assert_raises
+
+
+class ValidationServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Stand-in for the validation service: replies to each request with the
+    next of the server `responses` (status code, seconds to wait before
+    replying).
+    '''
+
+    def do_POST(self):
+        body = self.rfile.read(
+            int(self.headers.getheader('Content-Length', 0)))
+        self.server.requests += 1
+        self.server.content_encoding = self.headers.getheader(
+            'Content-Encoding')
+        if self.server.content_encoding == 'gzip':
+            body = gzip.GzipFile(fileobj=StringIO.StringIO(body)).read()
+        self.server.body = body
+        status, delay = self.server.responses.pop(0)
+        if delay:
+            time.sleep(delay)
+        body = json.dumps({'rdfError': None, 'resources': []})
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestValidationClient(object):
+
+    options = {
+        'ckanext.sweden.harvest.validation_retries': '2',
+        'ckanext.sweden.harvest.validation_backoff': '0',
+        'ckanext.sweden.harvest.validation_read_timeout': '0.5',
+        'ckanext.sweden.harvest.validation_gzip': 'false',
+        'ckanext.sweden.harvest.validation_max_size': '100',
+        'ckanext.sweden.harvest.validation_cache_ttl': '0',
+    }
+
+    def setup(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                ValidationServiceHandler)
+        self.server.requests = 0
+        self.server.responses = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{0}/service'.format(
+            self.server.server_address[1])
+
+        self.original_config = dict((key, config.get(key))
+                                    for key in self.options)
+        config.update(self.options)
+        validation.reset_session()
+        validation.metrics.reset()
+        validation._gzip_unsupported.clear()
+        validation._host_semaphores.clear()
+
+    def teardown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for key, value in self.original_config.iteritems():
+            if value is None:
+                config.pop(key, None)
+            else:
+                config[key] = value
+        validation.reset_session()
+
+    def test_post(self):
+        self.server.responses = [(200, 0)]
+
+        r = validation.post(self.url, 'content')
+
+        eq_(r.status_code, 200)
+        eq_(r.json(), {'rdfError': None, 'resources': []})
+        eq_(validation.metrics.as_dict()['retries'], 0)
+
+    def test_requests_are_limited_per_host(self):
+        self.server.responses = [(200, 0)]
+        config['ckanext.sweden.harvest.validation_max_concurrency'] = '1'
+        responses = []
+
+        try:
+            with validation._host_semaphore(self.url):
+                thread = threading.Thread(target=lambda: responses.append(
+                    validation.post(self.url, 'content')))
+                thread.start()
+                time.sleep(0.2)
+                # The request waits for this thread to free the host slot
+                eq_(self.server.requests, 0)
+            thread.join(5)
+        finally:
+            config.pop('ckanext.sweden.harvest.validation_max_concurrency')
+
+        eq_(self.server.requests, 1)
+        eq_(responses[0].status_code, 200)
+
+    def test_job_counts_are_kept_per_thread(self):
+        self.server.responses = [(200, 0)] * 2
+        validation.metrics.start_job()
+
+        validation.post(self.url, 'content')
+        thread = threading.Thread(target=validation.post,
+                                  args=(self.url, 'content'))
+        thread.start()
+        thread.join(5)
+
+        eq_(validation.metrics.job_counts()['requests'], 1)
+        eq_(validation.metrics.as_dict()['requests'], 2)
+
+    def test_server_errors_are_retried(self):
+        self.server.responses = [(503, 0), (500, 0), (200, 0)]
+
+        r = validation.post(self.url, 'content')
+
+        eq_(r.status_code, 200)
+        eq_(self.server.requests, 3)
+        metrics = validation.metrics.as_dict()
+        eq_(metrics['retries'], 2)
+        eq_(metrics['server_errors'], 2)
+
+    def test_retries_are_bounded(self):
+        self.server.responses = [(500, 0)] * 4
+
+        r = validation.post(self.url, 'content')
+
+        eq_(r.status_code, 500)
+        eq_(self.server.requests, 3)
+        eq_(validation.metrics.as_dict()['failures'], 1)
+
+    def test_client_errors_are_not_retried(self):
+        self.server.responses = [(400, 0), (200, 0)]
+
+        r = validation.post(self.url, 'content')
+
+        eq_(r.status_code, 400)
+        eq_(self.server.requests, 1)
+
+    def test_timeouts(self):
+        self.server.responses = [(200, 1)] * 3
+
+        assert_raises(requests.exceptions.Timeout,
+                      validation.post, self.url, 'content')
+
+        metrics = validation.metrics.as_dict()
+        eq_(metrics['timeouts'], 3)
+        eq_(metrics['retries'], 2)
+
+    def test_session_is_shared(self):
+        self.server.responses = [(200, 0)] * 2
+
+        validation.post(self.url, 'content')
+        validation.post(self.url, 'content')
+
+        eq_(validation.get_session(), validation.get_session())
+        eq_(validation.metrics.as_dict()['requests'], 2)
+
+    def test_reports_are_cached(self):
+        self.server.responses = [(200, 0)] * 2
+        get_backend().clear()
+        config['ckanext.sweden.harvest.validation_cache_ttl'] = '60'
+
+        report = validation.validate('content', self.url)
+        eq_(validation.validate('content', self.url), report)
+
+        eq_(self.server.requests, 1)
+        metrics = validation.metrics.as_dict()
+        eq_(metrics['cache_misses'], 1)
+        eq_(metrics['cache_hits'], 1)
+
+    def test_changed_content_is_validated_again(self):
+        self.server.responses = [(200, 0)] * 2
+        get_backend().clear()
+        config['ckanext.sweden.harvest.validation_cache_ttl'] = '60'
+
+        validation.validate('content', self.url)
+        validation.validate('other content', self.url)
+
+        eq_(self.server.requests, 2)
+
+    def test_cache_key_includes_service_url(self):
+        assert (validation.cache_key('content', self.url) !=
+                validation.cache_key('content', self.url + '/v2'))
+
+    def test_errors_are_not_cached(self):
+        self.server.responses = [(400, 0), (200, 0)]
+        get_backend().clear()
+
+        assert_raises(validation.ValidationServiceError,
+                      validation.validate, 'content', self.url)
+        validation.validate('content', self.url)
+
+        eq_(self.server.requests, 2)
+
+    def test_gzipped_upload(self):
+        self.server.responses = [(200, 0)]
+        config['ckanext.sweden.harvest.validation_gzip'] = 'true'
+
+        validation.validate('content', self.url)
+
+        eq_(self.server.content_encoding, 'gzip')
+        eq_(self.server.body, 'content')
+
+    def test_gzip_unsupported(self):
+        self.server.responses = [(415, 0), (200, 0), (200, 0)]
+        config['ckanext.sweden.harvest.validation_gzip'] = 'true'
+
+        validation.validate('content', self.url)
+        eq_(self.server.content_encoding, None)
+        eq_(self.server.body, 'content')
+
+        validation.validate('other content', self.url)
+        eq_(self.server.requests, 3)
+        eq_(self.server.content_encoding, None)
+
+    def test_oversized_documents_are_not_validated(self):
+        errors, validated = validation.validate_document('x' * 101,
+                                                         self.url)
+
+        eq_(validated, False)
+        eq_(len(errors), 1)
+        assert 'too large' in errors[0]
+        eq_(self.server.requests, 0)
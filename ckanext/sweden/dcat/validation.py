@@ -0,0 +1,486 @@
+'''
+Validation of harvested DCAT documents.
+
+Documents are validated either by the remote validation service or, if
+`ckanext.sweden.harvest.validation_service` is set to `local`, by the local
+engine in `ckanext.sweden.dcat.local_validator`. Both return reports with the
+same structure.
+
+All requests to the remote service go through a single `requests.Session`,
+so connections to the service are pooled and reused between documents (and
+between the threads of a harvester process). Requests have connect and read
+timeouts, and are retried with exponential backoff on connection errors and
+5xx responses.
+
+Validation reports are cached (in the `ckanext.sweden.cache` backend) by
+the SHA-256 of the document and the service URL, so documents that haven't
+changed since they were last validated are not sent again.
+
+The number of requests, retries, timeouts, failures and cache hits and
+misses are kept in `metrics`, in total and for the harvest job of each
+thread. The counts of each job are logged and stored with its validation
+summary.
+
+Documents can also be validated in the background by a pool of threads
+(`validate_async`), with the validation errors added to the harvest job as
+they are available.
+'''
+import gzip
+import json
+import time
+import Queue
+import atexit
+import hashlib
+import tempfile
+import logging
+import urlparse
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from pylons import config
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.sweden.cache import MISSING, get_backend
+from ckanext.sweden.dcat import local_validator
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 120
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 1
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CACHE_TTL = 14 * 24 * 60 * 60
+DEFAULT_WORKERS = 4
+DEFAULT_QUEUE_SIZE = 20
+DEFAULT_MAX_SIZE = 100 * 1024 * 1024
+DEFAULT_MAX_CONCURRENCY = 4
+
+# Value of `ckanext.sweden.harvest.validation_service` that selects the
+# local validation engine
+LOCAL = 'local'
+
+METRICS = ('requests', 'retries', 'timeouts', 'connection_errors',
+           'server_errors', 'failures', 'cache_hits', 'cache_misses')
+
+
+class ValidationServiceError(Exception):
+    '''The validation service replied with an error status code.'''
+
+    def __init__(self, status_code):
+        super(ValidationServiceError, self).__init__(status_code)
+        self.status_code = status_code
+
+
+_session = None
+_session_lock = threading.Lock()
+
+# Validation services that rejected gzipped uploads
+_gzip_unsupported = set()
+
+# Semaphores limiting the concurrent requests to each validation service
+# host
+_host_semaphores = {}
+
+
+class Metrics(object):
+    '''
+    Thread safe counters for the requests made to the service, in total and
+    for the harvest job of each thread since it called `start_job`.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def increment(self, name):
+        with self._lock:
+            self._counts[name] += 1
+        job_counts = getattr(self._local, 'counts', None)
+        if job_counts is not None:
+            job_counts[name] += 1
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def start_job(self):
+        '''Start counting for a harvest job in this thread.'''
+        self._local.counts = dict((name, 0) for name in METRICS)
+
+    def job_counts(self):
+        '''Return the counts since this thread called `start_job`.'''
+        counts = getattr(self._local, 'counts', None)
+        if counts is None:
+            return dict((name, 0) for name in METRICS)
+        return dict(counts)
+
+    def reset(self):
+        with self._lock:
+            self._counts = dict((name, 0) for name in METRICS)
+
+
+metrics = Metrics()
+
+
+def get_session():
+    '''
+    Return the session shared by all the requests to the validation service.
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            pool_size = toolkit.asint(config.get(
+                'ckanext.sweden.harvest.validation_pool_size',
+                DEFAULT_POOL_SIZE))
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size,
+                                  pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+
+def reset_session():
+    '''
+    Close the shared session, e.g. after forking, so a new one with its own
+    connections is created on the next request.
+    '''
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def get_timeout():
+    '''Return the (connect, read) timeout for requests to the service.'''
+    return (float(config.get(
+                'ckanext.sweden.harvest.validation_connect_timeout',
+                DEFAULT_CONNECT_TIMEOUT)),
+            float(config.get(
+                'ckanext.sweden.harvest.validation_read_timeout',
+                DEFAULT_READ_TIMEOUT)))
+
+
+def post(url, data, headers=None):
+    '''
+    POST `data` to the validation service and return the response.
+
+    Connection errors, timeouts and 5xx responses are retried up to
+    `ckanext.sweden.harvest.validation_retries` times, waiting
+    `ckanext.sweden.harvest.validation_backoff` seconds before the first
+    retry and doubling the wait after each one. If all the attempts fail,
+    the last exception is raised, or the last 5xx response returned.
+    '''
+    retries = toolkit.asint(config.get(
+        'ckanext.sweden.harvest.validation_retries', DEFAULT_RETRIES))
+    backoff = float(config.get(
+        'ckanext.sweden.harvest.validation_backoff', DEFAULT_BACKOFF))
+    timeout = get_timeout()
+    session = get_session()
+
+    attempt = 0
+    while True:
+        metrics.increment('requests')
+        error = None
+        if hasattr(data, 'seek'):
+            data.seek(0)
+        try:
+            with _host_semaphore(url):
+                response = session.post(url, data=data, headers=headers,
+                                        timeout=timeout)
+        except requests.exceptions.Timeout, e:
+            metrics.increment('timeouts')
+            error = e
+        except requests.exceptions.ConnectionError, e:
+            metrics.increment('connection_errors')
+            error = e
+        else:
+            if response.status_code < 500:
+                return response
+            metrics.increment('server_errors')
+
+        if attempt >= retries:
+            metrics.increment('failures')
+            if error:
+                raise error
+            return response
+
+        wait = backoff * 2 ** attempt
+        log.debug('Validation request to {0} failed ({1}), retrying in '
+                  '{2} seconds'.format(
+                      url, error or response.status_code, wait))
+        metrics.increment('retries')
+        attempt += 1
+        if wait:
+            time.sleep(wait)
+
+
+def _host_semaphore(url):
+    '''
+    Return the semaphore that limits the concurrent requests from this
+    process to the host of `url` to
+    `ckanext.sweden.harvest.validation_max_concurrency`.
+    '''
+    host = urlparse.urlparse(url).netloc.lower()
+    with _session_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(
+                toolkit.asint(config.get(
+                    'ckanext.sweden.harvest.validation_max_concurrency',
+                    DEFAULT_MAX_CONCURRENCY)))
+        return _host_semaphores[host]
+
+
+def validate(content, service_url):
+    '''
+    Return the validation report for a DCAT document, from the validation
+    service at `service_url` or the local engine if it is `local`.
+
+    Reports are cached for `ckanext.sweden.harvest.validation_cache_ttl`
+    seconds (0 disables the cache). Raises `ValidationServiceError` if the
+    service replies with an error, or `requests.exceptions.RequestException`
+    if it can't be reached.
+    '''
+    ttl = toolkit.asint(config.get(
+        'ckanext.sweden.harvest.validation_cache_ttl', DEFAULT_CACHE_TTL))
+    key = cache_key(content, service_url)
+
+    if ttl:
+        report = get_backend().get(key)
+        if report is not MISSING:
+            metrics.increment('cache_hits')
+            return report
+        metrics.increment('cache_misses')
+
+    if service_url == LOCAL:
+        report = local_validator.validate(content)
+    else:
+        r = _post_document(service_url, content)
+        if r.status_code != 200:
+            raise ValidationServiceError(r.status_code)
+        report = r.json()
+
+    if ttl:
+        get_backend().set(key, report, ttl)
+    return report
+
+
+def _post_document(service_url, content):
+    '''
+    POST a document to the validation service, gzipped if
+    `ckanext.sweden.harvest.validation_gzip` is enabled.
+
+    The gzipped document is written to a temporary file and streamed from
+    it. If the service rejects it with a 415 (Unsupported Media Type), it is
+    sent uncompressed, and so are all the following ones.
+    '''
+    if isinstance(content, unicode):
+        content = content.encode('utf8')
+
+    if (not toolkit.asbool(config.get(
+            'ckanext.sweden.harvest.validation_gzip', False)) or
+            service_url in _gzip_unsupported):
+        return post(service_url, content)
+
+    with tempfile.TemporaryFile() as f:
+        gz = gzip.GzipFile(fileobj=f, mode='wb')
+        gz.write(content)
+        gz.close()
+        r = post(service_url, f, headers={'Content-Encoding': 'gzip'})
+
+    if r.status_code == 415:
+        log.info('The validation service at {0} does not support gzipped '
+                 'uploads, sending them uncompressed'.format(service_url))
+        _gzip_unsupported.add(service_url)
+        r = post(service_url, content)
+    return r
+
+
+def cache_key(content, service_url):
+    if isinstance(content, unicode):
+        content = content.encode('utf8')
+    digest = hashlib.sha256(content)
+    digest.update('|' + service_url.encode('utf8'))
+    return 'dcat_validation:' + digest.hexdigest()
+
+
+def save_metrics(harvest_job_id):
+    '''
+    Log the counts of the validation of a harvest job by this thread (see
+    `Metrics.start_job`) and add them to its stored validation summary.
+    This doesn't commit.
+    '''
+    from ckanext.sweden.model.validation import add_validation_metrics
+
+    counts = metrics.job_counts()
+    if not any(counts.values()):
+        return
+    log.info('Validation service requests for harvest job {0}: {1}'.format(
+        harvest_job_id,
+        ', '.join('{0}: {1}'.format(name, count) for name, count in
+                  sorted(counts.iteritems()))))
+    add_validation_metrics(harvest_job_id, counts)
+
+
+def validate_document(content, service_url):
+    '''
+    Validate a DCAT document and return a tuple with the list of errors to
+    record as gather errors of the harvest job, and whether the document
+    could be validated.
+
+    The errors are messages for errors contacting the service and missing
+    classes, and a JSON object for each resource with errors or warnings.
+    Documents larger than `ckanext.sweden.harvest.validation_max_size`
+    bytes are not validated, and an error is returned instead.
+    '''
+    max_size = toolkit.asint(config.get(
+        'ckanext.sweden.harvest.validation_max_size', DEFAULT_MAX_SIZE))
+    if max_size and len(content) > max_size:
+        return [toolkit._(
+            'The document is too large to be validated ({0} bytes, the '
+            'maximum is {1} bytes)'.format(len(content), max_size))], False
+
+    try:
+        report = validate(content, service_url)
+    except requests.exceptions.RequestException, e:
+        return [toolkit._(
+            'Error contacting the validation service: {0}'.format(
+                str(e)))], False
+    except ValidationServiceError, e:
+        return [toolkit._(
+            'The validation service returned an error: {0}'.format(
+                e.status_code))], False
+
+    if not any([report.get('rdfError'),
+                report.get('errors'),
+                report.get('warnings')]):
+        # All clear
+        return [], True
+
+    errors = []
+    if report.get('rdfError'):
+        errors.append(report.get('rdfError'))
+    else:
+        if report.get('mandatoryError'):
+            for _class in report['mandatoryError']:
+                errors.append(toolkit._(
+                    'Mandatory class {0} missing'.format(_class)))
+
+        for resource in report.get('resources', []):
+            errors.append(json.dumps(resource))
+
+    return errors, True
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def validate_async(content, service_url, harvest_job_id, downloaded=None):
+    '''
+    Queue a DCAT document to be validated in the background. Its validation
+    errors are saved as gather errors of the harvest job once done, and if
+    it could be validated, `downloaded` (see
+    `ckanext.sweden.dcat.conditional.pop_downloaded`) is recorded.
+
+    The queue is processed by `ckanext.sweden.harvest.validation_workers`
+    threads, started on the first call. It holds up to
+    `ckanext.sweden.harvest.validation_queue_size` documents, and once it
+    is full documents are validated straight away instead.
+    '''
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = Queue.Queue(maxsize=toolkit.asint(config.get(
+                'ckanext.sweden.harvest.validation_queue_size',
+                DEFAULT_QUEUE_SIZE)))
+            workers = toolkit.asint(config.get(
+                'ckanext.sweden.harvest.validation_workers',
+                DEFAULT_WORKERS))
+            for i in range(workers):
+                thread = threading.Thread(target=_worker, args=(_queue,),
+                                          name='dcat-validation-{0}'.format(i))
+                thread.daemon = True
+                thread.start()
+            atexit.register(wait_for_validations)
+    try:
+        _queue.put_nowait((content, service_url, harvest_job_id, downloaded))
+    except Queue.Full:
+        log.info('The validation queue is full, validating the document of '
+                 'harvest job {0} now'.format(harvest_job_id))
+        _validate(content, service_url, harvest_job_id, downloaded)
+
+
+def wait_for_validations():
+    '''Block until all the queued validations are done.'''
+    if _queue is not None:
+        _queue.join()
+
+
+def _worker(queue):
+    import pylons
+    from paste.registry import Registry
+    from ckan.lib.cli import MockTranslator
+    import ckan.model as model
+
+    # Messages are translated, and the translator is registered per thread
+    registry = Registry()
+    registry.prepare()
+    registry.register(pylons.translator, MockTranslator())
+
+    while True:
+        content, service_url, harvest_job_id, downloaded = queue.get()
+        try:
+            _validate(content, service_url, harvest_job_id, downloaded)
+        finally:
+            model.Session.remove()
+            queue.task_done()
+
+
+def _validate(content, service_url, harvest_job_id, downloaded):
+    '''
+    Validate a document queued by `validate_async`, and save its validation
+    errors and `downloaded`.
+    '''
+    from ckanext.sweden.dcat import conditional
+
+    metrics.start_job()
+    try:
+        errors, validated = validate_document(content, service_url)
+        save_gather_errors(harvest_job_id, errors)
+        if validated and downloaded:
+            conditional.record_validated(harvest_job_id, downloaded)
+        log.info('Validated the queued document of harvest job {0}: {1} '
+                 'errors'.format(harvest_job_id, len(errors)))
+    except Exception:
+        log.exception('Error validating the document of harvest job '
+                      '{0}'.format(harvest_job_id))
+
+
+def save_gather_errors(harvest_job_id, errors):
+    '''
+    Add validation errors to a harvest job, and update its stored validation
+    summary with them and the counts of this thread, in a single
+    transaction.
+    '''
+    from ckanext.harvest.model import HarvestJob, HarvestGatherError
+    import ckan.model as model
+    from ckanext.sweden.model.validation import update_validation_summary
+
+    job = HarvestJob.get(harvest_job_id)
+    if not job:
+        log.warning('Harvest job {0} not found, validation errors '
+                    'discarded'.format(harvest_job_id))
+        return
+    for error in errors:
+        model.Session.add(HarvestGatherError(message=error, job=job))
+    update_validation_summary(harvest_job_id)
+    save_metrics(harvest_job_id)
+    model.Session.commit()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+'''
+The Eurovoc domains datasets are categorized in, from the first `theme` of
+each dataset, with their labels in Swedish and English.
+'''
+import json
+
+from pylons import config
+
+EUROVOC_URI = u'http://eurovoc.europa.eu/{0}'
+
+# The 21 Eurovoc domains, in the order of their codes (04 to 76)
+CATEGORIES = dict((EUROVOC_URI.format(id), labels) for id, labels in [
+    (100142, {'en': u'Politics', 'sv': u'Politik'}),
+    (100143, {'en': u'International relations',
+              'sv': u'Internationella förbindelser'}),
+    (100144, {'en': u'European Union', 'sv': u'Europeiska unionen'}),
+    (100145, {'en': u'Law', 'sv': u'Rätt'}),
+    (100146, {'en': u'Economics', 'sv': u'Ekonomi'}),
+    (100147, {'en': u'Trade', 'sv': u'Handel'}),
+    (100148, {'en': u'Finance', 'sv': u'Finanser'}),
+    (100149, {'en': u'Social questions', 'sv': u'Sociala frågor'}),
+    (100150, {'en': u'Education and communications',
+              'sv': u'Utbildning och kommunikation'}),
+    (100151, {'en': u'Science', 'sv': u'Vetenskap'}),
+    (100152, {'en': u'Business and competition',
+              'sv': u'Företag och konkurrens'}),
+    (100153, {'en': u'Employment and working conditions',
+              'sv': u'Sysselsättning och arbetsvillkor'}),
+    (100154, {'en': u'Transport', 'sv': u'Transport'}),
+    (100155, {'en': u'Environment', 'sv': u'Miljö'}),
+    (100156, {'en': u'Agriculture, forestry and fisheries',
+              'sv': u'Jordbruk, skogsbruk och fiske'}),
+    (100157, {'en': u'Agri-foodstuffs', 'sv': u'Livsmedel'}),
+    (100158, {'en': u'Production, technology and research',
+              'sv': u'Produktion, teknik och forskning'}),
+    (100159, {'en': u'Energy', 'sv': u'Energi'}),
+    (100160, {'en': u'Industry', 'sv': u'Industri'}),
+    (100161, {'en': u'Geography', 'sv': u'Geografi'}),
+    (100162, {'en': u'International organisations',
+              'sv': u'Internationella organisationer'}),
+])
+
+DEFAULT_LANGUAGE = 'en'
+
+
+def get_label(category, language=None):
+    '''
+    Return the label of a Eurovoc category in the given language (by default
+    `ckanext.sweden.eurovoc_language`), or None if it isn't known.
+    '''
+    labels = CATEGORIES.get(category)
+    if not labels:
+        return None
+    language = language or config.get('ckanext.sweden.eurovoc_language',
+                                      DEFAULT_LANGUAGE)
+    return labels.get(language) or labels[DEFAULT_LANGUAGE]
+
+
+def category_from_theme(theme):
+    '''
+    Return the Eurovoc category from the value of the `theme` extra, a URI
+    or a JSON list of them, of which the first one is used.
+    '''
+    if not theme:
+        return None
+    if theme.startswith('['):
+        try:
+            themes = json.loads(theme)
+        except ValueError:
+            return theme
+        return themes[0] if themes else None
+    return theme
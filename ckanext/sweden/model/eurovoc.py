@@ -0,0 +1,48 @@
+from sqlalchemy import Column
+from sqlalchemy import types
+from sqlalchemy.ext.declarative import declarative_base
+
+import ckan.model as model
+
+log = __import__('logging').getLogger(__name__)
+
+Base = declarative_base()
+
+
+class PackageEurovocCategory(Base):
+    """
+    The Eurovoc category of a dataset, as it was last indexed.
+    """
+    __tablename__ = 'sweden_package_eurovoc'
+
+    package_id = Column(types.UnicodeText, primary_key=True)
+    eurovoc_category = Column(types.UnicodeText)
+    eurovoc_category_label = Column(types.UnicodeText, nullable=False,
+                                    index=True)
+
+    def __repr__(self):
+        return u"<PackageEurovocCategory: %s, %s>" % (
+            self.package_id, self.eurovoc_category_label)
+
+
+def set_package_eurovoc_category(package_id, eurovoc_category,
+                                 eurovoc_category_label):
+    '''
+    Store the Eurovoc category of a dataset, or remove it if there is no
+    label.
+
+    This doesn't commit: it is called while the dataset is being indexed,
+    so it is saved in the same transaction as the dataset.
+    '''
+    table = PackageEurovocCategory.__table__
+    model.Session.execute(
+        table.delete().where(table.c.package_id == package_id))
+    if eurovoc_category_label:
+        model.Session.execute(table.insert().values(
+            package_id=package_id,
+            eurovoc_category=eurovoc_category,
+            eurovoc_category_label=eurovoc_category_label))
+
+
+def init_tables(e):
+    Base.metadata.create_all(e)
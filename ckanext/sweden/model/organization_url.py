@@ -0,0 +1,132 @@
+import re
+
+from sqlalchemy import Column, or_
+from sqlalchemy import types
+from sqlalchemy.ext.declarative import declarative_base
+
+import ckan.model as model
+
+log = __import__('logging').getLogger(__name__)
+
+Base = declarative_base()
+
+SCHEME = re.compile(r'^[a-z][a-z0-9+.-]*://')
+
+
+class OrganizationURL(Base):
+    """
+    The URL of an organization, normalized so it can be checked for
+    uniqueness with an index lookup.
+    """
+    __tablename__ = 'sweden_organization_url'
+
+    group_id = Column(types.UnicodeText, primary_key=True)
+    url = Column(types.UnicodeText, nullable=False)
+    normalized_url = Column(types.UnicodeText, nullable=False, unique=True)
+
+    def __repr__(self):
+        return u"<OrganizationURL: %s, %s>" % (self.group_id, self.url)
+
+
+def normalize_url(url):
+    '''
+    Return the form of an organization URL used to compare them: without
+    scheme nor trailing slashes (as removed by the organization form), and
+    in lower case.
+    '''
+    return SCHEME.sub('', url.strip().lower()).rstrip('/')
+
+
+def find_organization_by_url(url):
+    '''
+    Return the id of the active organization with the given URL (once
+    normalized), or None.
+    '''
+    # Rows of organizations that no longer exist or were deleted are ignored
+    q = model.Session.query(OrganizationURL.group_id) \
+        .join(model.Group, model.Group.id == OrganizationURL.group_id) \
+        .filter(model.Group.state == 'active') \
+        .filter(OrganizationURL.normalized_url == normalize_url(url))
+    row = q.first()
+    return row[0] if row else None
+
+
+def set_organization_url(group_id, url):
+    '''
+    Store the URL of an organization, or remove it if there is none.
+
+    The URL must have been checked to be unique, so rows with the same URL
+    (left by organizations that no longer exist or were deleted) are
+    replaced. This doesn't
+    commit, so it is saved together with the organization.
+    '''
+    table = OrganizationURL
+    normalized_url = normalize_url(url) if url else None
+
+    q = model.Session.query(table)
+    if normalized_url:
+        q = q.filter(or_(table.group_id == group_id,
+                         table.normalized_url == normalized_url))
+    else:
+        q = q.filter(table.group_id == group_id)
+    q.delete(synchronize_session=False)
+
+    if normalized_url:
+        model.Session.add(OrganizationURL(group_id=group_id, url=url,
+                                          normalized_url=normalized_url))
+
+
+def migrate_organization_urls():
+    '''
+    Fill in the table with the URLs of all active organizations.
+
+    When several organizations have the same URL, only the oldest one is
+    stored. Returns a dict with the names of the organizations sharing each
+    duplicated URL, keyed by the normalized URL.
+    '''
+    q = model.Session.query(model.Group.id, model.Group.name,
+                            model.GroupExtra.value) \
+        .join(model.GroupExtra,
+              model.GroupExtra.group_id == model.Group.id) \
+        .filter(model.Group.is_organization == True) \
+        .filter(model.Group.state == 'active') \
+        .filter(model.GroupExtra.key == 'url') \
+        .filter(model.GroupExtra.state == 'active') \
+        .order_by(model.Group.created)
+
+    organizations = {}
+    duplicates = {}
+    for group_id, name, url in q:
+        if not url:
+            continue
+        normalized_url = normalize_url(url)
+        if normalized_url in organizations:
+            duplicates.setdefault(
+                normalized_url, [organizations[normalized_url][1]]
+            ).append(name)
+            continue
+        organizations[normalized_url] = (group_id, name, url)
+
+    model.Session.query(OrganizationURL).delete(synchronize_session=False)
+    for normalized_url, (group_id, name, url) in organizations.iteritems():
+        model.Session.add(OrganizationURL(group_id=group_id, url=url,
+                                          normalized_url=normalized_url))
+    model.Session.commit()
+
+    log.info('Stored the URLs of {0} organizations'.format(
+        len(organizations)))
+    return duplicates
+
+
+def init_tables(e):
+    created = not OrganizationURL.__table__.exists(bind=e)
+    Base.metadata.create_all(e)
+
+    # Until it has the URLs of the existing organizations, duplicates of
+    # them would be accepted. CKAN's tables don't exist before the database
+    # is initialized.
+    if created and model.group_table.exists(bind=e):
+        duplicates = migrate_organization_urls()
+        for url, names in sorted(duplicates.items()):
+            log.warning('Organizations with the same URL ({0}): {1}'.format(
+                url, ', '.join(names)))
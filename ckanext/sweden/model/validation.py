@@ -0,0 +1,167 @@
+import json
+from datetime import datetime
+from sqlalchemy import Column
+from sqlalchemy import types
+from sqlalchemy.ext.declarative import declarative_base
+
+import ckan.model as model
+
+log = __import__('logging').getLogger(__name__)
+
+Base = declarative_base()
+
+
+class ValidationSummary(Base):
+    """
+    The totals of the DCAT validation of a harvest job, worked out from its
+    gather errors at the end of the gather stage (or once the document has
+    been validated, if it is validated in the background).
+    """
+    __tablename__ = 'sweden_dcat_validation'
+
+    harvest_job_id = Column(types.UnicodeText, primary_key=True)
+    errors = Column(types.Integer, nullable=False, default=0)
+    warnings = Column(types.Integer, nullable=False, default=0)
+    # When it was last worked out (in UTC)
+    created = Column(types.DateTime, default=datetime.utcnow)
+    # The validation service counters of the job, serialized as JSON
+    metrics = Column(types.UnicodeText)
+
+    @classmethod
+    def get(cls, harvest_job_id):
+        return model.Session.query(cls).get(harvest_job_id)
+
+    def __repr__(self):
+        return u"<ValidationSummary: %s, errors:%s, warnings:%s>" % (
+            self.harvest_job_id, self.errors, self.warnings)
+
+
+class ValidationResource(Base):
+    """
+    One of the gather error messages of a harvest job, parsed: either a
+    validation report for a resource or a plain error message.
+    """
+    __tablename__ = 'sweden_dcat_validation_resource'
+
+    harvest_job_id = Column(types.UnicodeText, primary_key=True)
+    position = Column(types.Integer, primary_key=True, autoincrement=False)
+    errors = Column(types.Integer, nullable=False, default=0)
+    warnings = Column(types.Integer, nullable=False, default=0)
+    # The parsed message, serialized as JSON
+    message = Column(types.UnicodeText, nullable=False)
+
+    def __repr__(self):
+        return u"<ValidationResource: %s, %s>" % (self.harvest_job_id,
+                                                  self.position)
+
+
+def save_validation_summary(harvest_job_id, summary):
+    '''
+    Store the result of `summarize_gather_errors` for a harvest job,
+    replacing any previous one. The rows are updated in place rather than
+    deleted and inserted again. This doesn't commit.
+    '''
+    model.Session.merge(ValidationSummary(harvest_job_id=harvest_job_id,
+                                          errors=summary['errors'],
+                                          warnings=summary['warnings'],
+                                          created=datetime.utcnow()))
+    # Load the current rows at once, so merging doesn't query them one by one
+    model.Session.query(ValidationResource) \
+        .filter(ValidationResource.harvest_job_id == harvest_job_id).all()
+    for position, resource in enumerate(summary['resources']):
+        errors, warnings = count_errors_and_warnings(resource)
+        model.Session.merge(ValidationResource(harvest_job_id=harvest_job_id,
+                                               position=position,
+                                               errors=errors,
+                                               warnings=warnings,
+                                               message=json.dumps(resource)))
+    model.Session.query(ValidationResource) \
+        .filter(ValidationResource.harvest_job_id == harvest_job_id) \
+        .filter(ValidationResource.position >= len(summary['resources'])) \
+        .delete(synchronize_session=False)
+
+
+def update_validation_summary(harvest_job_id):
+    '''
+    Work out the validation summary of a harvest job from its gather errors
+    and store it. This doesn't commit.
+    '''
+    from ckanext.harvest.model import HarvestGatherError
+
+    model.Session.flush()
+    q = model.Session.query(HarvestGatherError.message) \
+        .filter(HarvestGatherError.harvest_job_id == harvest_job_id) \
+        .order_by(HarvestGatherError.created)
+    save_validation_summary(
+        harvest_job_id,
+        summarize_gather_errors([message for message, in q]))
+
+
+def add_validation_metrics(harvest_job_id, metrics):
+    '''
+    Add validation service counters to the ones stored with the validation
+    summary of a harvest job. This doesn't commit.
+    '''
+    summary = ValidationSummary.get(harvest_job_id)
+    if not summary:
+        return
+    totals = json.loads(summary.metrics) if summary.metrics else {}
+    for name, count in metrics.iteritems():
+        totals[name] = totals.get(name, 0) + count
+    summary.metrics = json.dumps(totals)
+
+
+def delete_validation_summary(harvest_job_id):
+    for cls in (ValidationSummary, ValidationResource):
+        model.Session.query(cls) \
+            .filter(cls.harvest_job_id == harvest_job_id) \
+            .delete(synchronize_session=False)
+
+
+def summarize_gather_errors(messages):
+    '''
+    Count the errors and warnings in the gather error messages of a harvest
+    job, parsing the ones coming from the validation service.
+    '''
+    gather_errors_list = []
+    error_count = 0
+    warning_count = 0
+    for message in messages:
+        try:
+            message = json.loads(message)
+        except (TypeError, ValueError):
+            # If the error can't be parsed it is normal text (not a
+            # json object) which means its a more fundamental error
+            message = message or ''
+        else:
+            if not isinstance(message, dict):
+                message = unicode(message)
+
+        errors, warnings = count_errors_and_warnings(message)
+        error_count += errors
+        warning_count += warnings
+
+        gather_errors_list.append(message)
+
+    return {
+        'errors': error_count,
+        'warnings': warning_count,
+        'resources': gather_errors_list
+    }
+
+
+def count_errors_and_warnings(message):
+    '''
+    Return the number of errors and warnings of a parsed gather error
+    message. Plain text messages count as one error.
+    '''
+    if not isinstance(message, dict):
+        return 1, 0
+    errors = message.get('errors')
+    warnings = message.get('warnings')
+    return (len(errors) if type(errors) is list else 0,
+            len(warnings) if type(warnings) is list else 0)
+
+
+def init_tables(e):
+    Base.metadata.create_all(e)
@@ -1,10 +1,18 @@
 import json
+from collections import OrderedDict
 
+import ckan.model as model
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 from ckan.lib.plugins import DefaultOrganizationForm
+import ckan.lib.search.query as search_query
 
 import ckanext.sweden.actions
+from ckanext.sweden import eurovoc
+from ckanext.sweden.dcat import model as dcat_model
+from ckanext.sweden.model import eurovoc as eurovoc_model
+from ckanext.sweden.model import organization_url as organization_url_model
+from ckanext.sweden.model import validation as validation_model
 
 
 class SwedenPlugin(plugins.SingletonPlugin, DefaultOrganizationForm):
@@ -13,15 +21,32 @@ class SwedenPlugin(plugins.SingletonPlugin, DefaultOrganizationForm):
     plugins.implements(plugins.IAuthFunctions)
     plugins.implements(plugins.IRoutes, inherit=True)
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.IPackageController, inherit=True)
     plugins.implements(plugins.IFacets)
     plugins.implements(plugins.IGroupForm, inherit=True)
+    plugins.implements(plugins.IOrganizationController, inherit=True)
 
     # IConfigurer
 
     def update_config(self, config):
         toolkit.add_template_directory(config, 'templates')
 
+    # IConfigurable
+
+    def configure(self, config):
+        self._facets = parse_facets(config.get('ckanext.sweden.facets'))
+        self._facets_cache = {}
+
+        # Let the per field facet limits through to Solr
+        search_query.VALID_SOLR_PARAMETERS.update(
+            _facet_limit_param(name) for name, limit in self._facets if limit)
+
+        eurovoc_model.init_tables(model.meta.engine)
+        validation_model.init_tables(model.meta.engine)
+        organization_url_model.init_tables(model.meta.engine)
+        dcat_model.init_tables(model.meta.engine)
+
     # IRoutes
     def before_map(self, _map):
 
@@ -29,7 +54,7 @@ class SwedenPlugin(plugins.SingletonPlugin, DefaultOrganizationForm):
 
         _map.connect('dcat_organization', '/organization/{_id}/dcat.{_format}',
                      controller=controller, action='read_organization',
-                     requirements={'_format': 'xml|rdf|n3|ttl'})
+                     requirements={'_format': 'xml|rdf|n3|ttl|nt'})
         _map.connect('dcat_validation',
                      '/organization/{_id}/dcat_validation.json',
                      controller=controller,
@@ -41,53 +66,132 @@ class SwedenPlugin(plugins.SingletonPlugin, DefaultOrganizationForm):
 
     def after_show(self, context, pkg_dict):
         '''
-        Take the URI value for `theme` populated by dcat, transform it into a
-        Eurovoc category label, and use it as the value for eurovoc category.
+        Take the URI value for `theme` populated by dcat, and use it as the
+        value for eurovoc category.
+
+        Datasets read from the search index already have it, and its label,
+        worked out when they were indexed (see `before_index`).
+        '''
+        if 'eurovoc_category_label' in pkg_dict:
+            return pkg_dict
+        for extra in pkg_dict.get('extras', []):
+            if extra['key'] == 'theme':
+                category = eurovoc.category_from_theme(extra['value'])
+                if category:
+                    pkg_dict['eurovoc_category'] = category
+                break
+        return pkg_dict
+
+    def before_index(self, pkg_dict):
+        '''
+        Work out the Eurovoc category of the dataset and its label, and store
+        them in the index, so they can be faceted on and are part of the
+        datasets read from it without working them out again.
+
+        Also keep track of the Eurovoc category of each public, active
+        dataset, so the weekly stats can be grouped by category without
+        searching for the datasets in each of them.
         '''
-        theme_dict = next((i for i in pkg_dict.get('extras', [])
-                           if i['key'] == 'theme'), {})
-        theme = theme_dict.get('value', None)
-        if theme is not None:
-            try:
-                theme_list = json.loads(theme)
-            except ValueError:
-                theme_list = [theme]
-            pkg_dict['eurovoc_category'] = theme_list[0]
+        if pkg_dict.get('type', 'dataset') != 'dataset':
+            return pkg_dict
+
+        category = pkg_dict.get('eurovoc_category') or \
+            eurovoc.category_from_theme(pkg_dict.get('extras_theme'))
+        label = eurovoc.get_label(category) or \
+            pkg_dict.get('eurovoc_category_label')
+        if category:
+            pkg_dict['eurovoc_category'] = category
+            if label:
+                pkg_dict['eurovoc_category_label'] = label
+
+            # The dataset dicts returned by searches
+            for key in ('validated_data_dict', 'data_dict'):
+                if not pkg_dict.get(key):
+                    continue
+                data_dict = json.loads(pkg_dict[key])
+                data_dict['eurovoc_category'] = category
+                if label:
+                    data_dict['eurovoc_category_label'] = label
+                pkg_dict[key] = json.dumps(data_dict)
+
+        # The stats are the same for all users, so private and draft
+        # datasets are left out
+        if pkg_dict.get('private') or \
+                pkg_dict.get('state', 'active') != 'active':
+            category = label = None
+        eurovoc_model.set_package_eurovoc_category(
+            pkg_dict['id'], category, label)
         return pkg_dict
 
+    def after_delete(self, context, pkg_dict):
+        # Called before the dataset is deleted, the row is deleted when the
+        # action commits. The id passed may be the dataset name.
+        package = model.Package.get(pkg_dict.get('id'))
+        if package:
+            eurovoc_model.set_package_eurovoc_category(package.id, None,
+                                                       None)
+
+    # IOrganizationController
+
+    def create(self, entity):
+        self._set_organization_url(entity)
+
+    def edit(self, entity):
+        self._set_organization_url(entity)
+
+    def _set_organization_url(self, entity):
+        '''
+        Keep the URL of organizations in the indexed table the uniqueness
+        of new URLs is checked against.
+
+        IPackageController calls these same methods with datasets.
+        '''
+        if isinstance(entity, model.Group) and entity.is_organization:
+            organization_url_model.set_organization_url(
+                entity.id, entity.extras.get('url'))
+
     # IFacets
 
     def dataset_facets(self, facets_dict, package_type):
-        facets_dict = self._update_facets(facets_dict)
-        return facets_dict
+        return self._update_facets(facets_dict, 'dataset')
 
     def group_facets(self, facets_dict, group_type, package_type):
-        facets_dict = self._update_facets(facets_dict)
-        return facets_dict
+        return self._update_facets(facets_dict, group_type)
 
     def organization_facets(self, facets_dict, organization_type,
                             package_type):
-        facets_dict = self._update_facets(facets_dict)
-        return facets_dict
-
-    def _update_facets(self, facets_dict):
-        '''Add `eurovoc_category_label` and change its position.'''
+        return self._update_facets(facets_dict, organization_type)
 
-        new_position = 1  # new zero indexed position
-        eurovoc_facet = {'eurovoc_category_label':
-                         plugins.toolkit._('Eurovoc Categories')}
+    def _update_facets(self, facets_dict, search_type):
+        '''
+        Return the facets to show, as set in `ckanext.sweden.facets`, or the
+        default ones with `eurovoc_category_label` added in second place.
 
-        if 'eurovoc_category_label' in facets_dict:
-            del facets_dict['eurovoc_category_label']
+        The layout is worked out once for each search type, language and set
+        of facets passed in, and a copy of it returned afterwards, as other
+        plugins may still change it.
+        '''
+        key = (search_type, _current_language(), tuple(facets_dict))
+        layout = self._facets_cache.get(key)
+        if layout is None:
+            layout = self._facets_cache[key] = _facets_layout(
+                facets_dict, self._facets)
+        return OrderedDict(layout)
 
-        old_facets = facets_dict.copy()
-        facets_dict.clear()
-        for i, facet in enumerate(old_facets):
-            if i == new_position:
-                facets_dict.update(eurovoc_facet)
-            facets_dict.update({facet: old_facets[facet]})
+    # IPackageController (facet limits)
 
-        return facets_dict
+    def before_search(self, search_params):
+        '''
+        Ask Solr for the configured number of values of each facet with a
+        limit, leaving the limit of the rest as it is. Searches asking for
+        all the values (a negative `facet.limit`) get them.
+        '''
+        if int(search_params.get('facet.limit', 0)) < 0:
+            return search_params
+        for name, limit in self._facets:
+            if limit:
+                search_params.setdefault(_facet_limit_param(name), limit)
+        return search_params
 
     # IGroupForm
 
@@ -154,6 +258,57 @@ class SwedenPlugin(plugins.SingletonPlugin, DefaultOrganizationForm):
         return auth_functions
 
 
+# Facets
+
+# Position of `eurovoc_category_label` in the default facets (zero indexed)
+EUROVOC_FACET_POSITION = 1
+
+
+def parse_facets(value):
+    '''
+    Parse the `ckanext.sweden.facets` option, a list of facet fields in the
+    order they are shown, each of them optionally followed by `:` and the
+    maximum number of values returned for it, e.g.
+    `organization eurovoc_category_label:20 tags`. Returns a list of
+    (field, limit) tuples, with None for facets without a limit.
+    '''
+    facets = []
+    for item in toolkit.aslist(value):
+        name, _, limit = item.partition(':')
+        facets.append((name, int(limit) if limit else None))
+    return facets
+
+
+def _facet_limit_param(name):
+    '''Return the Solr parameter with the limit of a single facet.'''
+    return 'f.{0}.facet.limit'.format(name)
+
+
+def _facets_layout(facets_dict, facets):
+    extra_titles = {
+        'eurovoc_category_label': toolkit._('Eurovoc Categories'),
+    }
+    if not facets:
+        names = [name for name in facets_dict
+                 if name != 'eurovoc_category_label']
+        names.insert(EUROVOC_FACET_POSITION, 'eurovoc_category_label')
+    else:
+        names = [name for name, limit in facets]
+
+    layout = OrderedDict()
+    for name in names:
+        layout[name] = extra_titles.get(name) or facets_dict.get(name) or name
+    return layout
+
+
+def _current_language():
+    try:
+        return toolkit.request.environ.get('CKAN_LANG')
+    except TypeError:
+        # Outside of a request
+        return None
+
+
 # Auth functions
 
 @toolkit.auth_allow_anonymous_access
@@ -167,21 +322,14 @@ def _unique_org_url(key, data, errors, context):
 
     value = data[key]
 
-    model = context['model']
-
-    q = model.Session.query(model.GroupExtra) \
-             .filter(model.GroupExtra.key == 'url') \
-             .filter(model.GroupExtra.value == value)
+    group_id = organization_url_model.find_organization_by_url(value)
+    if not group_id:
+        return
 
     org_id = data.get(('id',), '')
     org = model.Group.get(org_id)
 
-    if org:
-        q = q.filter(model.GroupExtra.group_id != org.id)
-
-    count = q.count()
-
-    if count:
+    if not org or org.id != group_id:
         raise toolkit.Invalid(toolkit._(
             'There already is an organization with this URL: {0}'.format(
                 data[key])))
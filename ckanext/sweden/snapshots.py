@@ -0,0 +1,187 @@
+'''
+Pre-rendered snapshots of the full DCAT catalog of each organization.
+
+The snapshots of an organization are stored in their own directory (under
+`ckanext.sweden.dcat.snapshots_dir`), one file per format plus a gzipped copy
+of each, and a `state` file with the state of the organization datasets they
+were rendered from (see `catalog_state`). Snapshots are only served while
+the state of the organization matches, so dataset changes and harvests make
+them stale straight away, until they are rendered again.
+'''
+import os
+import gzip
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from pylons import config
+from sqlalchemy import func
+
+import ckan.model as model
+
+from ckanext.sweden.actions import _harvest_source_for_org, _last_harvest_jobs
+from ckanext.sweden.streaming import iter_datasets
+
+log = logging.getLogger(__name__)
+
+# The formats of the `dcat_organization` route, and the rdflib format each
+# of them is serialized with
+FORMATS = {
+    'rdf': 'pretty-xml',
+    'xml': 'pretty-xml',
+    'ttl': 'turtle',
+    'n3': 'n3',
+}
+
+STATE_FILE = 'state'
+
+
+def get_snapshots_dir():
+    '''
+    Return the directory the snapshots are stored in, or None if snapshots
+    are not enabled.
+    '''
+    return config.get('ckanext.sweden.dcat.snapshots_dir') or None
+
+
+def catalog_state(org):
+    '''
+    Return a key that changes whenever the DCAT catalog of the organization
+    changes.
+
+    The catalog changes when the organization or one of its public datasets
+    is modified, when datasets are added to or removed from it, and when its
+    harvest source is run.
+    '''
+    last_modified, num_datasets = model.Session.query(
+        func.max(model.Package.metadata_modified),
+        func.count(model.Package.id)) \
+        .filter(model.Package.owner_org == org.id) \
+        .filter(model.Package.state == 'active') \
+        .filter(model.Package.private == False) \
+        .one()
+    last_job = last_harvest_job(org.id)
+    key = hashlib.md5(u'|'.join(unicode(value) for value in (
+        org.id, org.revision_id, last_modified, num_datasets,
+        last_job.id if last_job else None)).encode('utf8')).hexdigest()
+    return key
+
+
+def last_harvest_job(org_id):
+    '''
+    Return the last harvest job of the harvest source of the organization,
+    if any.
+    '''
+    harvest_source = _harvest_source_for_org(org_id)
+    if not harvest_source:
+        return None
+    return _last_harvest_jobs([harvest_source.id]).get(harvest_source.id)
+
+
+def snapshot_path(org_id, _format, state, gzipped=False):
+    '''
+    Return the path to the snapshot of the organization catalog in the given
+    format, if there is an up to date one for `state`, or None otherwise.
+    '''
+    snapshots_dir = get_snapshots_dir()
+    if not snapshots_dir or _format not in FORMATS:
+        return None
+    org_dir = os.path.join(snapshots_dir, org_id)
+    try:
+        with open(os.path.join(org_dir, STATE_FILE)) as f:
+            if f.read().strip() != state:
+                return None
+    except IOError:
+        return None
+    path = os.path.join(org_dir, _catalog_file_name(_format, gzipped))
+    return path if os.path.exists(path) else None
+
+
+def render_snapshots(org_id, force=False):
+    '''
+    Render the catalog of the organization in all formats and write it to
+    the snapshots directory.
+
+    Unless `force` is True, nothing is rendered if the existing snapshots
+    are up to date. Returns True if the snapshots were rendered.
+    '''
+    from ckanext.dcat.processors import RDFSerializer
+
+    snapshots_dir = get_snapshots_dir()
+    if not snapshots_dir:
+        raise RuntimeError(
+            'ckanext.sweden.dcat.snapshots_dir is not set')
+
+    org = model.Group.get(org_id)
+    if not org or not org.is_organization or org.state != 'active':
+        delete_snapshots(org_id)
+        return False
+
+    # Get the state before fetching the datasets, so changes made while
+    # rendering leave the snapshots stale rather than outdated
+    state = catalog_state(org)
+    if not force and snapshot_path(org.id, 'rdf', state):
+        return False
+
+    context = {'model': model, 'session': model.Session, 'user': ''}
+    dataset_dicts = list(iter_datasets(org.id, context, rows=1000))
+    serializer = RDFSerializer()
+    serializer.serialize_catalog({}, dataset_dicts, _format='rdf')
+
+    org_dir = os.path.join(snapshots_dir, org.id)
+    if not os.path.isdir(org_dir):
+        os.makedirs(org_dir)
+
+    outputs = {}
+    for _format, rdflib_format in sorted(FORMATS.iteritems()):
+        if rdflib_format not in outputs:
+            outputs[rdflib_format] = serializer.g.serialize(
+                format=rdflib_format)
+        output = outputs[rdflib_format]
+        _write_atomically(
+            os.path.join(org_dir, _catalog_file_name(_format)), output)
+        _write_atomically(
+            os.path.join(org_dir, _catalog_file_name(_format, True)),
+            output, gzipped=True)
+
+    # Written last, so the snapshots are only served once all of them are
+    _write_atomically(os.path.join(org_dir, STATE_FILE), state)
+
+    log.info('Rendered the DCAT snapshots of organization {0} '
+             '({1} datasets)'.format(org.name, len(dataset_dicts)))
+    return True
+
+
+def delete_snapshots(org_id):
+    snapshots_dir = get_snapshots_dir()
+    if not snapshots_dir:
+        return
+    org_dir = os.path.join(snapshots_dir, org_id)
+    if os.path.isdir(org_dir):
+        shutil.rmtree(org_dir, ignore_errors=True)
+
+
+def _catalog_file_name(_format, gzipped=False):
+    return 'catalog.{0}{1}'.format(_format, '.gz' if gzipped else '')
+
+
+def _write_atomically(path, content, gzipped=False):
+    '''
+    Write `content` to a temporary file in the same directory and move it
+    to `path` once done, so readers never see a partially written file.
+    '''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if gzipped:
+                with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                    gz.write(content)
+            else:
+                f.write(content)
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
@@ -0,0 +1,80 @@
+'''
+Streaming serialization of the full DCAT catalog of an organization.
+
+Instead of building a graph with all the datasets, the catalog is written one
+dataset at a time, in formats where chunks can just be concatenated (each
+Turtle chunk declares the prefixes it uses, which Turtle allows to be
+repeated). Memory use doesn't depend on the number of datasets.
+'''
+import logging
+
+import rdflib
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+
+log = logging.getLogger(__name__)
+
+DCAT = rdflib.Namespace('http://www.w3.org/ns/dcat#')
+
+# The formats that can be streamed, and the rdflib format of each of them
+FORMATS = {
+    'nt': 'nt',
+    'ttl': 'turtle',
+    'n3': 'n3',
+}
+
+CONTENT_TYPES = {
+    'nt': 'application/n-triples',
+}
+
+
+def iter_datasets(org_id, context, rows=100):
+    '''
+    Yield all the public datasets of the organization, as returned by
+    `package_search`, sorted by name.
+
+    Results are paged by name rather than with `start`, so Solr doesn't have
+    to go through all the previous pages to get each of them.
+    '''
+    last_name = None
+    while True:
+        fq = '+owner_org:{0} +capacity:public'.format(org_id)
+        if last_name:
+            fq += ' +name:{{"{0}" TO *]'.format(last_name.replace('"', '\\"'))
+        search = toolkit.get_action('package_search')(dict(context), {
+            'fq': fq,
+            'rows': rows,
+            'sort': 'name asc',
+        })
+        for dataset_dict in search['results']:
+            yield dataset_dict
+        if len(search['results']) < rows:
+            break
+        last_name = search['results'][-1]['name']
+
+
+def iter_catalog(org_id, _format, context):
+    '''
+    Yield the DCAT catalog of the organization in the given format (one of
+    `FORMATS`), in chunks of one dataset each.
+
+    The first chunk describes the catalog itself.
+    '''
+    from ckanext.dcat.processors import RDFSerializer
+
+    rdflib_format = FORMATS[_format]
+    serializer = RDFSerializer()
+    try:
+        catalog_ref = serializer.graph_from_catalog({})
+        yield serializer.g.serialize(format=rdflib_format)
+
+        for dataset_dict in iter_datasets(org_id, context):
+            serializer.g = rdflib.Graph()
+            dataset_ref = serializer.graph_from_dataset(dataset_dict)
+            serializer.g.add((catalog_ref, DCAT.dataset, dataset_ref))
+            yield serializer.g.serialize(format=rdflib_format)
+    finally:
+        # This is run once the request is over, so get rid of the session
+        # used, if any
+        model.Session.remove()
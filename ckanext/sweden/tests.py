@@ -1,6 +1,17 @@
+import json
+import Queue
+import shutil
+import datetime
+import tempfile
+from collections import OrderedDict
+
+import rdflib
+
 from pylons import config
 from nose import tools as nosetools
 import ckan.logic as logic
+import ckan.model as model
+import ckan.plugins as plugins
 try:
     import ckan.tests.factories as factories
     import ckan.tests.helpers as helpers
@@ -9,6 +20,17 @@ except ImportError:
     import ckan.new_tests.factories as factories
     import ckan.new_tests.helpers as helpers
 
+from ckanext.sweden.cache import (MemoryCache, MISSING, cached, get_backend,
+                                  make_key)
+from ckanext.sweden import eurovoc
+from ckanext.sweden.plugin import _facets_layout, parse_facets
+from ckanext.sweden import snapshots
+from ckanext.sweden import streaming
+from ckanext.sweden.dcat import validation
+from ckanext.sweden.dcat.model import UnchangedHarvestJob
+from ckanext.sweden.model import organization_url
+from ckanext.sweden.model.validation import (ValidationSummary,
+                                             update_validation_summary)
 
 assert_equal = nosetools.assert_equal
 assert_true = nosetools.assert_true
@@ -77,6 +99,458 @@ class TestDcatOrganizationList(helpers.FunctionalTestBase):
         assert_equal(len(dcat_org_list), 0)
 
 
+class TestDcatValidation(helpers.FunctionalTestBase):
+
+    def _create_job(self, org, messages, gather_finished=None,
+                    summary=False):
+        from ckanext.harvest.model import HarvestJob, HarvestGatherError
+
+        source = factories.Dataset(owner_org=org['id'],
+                                   type='harvest',
+                                   source_type='dcat_rdf',
+                                   url='http://example.com/source')
+        job = HarvestJob(source_id=source['id'], status=u'Finished',
+                         gather_finished=gather_finished)
+        job.save()
+        for message in messages:
+            HarvestGatherError(message=message, job=job).save()
+        if summary:
+            # As stored by the harvester at the end of the gather stage
+            update_validation_summary(job.id)
+            model.Session.commit()
+        return job
+
+    def test_dcat_validation_counts_errors_and_warnings(self):
+        org = factories.Organization(url='http://example.com/url')
+        self._create_job(org, [
+            'Error contacting the validation service',
+            json.dumps({'uri': 'http://example.com/ds1',
+                        'errors': [{'path': 'dcterms:title', 'code': 'few'}],
+                        'warnings': [{'path': 'dcat:keyword', 'code': 'few'},
+                                     {'path': 'dcat:theme', 'code': 'few'}]}),
+        ])
+
+        validation = helpers.call_action('dcat_validation', id=org['id'])
+
+        assert_equal(validation['result']['errors'], 2)
+        assert_equal(validation['result']['warnings'], 2)
+        assert_equal(len(validation['result']['resources']), 2)
+
+    def test_dcat_validation_uses_stored_summary(self):
+        org = factories.Organization(url='http://example.com/url')
+        job = self._create_job(org, ['Some error', 'Another error'],
+                               gather_finished=datetime.datetime.now(),
+                               summary=True)
+        summary = ValidationSummary.get(job.id)
+        summary.errors = 5
+        model.Session.commit()
+
+        validation = helpers.call_action('dcat_validation', id=org['id'])
+
+        assert_equal(validation['result']['errors'], 5)
+        assert_equal(validation['result']['resources'],
+                     ['Some error', 'Another error'])
+
+    def test_dcat_validation_does_not_store_summary(self):
+        org = factories.Organization(url='http://example.com/url')
+        job = self._create_job(org, ['Some error', 'Another error'],
+                               gather_finished=datetime.datetime.now())
+
+        validation = helpers.call_action('dcat_validation', id=org['id'])
+
+        assert_equal(validation['result']['errors'], 2)
+        assert_equal(ValidationSummary.get(job.id), None)
+
+    def test_dcat_validation_offset_limit_and_severity(self):
+        org = factories.Organization(url='http://example.com/url')
+        warning = {'path': 'dcat:keyword', 'code': 'few'}
+        error = {'path': 'dcterms:title', 'code': 'few'}
+        messages = [
+            {'uri': 'http://example.com/ds1', 'errors': [error],
+             'warnings': []},
+            {'uri': 'http://example.com/ds2', 'errors': [],
+             'warnings': [warning]},
+            {'uri': 'http://example.com/ds3', 'errors': [error],
+             'warnings': [warning]},
+        ]
+        for summary in (False, True):
+            self._create_job(org, [json.dumps(m) for m in messages],
+                             gather_finished=datetime.datetime.now(),
+                             summary=summary)
+
+            result = helpers.call_action('dcat_validation', id=org['id'],
+                                         offset=1, limit=1)['result']
+            assert_equal(result['resources_count'], 3)
+            assert_equal(result['resources'], messages[1:2])
+
+            result = helpers.call_action('dcat_validation', id=org['id'],
+                                         severity='warnings')['result']
+            assert_equal(result['errors'], 2)
+            assert_equal(result['resources_count'], 2)
+            assert_equal(result['resources'], messages[1:])
+
+    def test_dcat_validation_invalid_severity(self):
+        org = factories.Organization(url='http://example.com/url')
+        self._create_job(org, [])
+
+        assert_raises(logic.ValidationError, helpers.call_action,
+                      'dcat_validation', id=org['id'], severity='fatal')
+
+    def test_dcat_validation_streamed(self):
+        org = factories.Organization(url='http://example.com/url')
+        self._create_job(org, ['Some error', 'Another error'],
+                         gather_finished=datetime.datetime.now(),
+                         summary=True)
+
+        app = self._get_test_app()
+        response = app.get(
+            url='/organization/{0}/dcat_validation.json?limit=1'.format(
+                org['name']))
+
+        result = json.loads(response.body)['result']
+        assert_equal(result['resources_count'], 2)
+        assert_equal(result['resources'], ['Some error'])
+
+    def test_dcat_validation_not_modified(self):
+        org = factories.Organization(url='http://example.com/url')
+        self._create_job(org, ['Some error'],
+                         gather_finished=datetime.datetime.utcnow(),
+                         summary=True)
+
+        app = self._get_test_app()
+        url = '/organization/{0}/dcat_validation.json'.format(org['name'])
+        response = app.get(url=url)
+
+        etag = response.headers['ETag']
+        assert_true(response.headers['Last-Modified'])
+        assert_true(response.headers['Cache-Control'])
+
+        response = app.get(url=url, headers={'If-None-Match': etag},
+                           status=304)
+        assert_equal(response.body, '')
+
+        app.get(url=url + '?limit=1', headers={'If-None-Match': etag},
+                status=200)
+
+    def test_dcat_validation_not_cached_while_gathering(self):
+        org = factories.Organization(url='http://example.com/url')
+        self._create_job(org, ['Some error'])
+
+        app = self._get_test_app()
+        response = app.get(
+            url='/organization/{0}/dcat_validation.json'.format(org['name']))
+
+        assert 'ETag' not in response.headers
+
+    def test_dcat_validation_not_cached_while_validating(self):
+        org = factories.Organization(url='http://example.com/url')
+        self._create_job(org, ['Some error'],
+                         gather_finished=datetime.datetime.utcnow())
+
+        app = self._get_test_app()
+        response = app.get(
+            url='/organization/{0}/dcat_validation.json'.format(org['name']))
+
+        assert 'ETag' not in response.headers
+
+    def test_dcat_validation_etag_changes_with_the_summary(self):
+        org = factories.Organization(url='http://example.com/url')
+        job = self._create_job(org, [],
+                               gather_finished=datetime.datetime.utcnow(),
+                               summary=True)
+
+        app = self._get_test_app()
+        url = '/organization/{0}/dcat_validation.json'.format(org['name'])
+        etag = app.get(url=url).headers['ETag']
+
+        validation.save_gather_errors(job.id, ['Some error'])
+
+        response = app.get(url=url, headers={'If-None-Match': etag},
+                           status=200)
+        assert_equal(json.loads(response.body)['result']['errors'], 1)
+
+    def test_async_validation_errors_are_added_to_the_job(self):
+        from ckanext.harvest.model import HarvestGatherError
+
+        org = factories.Organization(url='http://example.com/url')
+        job = self._create_job(org, [],
+                               gather_finished=datetime.datetime.now(),
+                               summary=True)
+        assert_equal(ValidationSummary.get(job.id).errors, 0)
+
+        validation.validate_async('Not RDF', 'local', job.id)
+        validation.wait_for_validations()
+
+        model.Session.expire_all()
+        errors = model.Session.query(HarvestGatherError) \
+            .filter(HarvestGatherError.harvest_job_id == job.id).all()
+        assert_equal(len(errors), 1)
+        assert_equal(ValidationSummary.get(job.id).errors, 1)
+
+        result = helpers.call_action('dcat_validation', id=org['id'])
+        assert_equal(result['result']['errors'], 1)
+
+    def test_documents_are_validated_when_the_queue_is_full(self):
+        org = factories.Organization(url='http://example.com/url')
+        job = self._create_job(org, [],
+                               gather_finished=datetime.datetime.now(),
+                               summary=True)
+        original_queue = validation._queue
+        validation._queue = Queue.Queue(maxsize=1)
+        validation._queue.put(None)
+        try:
+            validation.validate_async('Not RDF', 'local', job.id)
+        finally:
+            validation._queue = original_queue
+
+        model.Session.expire_all()
+        assert_equal(ValidationSummary.get(job.id).errors, 1)
+
+    def test_dcat_validation_of_unchanged_job(self):
+        from ckanext.harvest.model import HarvestJob
+
+        org = factories.Organization(url='http://example.com/url')
+        job = self._create_job(org, ['Some error'],
+                               gather_finished=datetime.datetime.now())
+        unchanged_job = HarvestJob(source_id=job.source_id,
+                                   status=u'Finished',
+                                   gather_finished=datetime.datetime.now())
+        unchanged_job.save()
+        model.Session.add(UnchangedHarvestJob(harvest_job_id=unchanged_job.id,
+                                              reference_job_id=job.id))
+        model.Session.commit()
+
+        result = helpers.call_action('dcat_validation', id=org['id'])['result']
+
+        assert_true(result['unchanged'])
+        assert_equal(result['reference_job_id'], job.id)
+        assert_equal(result['errors'], 1)
+        assert_equal(result['resources'], ['Some error'])
+
+        dcat_org_list = helpers.call_action('dcat_organization_list')
+        assert_equal(dcat_org_list[0]['dcat_validation'], False)
+
+    def test_dcat_organization_list_uses_last_job(self):
+        org = factories.Organization(url='http://example.com/url')
+        self._create_job(org, [])
+
+        dcat_org_list = helpers.call_action('dcat_organization_list')
+
+        assert_equal(len(dcat_org_list), 1)
+        assert_equal(dcat_org_list[0]['dcat_validation'], True)
+
+
+class TestSnapshots(helpers.FunctionalTestBase):
+
+    def setup(self):
+        super(TestSnapshots, self).setup()
+        self.snapshots_dir = tempfile.mkdtemp()
+        config['ckanext.sweden.dcat.snapshots_dir'] = self.snapshots_dir
+
+    def teardown(self):
+        config.pop('ckanext.sweden.dcat.snapshots_dir', None)
+        shutil.rmtree(self.snapshots_dir)
+
+    def test_render_snapshots(self):
+        org = factories.Organization()
+        factories.Dataset(owner_org=org['id'])
+
+        assert_true(snapshots.render_snapshots(org['id']))
+        # Already up to date
+        assert_equal(snapshots.render_snapshots(org['id']), False)
+
+        state = snapshots.catalog_state(model.Group.get(org['id']))
+        for _format in snapshots.FORMATS:
+            assert_true(snapshots.snapshot_path(org['id'], _format, state))
+            assert_true(snapshots.snapshot_path(org['id'], _format, state,
+                                                gzipped=True))
+
+    def test_snapshots_are_stale_after_changes(self):
+        org = factories.Organization()
+        factories.Dataset(owner_org=org['id'])
+        snapshots.render_snapshots(org['id'])
+
+        factories.Dataset(owner_org=org['id'])
+
+        state = snapshots.catalog_state(model.Group.get(org['id']))
+        assert_equal(snapshots.snapshot_path(org['id'], 'ttl', state), None)
+
+    def test_snapshot_is_served(self):
+        org = factories.Organization()
+        factories.Dataset(owner_org=org['id'])
+        snapshots.render_snapshots(org['id'])
+
+        state = snapshots.catalog_state(model.Group.get(org['id']))
+        with open(snapshots.snapshot_path(org['id'], 'ttl', state)) as f:
+            snapshot = f.read()
+
+        app = self._get_test_app()
+        response = app.get(
+            url='/organization/{0}/dcat.ttl'.format(org['name']))
+
+        assert_equal(response.body, snapshot)
+
+    def test_gzipped_snapshot_has_its_own_etag(self):
+        org = factories.Organization()
+        factories.Dataset(owner_org=org['id'])
+        snapshots.render_snapshots(org['id'])
+
+        app = self._get_test_app()
+        url = '/organization/{0}/dcat.ttl'.format(org['name'])
+        response = app.get(url=url)
+        gzipped_response = app.get(url=url,
+                                   headers={'Accept-Encoding': 'gzip'})
+
+        assert_equal(gzipped_response.headers['Content-Encoding'], 'gzip')
+        assert_true(response.headers['ETag'] !=
+                    gzipped_response.headers['ETag'])
+        for r in (response, gzipped_response):
+            assert_equal(r.headers['Vary'], 'Accept-Encoding')
+            assert 'Last-Modified' not in r.headers
+
+
+class TestStreaming(helpers.FunctionalTestBase):
+
+    def test_iter_datasets_pages_by_name(self):
+        org = factories.Organization()
+        for name in ('dataset-c', 'dataset-a', 'dataset-b'):
+            factories.Dataset(name=name, owner_org=org['id'])
+
+        datasets = streaming.iter_datasets(org['id'], {'user': ''}, rows=2)
+
+        assert_equal([dataset['name'] for dataset in datasets],
+                     ['dataset-a', 'dataset-b', 'dataset-c'])
+
+    def test_streamed_catalog(self):
+        org = factories.Organization()
+        for i in range(3):
+            factories.Dataset(owner_org=org['id'])
+
+        app = self._get_test_app()
+        for _format, rdflib_format in (('nt', 'nt'), ('ttl', 'turtle')):
+            response = app.get(
+                url='/organization/{0}/dcat.{1}?stream=1'.format(
+                    org['name'], _format))
+
+            g = rdflib.Graph()
+            g.parse(data=response.body, format=rdflib_format)
+            dcat = rdflib.Namespace('http://www.w3.org/ns/dcat#')
+            assert_equal(len(list(g.subjects(rdflib.RDF.type,
+                                             dcat.Dataset))), 3)
+            assert_equal(len(list(g.objects(None, dcat.dataset))), 3)
+
+    def test_rdf_xml_cant_be_streamed(self):
+        org = factories.Organization()
+
+        app = self._get_test_app()
+        app.get(url='/organization/{0}/dcat.rdf?stream=1'.format(org['name']),
+                status=409)
+
+
+class TestEurovocCategory(helpers.FunctionalTestBase):
+
+    def test_category_from_theme(self):
+        dataset = factories.Dataset(extras=[
+            {'key': 'theme',
+             'value': json.dumps(['http://eurovoc.europa.eu/100142',
+                                  'http://eurovoc.europa.eu/100155'])}])
+
+        dataset = helpers.call_action('package_show', id=dataset['id'])
+
+        assert_equal(dataset['eurovoc_category'],
+                     'http://eurovoc.europa.eu/100142')
+
+    def test_category_label_is_indexed(self):
+        dataset = factories.Dataset(extras=[
+            {'key': 'theme', 'value': 'http://eurovoc.europa.eu/100155'}])
+        factories.Dataset()
+
+        result = helpers.call_action(
+            'package_search', fq='eurovoc_category_label:"Environment"')
+
+        assert_equal(result['count'], 1)
+        assert_equal(result['results'][0]['id'], dataset['id'])
+        assert_equal(result['results'][0]['eurovoc_category_label'],
+                     'Environment')
+
+    def test_only_public_active_datasets_are_stored(self):
+        from ckanext.sweden.model.eurovoc import PackageEurovocCategory
+
+        org = factories.Organization()
+        extras = [{'key': 'theme', 'value': 'http://eurovoc.europa.eu/100155'}]
+        datasets = [
+            factories.Dataset(extras=extras),
+            factories.Dataset(extras=extras, owner_org=org['id'],
+                              private=True),
+            factories.Dataset(extras=extras, state='draft'),
+        ]
+        public = datasets[0]
+
+        stored = [package_id for package_id, in
+                  model.Session.query(PackageEurovocCategory.package_id)
+                  .filter(PackageEurovocCategory.package_id.in_(
+                      [dataset['id'] for dataset in datasets]))]
+
+        assert_equal(stored, [public['id']])
+
+    def test_deleted_dataset_is_removed(self):
+        from ckanext.sweden.model.eurovoc import PackageEurovocCategory
+
+        dataset = factories.Dataset(extras=[
+            {'key': 'theme', 'value': 'http://eurovoc.europa.eu/100155'}])
+
+        # By name, not id
+        helpers.call_action('package_delete', id=dataset['name'])
+
+        assert_equal(model.Session.query(PackageEurovocCategory)
+                     .filter(PackageEurovocCategory.package_id ==
+                             dataset['id']).count(), 0)
+
+    def test_label_language(self):
+        assert_equal(eurovoc.get_label('http://eurovoc.europa.eu/100155',
+                                       'sv'), u'Milj\xf6')
+        assert_equal(eurovoc.get_label('http://example.com/category'), None)
+
+
+class TestFacets(object):
+
+    facets_dict = OrderedDict([('organization', 'Organizations'),
+                               ('groups', 'Groups'),
+                               ('tags', 'Tags')])
+
+    def test_parse_facets(self):
+        assert_equal(parse_facets('tags eurovoc_category_label:20'),
+                     [('tags', None), ('eurovoc_category_label', 20)])
+        assert_equal(parse_facets(None), [])
+
+    def test_default_layout(self):
+        layout = _facets_layout(self.facets_dict, [])
+
+        assert_equal(layout.keys(), ['organization', 'eurovoc_category_label',
+                                     'groups', 'tags'])
+
+    def test_configured_layout(self):
+        layout = _facets_layout(self.facets_dict,
+                                parse_facets('tags organization'))
+
+        assert_equal(layout.items(), [('tags', 'Tags'),
+                                      ('organization', 'Organizations')])
+
+    def test_facet_limits(self):
+        plugin = plugins.get_plugin('sweden')
+        original_facets = plugin._facets
+        plugin._facets = parse_facets('tags:2 organization')
+        try:
+            search_params = plugin.before_search({'facet.limit': 1})
+            all_values = plugin.before_search({'facet.limit': -1})
+        finally:
+            plugin._facets = original_facets
+
+        assert_equal(search_params, {'facet.limit': 1,
+                                     'f.tags.facet.limit': 2})
+        assert_equal(all_values, {'facet.limit': -1})
+
+
 class TestOrgSchema(object):
 
     @classmethod
@@ -136,3 +610,114 @@ class TestOrgSchema(object):
 
         assert_raises(logic.ValidationError, helpers.call_action, 'organization_update',
                       name='org2', url=url)
+
+    def test_url_field_cant_create_normalized_duplicate(self):
+        factories.Organization(name='org1', url='http://org1.com/data')
+
+        assert_raises(logic.ValidationError, helpers.call_action,
+                      'organization_create', name='org2',
+                      url='https://ORG1.com/data/')
+
+    def test_url_of_deleted_organization_can_be_reused(self):
+        org = factories.Organization(name='org1', url='http://org1.com')
+        helpers.call_action('organization_delete', id=org['id'])
+
+        factories.Organization(name='org2', url='http://org1.com')
+
+        org = helpers.call_action('organization_show', id='org2')
+        assert_equal(org['url'], 'http://org1.com')
+
+    def test_migrate_organization_urls(self):
+        org1 = factories.Organization(name='org1', url='http://org1.com')
+        factories.Organization(name='org2', url='http://org2.com')
+        # Organizations saved before the URLs were checked this way
+        org3 = factories.Organization(name='org3', url='http://org3.com')
+        model.repo.new_revision()
+        model.Group.get(org3['id']).extras['url'] = u'https://org1.com'
+        model.repo.commit_and_remove()
+
+        duplicates = organization_url.migrate_organization_urls()
+
+        assert_equal(duplicates, {'org1.com': ['org1', 'org3']})
+        assert_equal(
+            organization_url.find_organization_by_url('http://org1.com'),
+            org1['id'])
+
+
+class TestMemoryCache(object):
+
+    def test_get_missing(self):
+        cache = MemoryCache()
+
+        assert_true(cache.get('key') is MISSING)
+
+    def test_set_and_get(self):
+        cache = MemoryCache()
+        cache.set('key', None, 60)
+
+        assert_equal(cache.get('key'), None)
+
+    def test_expired_entries_are_missing(self):
+        cache = MemoryCache()
+        cache.set('key', 'value', -1)
+
+        assert_true(cache.get('key') is MISSING)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = MemoryCache(max_entries=2)
+        cache.set('a', 1, 60)
+        cache.set('b', 2, 60)
+        cache.get('a')
+        cache.set('c', 3, 60)
+
+        assert_equal(cache.get('a'), 1)
+        assert_true(cache.get('b') is MISSING)
+        assert_equal(cache.get('c'), 3)
+
+
+class TestCachedDecorator(object):
+
+    def setup(self):
+        get_backend().clear()
+        self.calls = []
+        self.original_ttl = config.get('ckanext.sweden.cache.ttl')
+        config['ckanext.sweden.cache.ttl'] = 60
+
+    def teardown(self):
+        if self.original_ttl is None:
+            config.pop('ckanext.sweden.cache.ttl', None)
+        else:
+            config['ckanext.sweden.cache.ttl'] = self.original_ttl
+
+    def test_results_are_cached(self):
+
+        @cached(per_user=False)
+        def expensive(value):
+            self.calls.append(value)
+            return value
+
+        assert_equal(expensive(1), 1)
+        assert_equal(expensive(1), 1)
+        assert_equal(expensive(2), 2)
+
+        assert_equal(self.calls, [1, 2])
+
+    def test_zero_ttl_disables_cache(self):
+        config['ckanext.sweden.cache.ttl'] = 0
+
+        @cached(per_user=False)
+        def expensive(value):
+            self.calls.append(value)
+            return value
+
+        expensive(1)
+        expensive(1)
+
+        assert_equal(self.calls, [1, 1])
+
+    def test_keys_differ_per_permission_context(self):
+        anonymous_key = make_key('helper', per_user=True)
+        shared_key = make_key('helper', per_user=False)
+
+        assert_true('anonymous' in anonymous_key)
+        assert_true('anonymous' not in shared_key)
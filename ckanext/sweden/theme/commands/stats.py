@@ -0,0 +1,51 @@
+import logging
+
+from ckan.lib.cli import CkanCommand
+# No other CKAN imports allowed until _load_config is run,
+# or logging is disabled
+
+
+class StatsCommand(CkanCommand):
+    """Manage the weekly dataset statistics used by the homepage charts
+
+    Usage:
+
+        sweden_stats init
+            Create the weekly stats tables
+
+        sweden_stats refresh [--full]
+            Update the weekly stats with the revisions made since the last
+            refresh (run it periodically, e.g. from cron). With --full, all
+            the weekly stats are rebuilt from scratch.
+    """
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 1
+    min_args = 1
+
+    def __init__(self, name):
+        super(StatsCommand, self).__init__(name)
+        self.parser.add_option('--full', dest='full', action='store_true',
+                               default=False,
+                               help='Rebuild all the weekly stats')
+
+    def command(self):
+        """
+        """
+        self._load_config()
+        log = logging.getLogger(__name__)
+
+        import ckan.model as model
+        import ckanext.sweden.theme.model.stats as stats_model
+        from ckanext.sweden.theme import helpers
+
+        cmd = self.args[0]
+        if cmd == 'init':
+            stats_model.init_tables(model.meta.engine)
+            log.info("Weekly stats DB tables are setup")
+        elif cmd == 'refresh':
+            stats_model.init_tables(model.meta.engine)
+            helpers.refresh_weekly_stats(full=self.options.full)
+        else:
+            print 'Command {0} not recognized'.format(cmd)
+            print self.usage
@@ -1,37 +1,60 @@
 import random
-from itertools import groupby
+import logging
 import datetime
 import calendar
-from sqlalchemy import Table, select, func, and_
+from sqlalchemy import Table, select, func, and_, distinct
 
 from ckan.plugins import toolkit
 import ckan.model as model
 
+from ckanext.sweden.cache import cached
+from ckanext.sweden.model.eurovoc import PackageEurovocCategory
+from ckanext.sweden.theme.model.stats import (WeeklyStat, WeeklyStatsState,
+                                              SERIES_NEW, SERIES_CUMULATIVE,
+                                              SERIES_ACTIVITY,
+                                              EUROVOC_SERIES_PREFIX)
+
+log = logging.getLogger(__name__)
+
 
 def table(name):
     return Table(name, model.meta.metadata, autoload=True)
 
 
-def get_new_datasets(pkg_ids=None):
+def _new_datasets_query(pkg_ids=None, since=None):
     '''
-    Return a list of new pkgs and date when they were created,
-    in format: [(id, datetime), ...]
-
-    If pkg_ids list is passed, limit query to just those packages.
+    Return a select of (id, created datetime) pairs for each dataset, where
+    the creation datetime is the timestamp of its first revision.
     '''
     # Can't filter by time in select because 'min' function has to
     # be 'for all time' else you get first revision in the time period.
     package_revision = table('package_revision')
     revision = table('revision')
-    s = select([package_revision.c.id, func.min(revision.c.timestamp)],
+    created = func.min(revision.c.timestamp)
+    s = select([package_revision.c.id, created.label('created')],
                from_obj=[package_revision.join(revision)])
     if pkg_ids:
         s = s.where(and_(package_revision.c.id.in_(pkg_ids),
                          package_revision.c.type == 'dataset'))
     else:
         s = s.where(package_revision.c.type == 'dataset')
-    s = s.group_by(package_revision.c.id).\
-        order_by(func.min(revision.c.timestamp))
+    s = s.group_by(package_revision.c.id)
+    if since:
+        s = s.having(created >= since)
+    return s
+
+
+def get_new_datasets(pkg_ids=None, since=None):
+    '''
+    Return a list of new pkgs and date when they were created,
+    in format: [(id, datetime), ...]
+
+    If pkg_ids list is passed, limit query to just those packages.
+
+    If `since` is passed, only return packages created on or after it.
+    '''
+    s = _new_datasets_query(pkg_ids=pkg_ids, since=since)
+    s = s.order_by('created')
     res = model.Session.execute(s).fetchall()  # [(id, datetime), ...]
     res_pickleable = []
     for pkg_id, created_datetime in res:
@@ -39,9 +62,11 @@ def get_new_datasets(pkg_ids=None):
     return res_pickleable
 
 
-def get_package_revisions():
+def get_package_revisions(since=None):
     '''
     Return a list of revision id and datetime, in format: [(id, date), ...]
+
+    If `since` is passed, only return revisions made on or after it.
     '''
     package_revision = table('package_revision')
     revision = table('revision')
@@ -49,34 +74,158 @@ def get_package_revisions():
                from_obj=[package_revision.join(revision)]).\
         order_by(revision.c.timestamp)
     s = s.where(package_revision.c.type == 'dataset')
+    if since:
+        s = s.where(revision.c.timestamp >= since)
     res = model.Session.execute(s).fetchall()  # [(id, datetime), ...]
     return res
 
 
+def get_weekly_new_dataset_counts(pkg_ids=None, since=None):
+    '''
+    Return the number of new datasets in each week (starting Monday), in
+    format: [(week start date, count), ...]
+
+    On PostgreSQL the datasets are grouped into weekly batches by the
+    database and only one row per week is fetched, otherwise (e.g. SQLite)
+    they are grouped in Python.
+    '''
+    if not _sql_week_buckets():
+        new_datasets = get_new_datasets(pkg_ids=pkg_ids, since=since)
+        return _weekly_totals(new_datasets, zero_week=False)
+
+    new_datasets = _new_datasets_query(pkg_ids=pkg_ids,
+                                       since=since).alias('new_datasets')
+    week = func.date_trunc('week', new_datasets.c.created)
+    s = select([week, func.count(new_datasets.c.id)]).\
+        group_by(week).order_by(week)
+    res = model.Session.execute(s).fetchall()  # [(datetime, count), ...]
+    return [(week_start.date(), count) for week_start, count in res]
+
+
+def get_weekly_dataset_activity_counts(since=None):
+    '''
+    Return the number of datasets with at least one revision in each week
+    (starting Monday), in format: [(week start date, count), ...]
+
+    As `get_weekly_new_dataset_counts`, the batching is done by the database
+    on PostgreSQL.
+    '''
+    if not _sql_week_buckets():
+        return _weekly_distinct_totals(get_package_revisions(since=since))
+
+    package_revision = table('package_revision')
+    revision = table('revision')
+    week = func.date_trunc('week', revision.c.timestamp)
+    s = select([week, func.count(distinct(package_revision.c.id))],
+               from_obj=[package_revision.join(revision)])
+    s = s.where(package_revision.c.type == 'dataset')
+    if since:
+        s = s.where(revision.c.timestamp >= since)
+    s = s.group_by(week).order_by(week)
+    res = model.Session.execute(s).fetchall()  # [(datetime, count), ...]
+    return [(week_start.date(), count) for week_start, count in res]
+
+
+def get_weekly_new_dataset_counts_by_eurovoc_label(eurovoc_label=None):
+    '''
+    Return the number of new datasets in each week (starting Monday) for
+    every eurovoc category label, in format:
+    {label: [(week start date, count), ...], ...}
+
+    The label of each dataset is taken from the `sweden_package_eurovoc`
+    table, kept up to date when datasets are indexed, so all the labels are
+    worked out with a single query. If `eurovoc_label` is passed, only that
+    label is returned.
+    '''
+    new_datasets = _new_datasets_query().alias('new_datasets')
+    eurovoc = PackageEurovocCategory.__table__
+    label = eurovoc.c.eurovoc_category_label
+    from_obj = [new_datasets.join(
+        eurovoc, eurovoc.c.package_id == new_datasets.c.id)]
+
+    if _sql_week_buckets():
+        week = func.date_trunc('week', new_datasets.c.created)
+        s = select([label, week, func.count(new_datasets.c.id)],
+                   from_obj=from_obj)
+        group_by = [label, week]
+    else:
+        s = select([label, new_datasets.c.created], from_obj=from_obj)
+        group_by = None
+    if eurovoc_label:
+        s = s.where(label == eurovoc_label)
+    if group_by:
+        s = s.group_by(*group_by).order_by(*group_by)
+    else:
+        s = s.order_by(label, new_datasets.c.created)
+    res = model.Session.execute(s).fetchall()
+
+    week_counts = {}
+    if group_by:
+        for row_label, week_start, count in res:
+            week_counts.setdefault(row_label, []).append(
+                (week_start.date(), count))
+    else:
+        created_by_label = {}
+        for row_label, created in res:
+            created_by_label.setdefault(row_label, []).append(
+                _epoch_seconds(created))
+        for row_label, epoch_seconds in created_by_label.items():
+            week_counts[row_label] = [
+                (_epoch_seconds_to_date(week), count)
+                for week, count in _weekly_counts(epoch_seconds)]
+    return week_counts
+
+
+def _sql_week_buckets():
+    '''Whether the database can group timestamps into weeks itself.'''
+    return model.meta.engine.dialect.name == 'postgresql'
+
+
+def get_latest_revision_timestamp():
+    '''Return the datetime of the most recent dataset revision.'''
+    package_revision = table('package_revision')
+    revision = table('revision')
+    s = select([func.max(revision.c.timestamp)],
+               from_obj=[package_revision.join(revision)])
+    s = s.where(package_revision.c.type == 'dataset')
+    return model.Session.execute(s).scalar()
+
+
+@cached(per_user=False)
 def get_weekly_new_dataset_totals(timestamp=True, zero_week=True):
     '''For each week, return the cumulative total number of datasets.'''
-    new_datasets = get_new_datasets()
+    if _weekly_stats_available():
+        return _stored_weekly_totals(SERIES_CUMULATIVE, timestamp=timestamp,
+                                     zero_week=zero_week)
 
-    return _weekly_totals(new_datasets, timestamp=timestamp, cumulative=True,
-                          zero_week=zero_week)
+    return _format_weekly_totals(get_weekly_new_dataset_counts(),
+                                 cumulative=True, timestamp=timestamp,
+                                 zero_week=zero_week)
 
 
+@cached(per_user=False)
 def get_weekly_dataset_activity(timestamp=True, zero_week=True):
     '''For each week, get the number datasets with some sort of activity.'''
-    pkg_revisions = get_package_revisions()
+    if _weekly_stats_available():
+        return _stored_weekly_totals(SERIES_ACTIVITY, timestamp=timestamp,
+                                     zero_week=zero_week)
 
-    return _weekly_totals(pkg_revisions, timestamp=timestamp,
-                          zero_week=zero_week)
+    return _format_weekly_totals(get_weekly_dataset_activity_counts(),
+                                 timestamp=timestamp, zero_week=zero_week)
 
 
+@cached(per_user=False)
 def get_weekly_dataset_activity_new(timestamp=True, zero_week=True):
     '''For each week, get the number of new datasets.'''
-    new_datasets = get_new_datasets()
+    if _weekly_stats_available():
+        return _stored_weekly_totals(SERIES_NEW, timestamp=timestamp,
+                                     zero_week=zero_week)
 
-    return _weekly_totals(new_datasets, timestamp=timestamp,
-                          zero_week=zero_week)
+    return _format_weekly_totals(get_weekly_new_dataset_counts(),
+                                 timestamp=timestamp, zero_week=zero_week)
 
 
+@cached(per_user=False)
 def get_weekly_new_dataset_totals_for_eurovoc_label(eurovoc_label,
                                                     timestamp=True,
                                                     zero_week=True):
@@ -84,19 +233,112 @@ def get_weekly_new_dataset_totals_for_eurovoc_label(eurovoc_label,
     For a given eurovoc category label, return the cumulative total number of
     weekly new datasets.
     '''
-    # get package ids for packages with the relevant eurovoc category.
-    pkgs = toolkit.get_action('package_search')(
-        data_dict={'fq':
-                   u'+eurovoc_category_label:"{0}"'.format(eurovoc_label)}
-    )
-    pkg_ids = [pkg['id'] for pkg in pkgs['results']]
+    if not eurovoc_label:
+        return []
+
+    if _weekly_stats_available():
+        return _stored_weekly_totals(EUROVOC_SERIES_PREFIX + eurovoc_label,
+                                     timestamp=timestamp,
+                                     zero_week=zero_week)
 
-    # get a list of (package_revision id, datetime) for the passed package ids
-    new_datasets_for_pkg_ids = get_new_datasets(pkg_ids=pkg_ids)
+    week_counts = get_weekly_new_dataset_counts_by_eurovoc_label(
+        eurovoc_label=eurovoc_label).get(eurovoc_label, [])
 
-    return _weekly_totals(new_datasets_for_pkg_ids, timestamp=timestamp,
-                          cumulative=True,
-                          zero_week=zero_week)
+    return _format_weekly_totals(week_counts, cumulative=True,
+                                 timestamp=timestamp, zero_week=zero_week)
+
+
+def _weekly_stats_available():
+    '''Whether `refresh_weekly_stats` has populated the stats table.'''
+    return WeeklyStatsState.get() is not None
+
+
+def _stored_weekly_totals(series, timestamp=False, zero_week=True):
+    '''
+    Return a series from the `sweden_weekly_stats` table in the same format
+    as `_weekly_totals`.
+    '''
+    return _format_weekly_totals(WeeklyStat.series_rows(series),
+                                 timestamp=timestamp, zero_week=zero_week)
+
+
+def refresh_weekly_stats(full=False):
+    '''
+    Update the `sweden_weekly_stats` table with the revisions made since the
+    last refresh.
+
+    Weeks from the one holding the last processed revision onwards are
+    recomputed, older weeks are left untouched. If `full` is True, all the
+    series are rebuilt from scratch.
+
+    Per Eurovoc category series are always rebuilt, as the category of a
+    dataset can change at any time.
+    '''
+    state = WeeklyStatsState.get()
+    if state is None:
+        state = WeeklyStatsState()
+        model.Session.add(state)
+        full = True
+
+    latest = get_latest_revision_timestamp()
+
+    if full or not state.last_revision_timestamp:
+        since = None
+    else:
+        since = _transform_to_week_start(state.last_revision_timestamp)
+        since = datetime.datetime.combine(since, datetime.time())
+
+    q = model.Session.query(WeeklyStat) \
+        .filter(~WeeklyStat.series.startswith(EUROVOC_SERIES_PREFIX))
+    if since:
+        q = q.filter(WeeklyStat.week_start >= since.date())
+    q.delete(synchronize_session=False)
+
+    # New datasets and their cumulative totals
+    new_totals = get_weekly_new_dataset_counts(since=since)
+    previous_total = 0
+    if since:
+        previous_total = model.Session.query(WeeklyStat.count) \
+            .filter(WeeklyStat.series == SERIES_CUMULATIVE) \
+            .filter(WeeklyStat.week_start < since.date()) \
+            .order_by(WeeklyStat.week_start.desc()) \
+            .limit(1).scalar() or 0
+
+    _store_weekly_totals(SERIES_NEW, new_totals)
+
+    cumulative_totals = []
+    for week_start, count in new_totals:
+        previous_total += count
+        cumulative_totals.append((week_start, previous_total))
+    _store_weekly_totals(SERIES_CUMULATIVE, cumulative_totals)
+
+    # Dataset activity
+    _store_weekly_totals(SERIES_ACTIVITY,
+                         get_weekly_dataset_activity_counts(since=since))
+
+    # Per Eurovoc category cumulative totals
+    model.Session.query(WeeklyStat) \
+        .filter(WeeklyStat.series.startswith(EUROVOC_SERIES_PREFIX)) \
+        .delete(synchronize_session=False)
+
+    label_counts = get_weekly_new_dataset_counts_by_eurovoc_label()
+    for eurovoc_label, week_counts in label_counts.items():
+        _store_weekly_totals(
+            EUROVOC_SERIES_PREFIX + eurovoc_label,
+            _format_weekly_totals(week_counts, cumulative=True,
+                                  zero_week=False))
+
+    state.last_revision_timestamp = latest
+    state.last_refresh = datetime.datetime.now()
+    model.Session.commit()
+
+    log.info('Weekly stats refreshed up to %s', latest)
+
+
+def _store_weekly_totals(series, week_totals):
+    for week_start, count in week_totals:
+        model.Session.add(WeeklyStat(series=series, week_start=week_start,
+                                     count=count))
 
 
 def get_random_active_eurovoc_label():
@@ -105,12 +347,7 @@ def get_random_active_eurovoc_label():
     categories (that have at least one dataset, otherwise the chart will have
     nothing to show).
     '''
-    # get active eurovoc category labels from package search
-    search_results = toolkit.get_action('package_search')(
-        data_dict={'facet.field': ['eurovoc_category_label']}
-    )
-    facets = search_results.get('facets')
-    facet_labels = [key for key in facets['eurovoc_category_label'].keys()]
+    facet_labels = get_active_eurovoc_labels()
 
     try:
         return random.choice(facet_labels)
@@ -118,6 +355,21 @@ def get_random_active_eurovoc_label():
         return None
 
 
+@cached()
+def get_active_eurovoc_labels():
+    '''
+    Return the eurovoc category labels with at least one dataset visible to
+    the current user.
+    '''
+    # get active eurovoc category labels from package search
+    search_results = toolkit.get_action('package_search')(
+        data_dict={'facet.field': ['eurovoc_category_label'], 'rows': 0,
+                   'facet.limit': -1}
+    )
+    facets = search_results.get('facets')
+    return [key for key in facets['eurovoc_category_label'].keys()]
+
+
 def _weekly_totals(id_date_list, cumulative=False, timestamp=False,
                    zero_week=True):
     '''
@@ -136,38 +388,121 @@ def _weekly_totals(id_date_list, cumulative=False, timestamp=False,
 
     e.g.: [(1429488000000, 8), (1430092800000, 10), (1430697600000, 13)]
     '''
+    epoch_seconds = [_epoch_seconds(date_time)
+                     for pkg_id, date_time in id_date_list]
 
-    if zero_week:
-        first_date = id_date_list[0][1]
-        previous_week = first_date - datetime.timedelta(weeks=1)
-        previous_week_start = _transform_to_week_start(previous_week)
-        if timestamp:
-            previous_week_start = _datetime_to_timestamp(previous_week_start)
+    week_totals = _weekly_counts(epoch_seconds, cumulative=cumulative)
 
-    # transform each datetime to its week start and convert to timestamp
-    ids_week_start = [(pkg_id, _transform_to_week_start(date_time))
-                      for pkg_id, date_time in id_date_list]
+    if zero_week and week_totals:
+        week_totals.insert(0, (week_totals[0][0] - _WEEK_SECONDS, 0))
 
     if timestamp:
-        ids_week_start = [(pkg_id, _datetime_to_timestamp(date_time))
-                          for pkgs, date_time in ids_week_start]
+        return [(week * 1000, total) for week, total in week_totals]
+    return [(_epoch_seconds_to_date(week), total)
+            for week, total in week_totals]
+
 
-    # group ids by new date (weekly batches)
+def _weekly_counts(epoch_seconds, cumulative=False):
+    '''
+    For an ordered sequence of timestamps in seconds, count the number of
+    timestamps in each weekly batch (starting Monday).
+
+    The start of each week is computed arithmetically and the (cumulative)
+    totals are worked out in the same pass.
+
+    Return a list of tuples in the form (week start, count), where week start
+    is also a timestamp in seconds.
+    '''
     week_totals = []
-    total_datasets = 0
-    for week, group in groupby(ids_week_start, lambda x: x[1]):
+    current_week = None
+    count = 0
+    total = 0
+    for seconds in epoch_seconds:
+        week = seconds - (seconds + _WEEK_OFFSET) % _WEEK_SECONDS
+        if week != current_week:
+            if current_week is not None:
+                week_totals.append((current_week,
+                                    total if cumulative else count))
+            current_week = week
+            count = 0
+        count += 1
+        total += 1
+
+    if current_week is not None:
+        week_totals.append((current_week, total if cumulative else count))
+
+    return week_totals
+
+
+def _weekly_distinct_totals(id_date_list):
+    '''
+    As `_weekly_totals`, but ids appearing more than once in the same week
+    are only counted once.
+    '''
+    seen = set()
+    epoch_seconds = []
+    for pkg_id, date_time in id_date_list:
+        seconds = _epoch_seconds(date_time)
+        key = (pkg_id, seconds - (seconds + _WEEK_OFFSET) % _WEEK_SECONDS)
+        if key not in seen:
+            seen.add(key)
+            epoch_seconds.append(seconds)
+
+    return [(_epoch_seconds_to_date(week), count)
+            for week, count in _weekly_counts(epoch_seconds)]
+
+
+def _format_weekly_totals(week_counts, cumulative=False, timestamp=False,
+                          zero_week=True):
+    '''
+    For a list of (week start date, count) tuples, return a list in the same
+    format as `_weekly_totals` with the same `cumulative`, `timestamp` and
+    `zero_week` options.
+    '''
+    if not week_counts:
+        return []
+
+    week_totals = []
+    total = 0
+    for week_start, count in week_counts:
         if cumulative:
-            total_datasets += len(list(group))
+            total += count
         else:
-            total_datasets = len(list(group))
-        week_totals.append((week, total_datasets))
+            total = count
+        week_totals.append((week_start, total))
 
     if zero_week:
+        previous_week_start = week_totals[0][0] - datetime.timedelta(weeks=1)
         week_totals.insert(0, (previous_week_start, 0))
 
+    if timestamp:
+        week_totals = [(_datetime_to_timestamp(week_start), total)
+                       for week_start, total in week_totals]
+
     return week_totals
 
 
+# The epoch (1970-01-01) was a Thursday, so weeks starting on Monday begin
+# three days before each multiple of a week since the epoch.
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+_DAY_SECONDS = 24 * 60 * 60
+_WEEK_SECONDS = 7 * _DAY_SECONDS
+_WEEK_OFFSET = 3 * _DAY_SECONDS
+
+
+def _epoch_seconds(dt):
+    '''Convert given date or datetime object to a timestamp in seconds'''
+    seconds = (dt.toordinal() - _EPOCH_ORDINAL) * _DAY_SECONDS
+    if isinstance(dt, datetime.datetime):
+        seconds += dt.hour * 3600 + dt.minute * 60 + dt.second
+    return seconds
+
+
+def _epoch_seconds_to_date(seconds):
+    '''Convert given timestamp in seconds to a date object'''
+    return datetime.date.fromordinal(_EPOCH_ORDINAL + seconds // _DAY_SECONDS)
+
+
 def _datetime_to_timestamp(dt):
     '''Convert given datetime object to a timestamp in milliseconds'''
     return calendar.timegm(dt.timetuple()) * 1000
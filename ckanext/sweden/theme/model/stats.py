@@ -0,0 +1,65 @@
+from datetime import datetime
+from sqlalchemy import Column
+from sqlalchemy import types
+from sqlalchemy.ext.declarative import declarative_base
+
+import ckan.model as model
+
+log = __import__('logging').getLogger(__name__)
+
+Base = declarative_base()
+
+# Names of the stored series. Per Eurovoc category series are stored as
+# `EUROVOC_SERIES_PREFIX + label`.
+SERIES_NEW = u'new'
+SERIES_CUMULATIVE = u'cumulative'
+SERIES_ACTIVITY = u'activity'
+EUROVOC_SERIES_PREFIX = u'eurovoc:'
+
+STATE_ID = u'weekly_stats'
+
+
+class WeeklyStat(Base):
+    """
+    The dataset count for one series in one ISO week (starting Monday).
+    """
+    __tablename__ = 'sweden_weekly_stats'
+
+    series = Column(types.UnicodeText, primary_key=True)
+    week_start = Column(types.Date, primary_key=True)
+    count = Column(types.Integer, nullable=False, default=0)
+
+    @classmethod
+    def series_rows(cls, series):
+        '''Return the [(week_start, count), ...] rows of a series, in order.'''
+        return model.Session.query(cls.week_start, cls.count) \
+            .filter(cls.series == series) \
+            .order_by(cls.week_start) \
+            .all()
+
+    def __repr__(self):
+        return u"<WeeklyStat: %s, %s, %s>" % (self.series, self.week_start,
+                                              self.count)
+
+
+class WeeklyStatsState(Base):
+    """
+    Bookkeeping for the incremental refresh of the weekly stats.
+    """
+    __tablename__ = 'sweden_weekly_stats_state'
+
+    id = Column(types.UnicodeText, primary_key=True, default=STATE_ID)
+    last_revision_timestamp = Column(types.DateTime)
+    last_refresh = Column(types.DateTime, default=datetime.now)
+
+    @classmethod
+    def get(cls):
+        return model.Session.query(cls).filter(cls.id == STATE_ID).first()
+
+    def __repr__(self):
+        return u"<WeeklyStatsState: %s, %s>" % (self.last_revision_timestamp,
+                                                self.last_refresh)
+
+
+def init_tables(e):
+    Base.metadata.create_all(e)
@@ -1,31 +1,157 @@
+import time
+import random
+import logging
+
 from sqlalchemy.sql.expression import true
 
 import ckan.plugins as p
 from ckan import model
 
+from ckanext.sweden.cache import cached
+from ckanext.sweden.model import eurovoc as eurovoc_model
 from ckanext.sweden.theme import helpers
 from ckanext.sweden.theme.logic import actions
 from ckanext.sweden.theme.logic import auth
+from ckanext.sweden.theme.model import stats as stats_model
+
+log = logging.getLogger(__name__)
+
+
+# Fields rendered by the dataset snippets on the homepage
+HOMEPAGE_DATASET_FIELDS = ['id', 'name', 'title', 'notes', 'type', 'state',
+                           'capacity', 'res_format']
 
 
-def _get_datasets(sort):
+def _get_datasets(sort, facet_fields=None):
+    '''
+    Return the three first datasets for the given sort order, and the search
+    facets for `facet_fields` if passed.
+
+    Only the fields rendered on the homepage are requested from Solr.
+    '''
     context = {'model': model, 'session': model.Session,
                'user': p.toolkit.c.user, 'for_view': True,
                'auth_user_obj': p.toolkit.c.userobj}
     data_dict = {'fq': 'dataset_type:dataset', 'rows': 3, 'start': 0,
-                 'sort': sort}
+                 'sort': sort, 'fl': HOMEPAGE_DATASET_FIELDS}
+    if facet_fields:
+        data_dict.update({'facet.field': facet_fields, 'facet.limit': -1})
+    else:
+        data_dict['facet'] = 'false'
     query = p.toolkit.get_action('package_search')(context, data_dict)
-    if (query['results']):
-        return query['results']
-    return False
+    datasets = [_search_result_to_dataset(result)
+                for result in query['results']]
+    return datasets or False, query.get('facets', {})
+
+
+def _search_result_to_dataset(result):
+    '''
+    Turn a search result with just the fields in `HOMEPAGE_DATASET_FIELDS`
+    into a dataset dict the dataset snippets can render.
+
+    Full dataset dicts (on CKAN versions that don't support the `fl`
+    parameter) are returned as they are.
+    '''
+    if 'resources' in result:
+        return result
+    dataset = dict(result)
+    formats = result.get('res_format') or []
+    dataset['resources'] = [{'format': _format} for _format in formats]
+    dataset['num_resources'] = len(formats)
+    dataset['private'] = result.get('capacity') == 'private'
+    return dataset
+
+
+@cached()
+def _get_most_viewed_datasets_and_eurovoc_labels():
+    '''
+    Return the most viewed datasets and the eurovoc category labels with at
+    least one dataset, using a single search.
+    '''
+    datasets, facets = _get_datasets(
+        'views desc', facet_fields=['eurovoc_category_label'])
+    eurovoc_labels = facets.get('eurovoc_category_label', {}).keys()
+    return datasets, eurovoc_labels
 
 
 def get_most_viewed_datasets():
-    return _get_datasets('views desc')
+    return _get_most_viewed_datasets_and_eurovoc_labels()[0]
 
 
+@cached()
 def get_recently_updated_datasets():
-    return _get_datasets('metadata_modified desc')
+    return _get_datasets('metadata_modified desc')[0]
+
+
+def _timed(timings, block, func, *args, **kwargs):
+    '''Call `func` and record how long it took in milliseconds.'''
+    start = time.time()
+    result = func(*args, **kwargs)
+    timings[block] = int((time.time() - start) * 1000)
+    return result
+
+
+def _get_homepage_stats(timings, eurovoc_label):
+    return {
+        'eurovoc_label': eurovoc_label,
+        'weekly_new_dataset_totals': _timed(
+            timings, 'weekly_new_dataset_totals',
+            helpers.get_weekly_new_dataset_totals),
+        'weekly_dataset_activity': _timed(
+            timings, 'weekly_dataset_activity',
+            helpers.get_weekly_dataset_activity),
+        'weekly_dataset_activity_new': _timed(
+            timings, 'weekly_dataset_activity_new',
+            helpers.get_weekly_dataset_activity_new),
+        'weekly_new_dataset_totals_for_eurovoc_label': _timed(
+            timings, 'weekly_new_dataset_totals_for_eurovoc_label',
+            helpers.get_weekly_new_dataset_totals_for_eurovoc_label,
+            eurovoc_label),
+    }
+
+
+def get_homepage_stats():
+    '''
+    Return the data rendered by the homepage charts.
+
+    Only the featured eurovoc category needs a search (a facet-only one, if
+    it's not cached), the charts come from the weekly stats.
+    '''
+    timings = {}
+    eurovoc_label = _timed(timings, 'eurovoc_label',
+                           helpers.get_random_active_eurovoc_label)
+    data = _get_homepage_stats(timings, eurovoc_label)
+    data['timings'] = timings
+    return data
+
+
+def get_homepage_data():
+    '''
+    Return all the data rendered by the homepage blocks.
+
+    The dataset lists and the eurovoc categories come from two searches (the
+    second one only if it's not cached) and the charts from the weekly stats.
+    The time spent on each block is returned in `timings`.
+    '''
+    timings = {}
+
+    most_viewed, eurovoc_labels = _timed(
+        timings, 'most_viewed', _get_most_viewed_datasets_and_eurovoc_labels)
+    recently_updated = _timed(
+        timings, 'recently_updated', get_recently_updated_datasets)
+
+    eurovoc_label = random.choice(eurovoc_labels) if eurovoc_labels else None
+
+    data = _get_homepage_stats(timings, eurovoc_label)
+    data.update({
+        'most_viewed': most_viewed,
+        'recently_updated': recently_updated,
+        'timings': timings,
+    })
+
+    log.debug('Homepage data timings (ms): {0}'.format(timings))
+
+    return data
 
 
 def get_top_groups():
@@ -68,6 +194,13 @@ class ThemePlugin(p.SingletonPlugin):
         p.toolkit.add_public_directory(config, 'public')
         p.toolkit.add_resource('resources', 'theme')
 
+    # IConfigurable
+    def configure(self, config):
+        ''' Create the weekly stats tables if they don't exist yet
+        '''
+        stats_model.init_tables(model.meta.engine)
+        eurovoc_model.init_tables(model.meta.engine)
+
     # IActions
     def get_actions(self):
         return {
@@ -84,6 +217,8 @@ class ThemePlugin(p.SingletonPlugin):
             'get_recently_updated_datasets': get_recently_updated_datasets,
             'get_top_groups': get_top_groups,
             'get_recent_blog_posts': get_recent_blog_posts,
+            'get_homepage_data': get_homepage_data,
+            'get_homepage_stats': get_homepage_stats,
             'get_weekly_new_dataset_totals':
                 helpers.get_weekly_new_dataset_totals,
             'get_weekly_dataset_activity': helpers.get_weekly_dataset_activity,
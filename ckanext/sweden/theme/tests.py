@@ -4,11 +4,15 @@ from nose import tools as nosetools
 
 try:
     import ckan.tests.helpers as helpers
+    import ckan.tests.factories as factories
 except ImportError:
     # CKAN 2.3
     import ckan.new_tests.helpers as helpers
+    import ckan.new_tests.factories as factories
 
 from ckanext.sweden.theme import helpers as swe_helpers
+from ckanext.sweden.theme import plugin as theme_plugin
+from ckanext.sweden.model.eurovoc import set_package_eurovoc_category
 
 
 class TestWeeklyTotalsHelpers(helpers.FunctionalTestBase):
@@ -90,3 +94,138 @@ class TestWeeklyTotalsHelpers(helpers.FunctionalTestBase):
         # 4 in w/c 9 feb 2015
         nosetools.assert_equal(weekly_totals[2][0], 1423440000000)
         nosetools.assert_equal(weekly_totals[2][1], 4)
+
+    def test_weekly_totals_week_boundary(self):
+        '''
+        Datetimes on Sunday night and Monday morning are in different weekly
+        batches.
+        '''
+        l = [
+            ('01', datetime.datetime(2015, 1, 11, 23, 59, 59)),
+            ('02', datetime.datetime(2015, 1, 12, 0, 0, 0)),
+        ]
+
+        weekly_totals = swe_helpers._weekly_totals(l, zero_week=False)
+
+        nosetools.assert_equal(weekly_totals, [
+            (datetime.date(2015, 1, 5), 1),
+            (datetime.date(2015, 1, 12), 1),
+        ])
+
+    def test_weekly_totals_empty(self):
+        nosetools.assert_equal(swe_helpers._weekly_totals([]), [])
+
+
+class TestWeeklyStatsTable(helpers.FunctionalTestBase):
+
+    def test_stored_totals_match_live_totals(self):
+        '''
+        After a refresh, the weekly totals read from the stats table are the
+        same as the ones computed from the revision tables.
+        '''
+        factories.Dataset()
+        factories.Dataset()
+
+        new_datasets = swe_helpers.get_new_datasets()
+        live_totals = swe_helpers._weekly_totals(new_datasets,
+                                                 cumulative=True,
+                                                 timestamp=True)
+
+        swe_helpers.refresh_weekly_stats()
+
+        nosetools.assert_equal(swe_helpers.get_weekly_new_dataset_totals(),
+                               live_totals)
+
+    def test_incremental_refresh(self):
+        '''
+        Datasets created after a refresh are added on the next refresh.
+        '''
+        factories.Dataset()
+        swe_helpers.refresh_weekly_stats()
+
+        factories.Dataset()
+        swe_helpers.refresh_weekly_stats()
+
+        totals = swe_helpers.get_weekly_new_dataset_totals(zero_week=False)
+        nosetools.assert_equal(totals[-1][1], 2)
+
+    def test_weekly_counts_by_eurovoc_label(self):
+        '''
+        New datasets are counted for the eurovoc category label they were
+        indexed with, all labels at once.
+        '''
+        dataset1 = factories.Dataset()
+        dataset2 = factories.Dataset()
+        factories.Dataset()
+        set_package_eurovoc_category(dataset1['id'],
+                                     u'http://eurovoc.europa.eu/100142',
+                                     u'Politics')
+        set_package_eurovoc_category(dataset2['id'],
+                                     u'http://eurovoc.europa.eu/100160',
+                                     u'Energy')
+
+        counts = swe_helpers.get_weekly_new_dataset_counts_by_eurovoc_label()
+
+        nosetools.assert_equal(sorted(counts.keys()),
+                               [u'Energy', u'Politics'])
+        nosetools.assert_equal(sum(c for w, c in counts[u'Politics']), 1)
+        nosetools.assert_equal(sum(c for w, c in counts[u'Energy']), 1)
+
+
+class TestHomepageStats(helpers.FunctionalTestBase):
+
+    def test_homepage_stats_do_not_search_datasets(self):
+        '''
+        The charts data is returned without the homepage dataset lists.
+        '''
+        factories.Dataset()
+
+        stats = theme_plugin.get_homepage_stats()
+
+        for key in ('weekly_new_dataset_totals', 'weekly_dataset_activity',
+                    'weekly_dataset_activity_new',
+                    'weekly_new_dataset_totals_for_eurovoc_label',
+                    'eurovoc_label'):
+            assert key in stats
+        assert 'most_viewed' not in stats
+        assert 'recently_updated' not in stats
+        assert 'most_viewed' not in stats['timings']
+        assert 'recently_updated' not in stats['timings']
+
+
+class TestFormatWeeklyTotals(object):
+
+    l = TestWeeklyTotalsHelpers.l
+
+    def test_format_weekly_totals_matches_weekly_totals(self):
+        '''
+        Formatting per week counts gives the same output as `_weekly_totals`
+        for every combination of options.
+        '''
+        week_counts = swe_helpers._weekly_totals(self.l, zero_week=False)
+
+        for cumulative in (False, True):
+            for timestamp in (False, True):
+                for zero_week in (False, True):
+                    nosetools.assert_equal(
+                        swe_helpers._format_weekly_totals(
+                            week_counts, cumulative=cumulative,
+                            timestamp=timestamp, zero_week=zero_week),
+                        swe_helpers._weekly_totals(
+                            self.l, cumulative=cumulative,
+                            timestamp=timestamp, zero_week=zero_week))
+
+    def test_format_weekly_totals_empty(self):
+        nosetools.assert_equal(swe_helpers._format_weekly_totals([]), [])
+
+    def test_weekly_distinct_totals(self):
+        '''
+        Ids with more than one date in the same week are only counted once.
+        '''
+        weekly_totals = swe_helpers._weekly_distinct_totals(self.l)
+
+        nosetools.assert_equal(weekly_totals, [
+            (datetime.date(2014, 12, 29), 2),
+            (datetime.date(2015, 1, 19), 1),
+            (datetime.date(2015, 2, 9), 1),
+        ])
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+'''
+Benchmark of the weekly batching used by the homepage charts and the stats
+API (`ckanext.sweden.theme.helpers._weekly_totals`), compared with the
+previous implementation based on `isocalendar()` and `groupby`.
+
+Unlike the other scripts in this folder, it needs to run on the virtualenv
+where CKAN and ckanext-sweden are installed:
+
+    python benchmark_weekly_totals.py
+    python benchmark_weekly_totals.py -s 100000 1000000
+
+'''
+import sys
+import argparse
+import calendar
+import datetime
+import random
+import timeit
+from itertools import groupby
+
+from ckanext.sweden.theme import helpers
+
+
+def _legacy_weekly_totals(id_date_list, cumulative=False, timestamp=False,
+                          zero_week=True):
+    '''The `_weekly_totals` implementation this benchmark compares to.'''
+
+    def _datetime_to_timestamp(dt):
+        return calendar.timegm(dt.timetuple()) * 1000
+
+    def _iso_year_start(iso_year):
+        fourth_jan = datetime.date(iso_year, 1, 4)
+        delta = datetime.timedelta(fourth_jan.isoweekday()-1)
+        return fourth_jan - delta
+
+    def _transform_to_week_start(dt):
+        iso_year, iso_week, _ = dt.isocalendar()
+        year_start = _iso_year_start(iso_year)
+        return year_start + datetime.timedelta(weeks=iso_week-1)
+
+    if zero_week:
+        first_date = id_date_list[0][1]
+        previous_week = first_date - datetime.timedelta(weeks=1)
+        previous_week_start = _transform_to_week_start(previous_week)
+        if timestamp:
+            previous_week_start = _datetime_to_timestamp(previous_week_start)
+
+    ids_week_start = [(pkg_id, _transform_to_week_start(date_time))
+                      for pkg_id, date_time in id_date_list]
+
+    if timestamp:
+        ids_week_start = [(pkg_id, _datetime_to_timestamp(date_time))
+                          for pkg_id, date_time in ids_week_start]
+
+    week_totals = []
+    total_datasets = 0
+    for week, group in groupby(ids_week_start, lambda x: x[1]):
+        if cumulative:
+            total_datasets += len(list(group))
+        else:
+            total_datasets = len(list(group))
+        week_totals.append((week, total_datasets))
+
+    if zero_week:
+        week_totals.insert(0, (previous_week_start, 0))
+
+    return week_totals
+
+
+def _id_date_list(size, years=5):
+    '''Return `size` ordered (id, datetime) tuples spread over `years`.'''
+    start = datetime.datetime(2010, 1, 1)
+    span = years * 365 * 24 * 60 * 60
+    offsets = sorted(random.randint(0, span) for i in xrange(size))
+    return [(str(i % 5000), start + datetime.timedelta(seconds=offset))
+            for i, offset in enumerate(offsets)]
+
+
+def run(sizes, repeat=3):
+    print '{0:>10} {1:>12} {2:>12} {3:>8}'.format(
+        'rows', 'legacy (s)', 'current (s)', 'speedup')
+    for size in sizes:
+        id_date_list = _id_date_list(size)
+
+        legacy = _legacy_weekly_totals(id_date_list, cumulative=True,
+                                       timestamp=True)
+        current = helpers._weekly_totals(id_date_list, cumulative=True,
+                                         timestamp=True)
+        if legacy != current:
+            print 'Results differ for {0} rows'.format(size)
+            sys.exit(1)
+
+        legacy_time = min(timeit.repeat(
+            lambda: _legacy_weekly_totals(id_date_list, cumulative=True,
+                                          timestamp=True),
+            number=1, repeat=repeat))
+        current_time = min(timeit.repeat(
+            lambda: helpers._weekly_totals(id_date_list, cumulative=True,
+                                           timestamp=True),
+            number=1, repeat=repeat))
+
+        print '{0:>10} {1:>12.3f} {2:>12.3f} {3:>7.1f}x'.format(
+            size, legacy_time, current_time, legacy_time / current_time)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the weekly batching of dataset revisions')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                        default=[100000, 1000000, 10000000],
+                        help='Number of rows to benchmark with')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Number of runs per size (the best is reported)')
+    args = parser.parse_args()
+
+    run(args.sizes, repeat=args.repeat)
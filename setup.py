@@ -35,6 +35,10 @@ setup(
 
         [paste.paster_command]
         sweden_blog_init = ckanext.sweden.blog.commands.blog_init:InitDB
+        sweden_stats = ckanext.sweden.theme.commands.stats:StatsCommand
+        sweden_dcat_snapshots = ckanext.sweden.commands.snapshots:SnapshotsCommand
+        sweden_harvest_schedule = ckanext.sweden.commands.schedule:ScheduleCommand
+        sweden_organization_urls = ckanext.sweden.commands.organization_urls:OrganizationURLsCommand
 
         [babel.extractors]
         ckan = ckan.lib.extract:extract_ckan